@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the study chatbot's chunking stage: split speed and retrieval recall.
+
+A synthetic corpus of writeup-like pages is generated with facts (XOR keys, buffer offsets, public exponents) planted at random
+places. Each chunking configuration splits the corpus, the chunks are embedded, and recall@k is the share of
+questions about a planted fact whose top-k chunks contain the answer. The `hashing` embedder (bag of
+nomic-embed-text token IDs) runs offline; `ollama` uses the real nomic-embed-text through the configured server.
+
+Run from the ctfbuddy directory:
+    python -m benchmarks.chunking_benchmark [--docs 200] [--embedder hashing|ollama] [--k 4] [--json report.json]
+"""
+
+import argparse
+import json
+import random
+from time import perf_counter
+
+import numpy as np
+
+from modules.chunking import Chunker
+from modules.tokenisers import get_nomic_embed_text_tokeniser
+
+CHUNK_CONFIGS = [(256, 0), (256, 32), (512, 64), (1024, 128)]
+BASELINE_CHUNK_SIZE = 7500
+BASELINE_CHUNK_OVERLAP = 100
+HASHING_DIM = 4096
+
+FILLER_SENTENCES = [
+    "The challenge gives us a ciphertext and a short Python script that produced it.",
+    "We start by reading the source to understand how the key is derived.",
+    "Running the binary under gdb shows the input is copied onto the stack without a length check.",
+    "The modulus is small enough that factoring it with FactorDB takes a few seconds.",
+    "After decoding the base64 blob we are left with what looks like repeating-key XOR.",
+    "Frequency analysis on the first few hundred bytes suggests English plaintext.",
+    "The server leaks one bit of the nonce on every signature it hands out.",
+    "Padding errors are reported differently from MAC errors, which gives us an oracle.",
+    "Sagemath makes the lattice reduction step straightforward.",
+    "The flag is only printed once the checksum matches the expected value.",
+]
+FACT_TEMPLATES = [
+    (
+        "The XOR key for the {name} challenge turned out to be {answer}.",
+        "What was the XOR key in the {name} challenge?",
+    ),
+    (
+        "In {name}, the vulnerable buffer sits at offset {answer} from the return address.",
+        "At what offset is the vulnerable buffer in {name}?",
+    ),
+    (
+        "The public exponent used by {name} was {answer}, which enables a small exponent attack.",
+        "Which public exponent did {name} use?",
+    ),
+]
+
+
+def make_corpus(no_docs, seed=0):
+    rng = random.Random(seed)
+    docs = []
+    questions = []
+    for i in range(no_docs):
+        paragraphs = [
+            " ".join(rng.choices(FILLER_SENTENCES, k=rng.randint(3, 8)))
+            for _ in range(rng.randint(4, 20))
+        ]
+        name = f"chall-{i:04d}"
+        fact_template, question_template = rng.choice(FACT_TEMPLATES)
+        answer = f"0x{rng.getrandbits(48):012x}"
+        paragraphs.insert(
+            rng.randrange(len(paragraphs) + 1),
+            fact_template.format(name=name, answer=answer),
+        )
+        docs.append(f"# Writeup: {name}\n\n" + "\n\n".join(paragraphs))
+        questions.append((question_template.format(name=name), answer))
+    return docs, questions
+
+
+def make_hashing_embedder():
+    tokeniser = get_nomic_embed_text_tokeniser()
+
+    def embed(texts):
+        vectors = np.zeros((len(texts), HASHING_DIM), dtype=np.float32)
+        for i, encoding in enumerate(tokeniser.encode_batch(texts)):
+            np.add.at(vectors[i], np.asarray(encoding.ids) % HASHING_DIM, 1.0)
+        return vectors
+
+    return embed, embed
+
+
+def make_ollama_embedder():
+    from modules.embeddings import EmbeddingService
+
+    service = EmbeddingService()
+    return (
+        lambda texts: np.asarray(service.embed_documents(texts), dtype=np.float32),
+        lambda texts: np.asarray(
+            [service.embed_query(text) for text in texts], dtype=np.float32
+        ),
+    )
+
+
+def normalise(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def recall_at_k(chunks, questions, embed_docs, embed_queries, k):
+    chunk_vectors = normalise(embed_docs(chunks))
+    query_vectors = normalise(embed_queries([question for question, _ in questions]))
+    top_k = np.argsort(-(query_vectors @ chunk_vectors.T), axis=1)[:, :k]
+    hits = sum(
+        any(answer in chunks[j] for j in row)
+        for row, (_, answer) in zip(top_k, questions)
+    )
+    return hits / len(questions)
+
+
+def bench_splitter(name, split_text, docs, questions, embedder, k):
+    tokeniser = get_nomic_embed_text_tokeniser()
+    start_time = perf_counter()
+    chunks = [chunk for doc in docs for chunk in split_text(doc)]
+    split_seconds = perf_counter() - start_time
+
+    no_doc_tokens = sum(len(encoding.ids) for encoding in tokeniser.encode_batch(docs))
+    chunk_tokens = [len(encoding.ids) for encoding in tokeniser.encode_batch(chunks)]
+    return {
+        "splitter": name,
+        "chunks": len(chunks),
+        "mean_chunk_tokens": round(float(np.mean(chunk_tokens)), 1),
+        "max_chunk_tokens": max(chunk_tokens),
+        "split_seconds": round(split_seconds, 4),
+        "tokens_per_s": round(no_doc_tokens / split_seconds) if split_seconds else None,
+        f"recall@{k}": round(recall_at_k(chunks, questions, *embedder, k), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--docs", type=int, default=200)
+    parser.add_argument("--embedder", choices=["hashing", "ollama"], default="hashing")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    docs, questions = make_corpus(args.docs, args.seed)
+    embedder = (
+        make_hashing_embedder()
+        if args.embedder == "hashing"
+        else make_ollama_embedder()
+    )
+
+    results = []
+    for chunk_size, chunk_overlap in CHUNK_CONFIGS:
+        chunker = Chunker(chunk_size, chunk_overlap)
+        results.append(
+            bench_splitter(
+                f"Chunker({chunk_size}, {chunk_overlap})",
+                chunker.split_text,
+                docs,
+                questions,
+                embedder,
+                args.k,
+            )
+        )
+
+    try:
+        from langchain.text_splitter import CharacterTextSplitter
+
+        baseline = CharacterTextSplitter.from_tiktoken_encoder(
+            chunk_size=BASELINE_CHUNK_SIZE, chunk_overlap=BASELINE_CHUNK_OVERLAP
+        )
+        results.append(
+            bench_splitter(
+                f"CharacterTextSplitter({BASELINE_CHUNK_SIZE}, {BASELINE_CHUNK_OVERLAP})",
+                baseline.split_text,
+                docs,
+                questions,
+                embedder,
+                args.k,
+            )
+        )
+    except Exception as e:
+        print(f"Skipped the tiktoken baseline: {e}")
+
+    columns = list(results[0])
+    print(" | ".join(columns))
+    for result in results:
+        print(" | ".join(str(result[column]) for column in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "docs": args.docs,
+                    "embedder": args.embedder,
+                    "k": args.k,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the chat paths, run entirely offline against a mock Ollama server.
+
+The mock server (benchmarks/mock_ollama.py) runs in a child process and streams canned replies at a fixed token rate,
+and stub tokenisers stand in for the Hugging Face ones, so no model, network or API key is needed. Each scenario runs
+under every session count, with each session making `--requests` requests one after another:
+
+    ollama_chat        streamed OllamaChat generations, one thread per session
+    crypto_autosolver  every step of the crypto autosolver (all of CA_STARTING_PROMPTS), one asyncio task per session
+    retrieval          the Autosurfer in offline mode: hybrid retrieval and reranking over a synthetic corpus, then
+                       a streamed answer, one thread per session
+
+The report gives p50/p95 time to first token and end-to-end latency per request, throughput, and the benchmark
+process's CPU time and RSS (the mock server's own CPU is excluded). Caches and the config live in a temporary
+directory, so the real .cache is left untouched. Compare the JSON reports of two runs to catch regressions.
+
+Run from the ctfbuddy directory:
+    python -m benchmarks.load_benchmark [--sessions 1 8 32] [--requests 2] [--parallel 2] [--tokens-per-second 200]
+        [--first-token-delay 0.05] [--scenarios ollama_chat crypto_autosolver retrieval] [--json report.json]
+"""
+
+import argparse
+import asyncio
+import configparser
+import contextlib
+import io
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from time import perf_counter, process_time
+
+import numpy as np
+from langchain_core.documents import Document
+
+import modules.config as config
+import modules.response_cache as response_cache
+import modules.vector_index as vector_index
+import modules.web_cache as web_cache
+from benchmarks.mock_ollama import (
+    DEFAULT_FIRST_TOKEN_DELAY,
+    DEFAULT_REPLY_TOKENS,
+    DEFAULT_TOKENS_PER_SECOND,
+    MockOllamaServer,
+)
+from benchmarks.stub_tokenisers import install_stub_tokenisers
+from modules.autosolver_categories.crypto_autosolver import crypto_autosolver
+from modules.bm25_index import BM25Index
+from modules.embeddings import EmbeddingService, VectorCache
+from modules.host import get_host
+from modules.ollama_chat import OllamaChat
+from modules.study_chatbot.gen_response import gen_response
+from modules.tokenisers import MODEL_SPECS
+
+SCENARIOS = ["ollama_chat", "crypto_autosolver", "retrieval"]
+DEFAULT_SESSIONS = [1, 8, 32]
+BENCHMARK_MODEL = "llama3"
+CORPUS_DOCS = 200
+TOPICS = [
+    ("RSA", "a small public exponent of {n} lets a cube root recover the plaintext"),
+    (
+        "XOR",
+        "the repeating key 0x{n:04x} is recovered by crib-dragging the flag prefix",
+    ),
+    (
+        "buffer overflow",
+        "the return address sits {n} bytes past the start of the buffer",
+    ),
+    ("padding oracle", "byte {n} of the IV is brute forced from the padding errors"),
+    ("format string", "the {n}th argument on the stack leaks the canary"),
+]
+
+
+def start_mock_server(**kwargs):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve_mock, args=(child_conn, kwargs), daemon=True
+    )
+    process.start()
+    return process, parent_conn.recv()
+
+
+def _serve_mock(conn, kwargs):
+    server = MockOllamaServer(**kwargs)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+def setup_environment(tmp_dir, ollama_url, parallel):
+    """
+    Points the config and every cache at `tmp_dir` and loads the stub tokenisers.
+    """
+    config.CONFIG_STORE.path = path.join(tmp_dir, "config.ini")
+    parser = configparser.ConfigParser()
+    parser["Server"] = {
+        "server_name": "127.0.0.1",
+        "server_port": "7860",
+        "ollama_server_url": ollama_url,
+        "ollama_num_parallel": str(parallel),
+        # Room for a stub tokeniser per model and nomic-embed-text
+        "max_loaded_tokenisers": str(len(MODEL_SPECS) + 1),
+    }
+    parser["Keys_and_IDs"] = {
+        "google_api_key": "unused",
+        "google_prog_search_engine_id": "unused",
+        "huggingface_user_access_token": "unused",
+    }  # Never used offline, but the autosolvers refuse to run without them
+    with open(config.CONFIG_STORE.path, "w") as f:
+        parser.write(f)
+
+    install_stub_tokenisers()
+    response_cache._response_cache = response_cache.ResponseCache(
+        path.join(tmp_dir, "responses.sqlite3")
+    )
+    web_cache._web_cache = web_cache.WebCache(path.join(tmp_dir, "web.sqlite3"))
+    vector_index._vector_index = vector_index.VectorIndex(
+        EmbeddingService(vector_cache=VectorCache(path.join(tmp_dir, "embeddings"))),
+        path.join(tmp_dir, "vector_index"),
+        bm25_index=BM25Index(path.join(tmp_dir, "bm25.sqlite3")),
+    )
+
+
+def make_corpus(no_docs):
+    docs = []
+    for i in range(no_docs):
+        topic, fact = TOPICS[i % len(TOPICS)]
+        docs.append(
+            Document(
+                page_content=f"Writeup {i}: {topic} challenge. "
+                + fact.format(n=i + 3).capitalize()
+                + ". We scripted the exploit in Python and got the flag.",
+                metadata={
+                    "source": f"https://example.com/writeup/{i}",
+                    "title": f"Writeup {i}",
+                },
+            )
+        )
+    return docs
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": None, "p95": None}
+    return {
+        "p50": round(float(np.percentile(values, 50)), 4),
+        "p95": round(float(np.percentile(values, 95)), 4),
+    }
+
+
+def run_ollama_chat_request(session, request_no):
+    ollama_chat = OllamaChat(
+        get_host(),
+        BENCHMARK_MODEL,
+        "You are a helpful assistant for CTF players.",
+        session_id=f"session-{session}",
+    )
+    ollama_chat.append_message(
+        "user",
+        f"Session {session}, request {request_no}: how do I attack textbook RSA?",
+    )
+    start_time = perf_counter()
+    ttft = None
+    for _ in ollama_chat.invoke_and_append_generated_message(stream=True):
+        if ttft is None:
+            ttft = perf_counter() - start_time
+    return ttft, perf_counter() - start_time
+
+
+def run_retrieval_request(session, request_no):
+    start_time = perf_counter()
+    ttft = None
+    for _, chat_history, _ in gen_response(
+        BENCHMARK_MODEL,
+        False,
+        False,
+        f"Session {session}, request {request_no}: how is the repeating XOR key recovered?",
+        [],
+    ):
+        if ttft is None and chat_history and chat_history[-1][1]:
+            ttft = perf_counter() - start_time
+    return ttft, perf_counter() - start_time
+
+
+async def run_crypto_autosolver_request(session, request_no):
+    start_time = perf_counter()
+    ttft = None
+    async for history, _, _ in crypto_autosolver(
+        BENCHMARK_MODEL,
+        f"Baby RSA {session}-{request_no}",
+        "flag{...}",
+        "n = 3233, e = 17, c = 2790. Recover the message.",
+        [],
+        [],
+        bypass_cache=True,
+    ):
+        if ttft is None and history and history[-1][1]:
+            ttft = perf_counter() - start_time
+    return ttft, perf_counter() - start_time
+
+
+def run_threaded(request_func, no_sessions, no_requests):
+    def session_worker(session):
+        return [request_func(session, i) for i in range(no_requests)]
+
+    with ThreadPoolExecutor(max_workers=no_sessions) as executor:
+        return [
+            result
+            for results in executor.map(session_worker, range(no_sessions))
+            for result in results
+        ]
+
+
+def run_async(request_func, no_sessions, no_requests):
+    async def session_worker(session):
+        return [await request_func(session, i) for i in range(no_requests)]
+
+    async def run_all():
+        return await asyncio.gather(
+            *(session_worker(session) for session in range(no_sessions))
+        )
+
+    return [result for results in asyncio.run(run_all()) for result in results]
+
+
+def run_scenario(scenario, no_sessions, no_requests):
+    if scenario == "crypto_autosolver":
+        run = lambda: run_async(run_crypto_autosolver_request, no_sessions, no_requests)
+    else:
+        request_func = (
+            run_ollama_chat_request
+            if scenario == "ollama_chat"
+            else run_retrieval_request
+        )
+        run = lambda: run_threaded(request_func, no_sessions, no_requests)
+
+    cpu_start = process_time()
+    wall_start = perf_counter()
+    results = run()
+    wall_time = perf_counter() - wall_start
+    cpu_time = process_time() - cpu_start
+
+    ttfts = [ttft for ttft, _ in results if ttft is not None]
+    latencies = [latency for _, latency in results]
+    return {
+        "scenario": scenario,
+        "sessions": no_sessions,
+        "requests": len(results),
+        "ttft_seconds": percentiles(ttfts),
+        "latency_seconds": percentiles(latencies),
+        "wall_seconds": round(wall_time, 4),
+        "requests_per_second": round(len(results) / wall_time, 3),
+        "cpu_seconds": round(cpu_time, 4),
+        "cpu_percent": round(100 * cpu_time / wall_time, 1),
+        "rss_mb": round(rss_mb(), 1),
+        "peak_rss_mb": round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+    }
+
+
+def format_table(results):
+    lines = [
+        f"{'scenario':<18} {'sessions':>8} {'reqs':>5} {'ttft p50':>9} {'ttft p95':>9} {'e2e p50':>8} {'e2e p95':>8} {'req/s':>7} {'cpu%':>6} {'rss MB':>7}"
+    ]
+    for result in results:
+        lines.append(
+            f"{result['scenario']:<18} {result['sessions']:>8} {result['requests']:>5} "
+            f"{result['ttft_seconds']['p50'] or 0:>9.3f} {result['ttft_seconds']['p95'] or 0:>9.3f} "
+            f"{result['latency_seconds']['p50']:>8.3f} {result['latency_seconds']['p95']:>8.3f} "
+            f"{result['requests_per_second']:>7.2f} {result['cpu_percent']:>6.1f} {result['rss_mb']:>7.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sessions", type=int, nargs="+", default=DEFAULT_SESSIONS)
+    parser.add_argument("--requests", type=int, default=2, help="requests per session")
+    parser.add_argument(
+        "--parallel",
+        type=int,
+        default=2,
+        help="generations the scheduler lets run at once",
+    )
+    parser.add_argument(
+        "--tokens-per-second", type=float, default=DEFAULT_TOKENS_PER_SECOND
+    )
+    parser.add_argument(
+        "--first-token-delay", type=float, default=DEFAULT_FIRST_TOKEN_DELAY
+    )
+    parser.add_argument("--reply-tokens", type=int, default=DEFAULT_REPLY_TOKENS)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the app's log output"
+    )
+    args = parser.parse_args()
+
+    mock_process, ollama_url = start_mock_server(
+        tokens_per_second=args.tokens_per_second,
+        first_token_delay=args.first_token_delay,
+        reply_tokens=args.reply_tokens,
+    )
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            log_output = sys.stdout if args.verbose else io.StringIO()
+            if not args.verbose:
+                warnings.filterwarnings("ignore", module="gradio")
+            with contextlib.redirect_stdout(log_output):
+                setup_environment(tmp_dir, ollama_url, args.parallel)
+                if "retrieval" in args.scenarios:
+                    vector_index.get_vector_index().add_documents(
+                        make_corpus(CORPUS_DOCS)
+                    )
+
+            for scenario in args.scenarios:
+                for no_sessions in args.sessions:
+                    with contextlib.redirect_stdout(log_output):
+                        result = run_scenario(scenario, no_sessions, args.requests)
+                    results.append(result)
+                    print(format_table([result]).splitlines()[-1], flush=True)
+    finally:
+        mock_process.terminate()
+
+    print()
+    print(format_table(results))
+    if args.json:
+        report = {
+            "settings": {
+                "parallel": args.parallel,
+                "requests_per_session": args.requests,
+                "tokens_per_second": args.tokens_per_second,
+                "first_token_delay": args.first_token_delay,
+                "reply_tokens": args.reply_tokens,
+                "model": BENCHMARK_MODEL,
+            },
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nWrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
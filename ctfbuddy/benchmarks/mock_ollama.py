@@ -0,0 +1,200 @@
+"""
+A deterministic stand-in for the Ollama HTTP API, for benchmarks that must run without a model or a network.
+
+Chat and generate requests stream a canned reply of `reply_tokens` tokens at `tokens_per_second` after a
+`first_token_delay` (plus prompt evaluation at `prompt_tokens_per_second`), and report Ollama-style durations in
+their final chunk; JSON-mode requests get a reranker-style `{"score": n}` reply. Embedding requests return unit vectors derived from a hash of each text. Every request is
+counted in `stats`.
+"""
+
+import json
+from collections import Counter
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter, sleep
+
+import numpy as np
+
+DEFAULT_TOKENS_PER_SECOND = 200
+DEFAULT_PROMPT_TOKENS_PER_SECOND = 5000
+DEFAULT_FIRST_TOKEN_DELAY = 0.05  # seconds
+DEFAULT_REPLY_TOKENS = 32
+DEFAULT_EMBEDDING_DIM = 64
+CHARS_PER_TOKEN = 4
+REPLY_WORDS = [
+    "factor",
+    " the",
+    " modulus",
+    ",",
+    " then",
+    " decrypt",
+    " the",
+    " flag",
+    ".",
+]
+
+
+def fake_embedding(text, dim=DEFAULT_EMBEDDING_DIM):
+    seed = int.from_bytes(sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dim)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class MockOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        tokens_per_second=DEFAULT_TOKENS_PER_SECOND,
+        prompt_tokens_per_second=DEFAULT_PROMPT_TOKENS_PER_SECOND,
+        first_token_delay=DEFAULT_FIRST_TOKEN_DELAY,
+        reply_tokens=DEFAULT_REPLY_TOKENS,
+        embedding_dim=DEFAULT_EMBEDDING_DIM,
+    ):
+        super().__init__((host, port), _MockOllamaHandler)
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.first_token_delay = first_token_delay
+        self.reply_tokens = reply_tokens
+        self.embedding_dim = embedding_dim
+        self.loaded_models = set()
+        self.stats = Counter()
+        self._lock = Lock()
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        Thread(target=self.serve_forever, name="mock-ollama", daemon=True).start()
+        return self
+
+    def record(self, endpoint, model=None):
+        with self._lock:
+            self.stats[endpoint] += 1
+            if model:
+                self.loaded_models.add(model)
+
+
+class _MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, payload):
+        data = (json.dumps(payload) + "\n").encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/ps":
+            self._send_json(
+                {
+                    "models": [
+                        {"name": name} for name in sorted(self.server.loaded_models)
+                    ]
+                }
+            )
+        elif self.path == "/api/tags":
+            self._send_json({"models": []})
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])) or b"{}")
+        if self.path in ("/api/chat", "/api/generate"):
+            self._generate(body)
+        elif self.path == "/api/embed":
+            self.server.record(self.path, body.get("model"))
+            inputs = (
+                body["input"] if isinstance(body["input"], list) else [body["input"]]
+            )
+            self._send_json(
+                {
+                    "model": body.get("model"),
+                    "embeddings": [
+                        fake_embedding(text, self.server.embedding_dim)
+                        for text in inputs
+                    ],
+                }
+            )
+        elif self.path == "/api/embeddings":
+            self.server.record(self.path, body.get("model"))
+            self._send_json(
+                {"embedding": fake_embedding(body["prompt"], self.server.embedding_dim)}
+            )
+        else:
+            self._send_json({"error": "not found"}, 404)
+
+    def _generate(self, body):
+        server = self.server
+        server.record(self.path, body.get("model"))
+        start_time = perf_counter()
+        is_chat = self.path == "/api/chat"
+        prompt = (
+            "".join(message.get("content", "") for message in body.get("messages", []))
+            if is_chat
+            else body.get("prompt", "")
+        )
+        no_prompt_tokens = max(len(prompt) // CHARS_PER_TOKEN, 1)
+        prompt_eval_duration = no_prompt_tokens / server.prompt_tokens_per_second
+        no_reply_tokens = body.get("options", {}).get(
+            "num_predict", server.reply_tokens
+        )
+        if not prompt and not is_chat:
+            no_reply_tokens = 0  # An empty generate request only loads the model
+        words = [REPLY_WORDS[i % len(REPLY_WORDS)] for i in range(no_reply_tokens)]
+        if body.get("format") == "json":
+            words = ['{"score": ', str(len(prompt) % 10), "}"]  # Reranker scores
+            no_reply_tokens = len(words)
+
+        def message(content):
+            if is_chat:
+                return {"message": {"role": "assistant", "content": content}}
+            return {"response": content}
+
+        sleep(server.first_token_delay + prompt_eval_duration)
+        eval_start_time = perf_counter()
+        final = {
+            "model": body.get("model"),
+            "done": True,
+            "prompt_eval_count": no_prompt_tokens,
+            "prompt_eval_duration": int(prompt_eval_duration * 1e9),
+            "eval_count": no_reply_tokens,
+            "load_duration": int(server.first_token_delay * 1e9),
+        }
+
+        if not body.get("stream", True):
+            sleep(no_reply_tokens / server.tokens_per_second)
+            final["eval_duration"] = int((perf_counter() - eval_start_time) * 1e9)
+            final["total_duration"] = int((perf_counter() - start_time) * 1e9)
+            self._send_json({**final, **message("".join(words))})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, word in enumerate(words):
+            if i:
+                sleep(1 / server.tokens_per_second)
+            self._send_chunk(
+                {"model": body.get("model"), "done": False, **message(word)}
+            )
+        final["eval_duration"] = int((perf_counter() - eval_start_time) * 1e9)
+        final["total_duration"] = int((perf_counter() - start_time) * 1e9)
+        self._send_chunk({**final, **message("")})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
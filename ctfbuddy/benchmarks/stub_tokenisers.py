@@ -0,0 +1,62 @@
+"""
+Small byte-level BPE tokenisers trained on the fly, so benchmarks never download the real ones from Hugging Face.
+
+Token counts differ from the real models' but scale the same way with text length, which is what the context
+budgeting, batching and chunking code needs.
+"""
+
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import PreTrainedTokenizerFast
+
+from modules.tokenisers import MODEL_SPECS, NOMIC_EMBED_TEXT, TOKENISER_REGISTRY
+
+VOCAB_SIZE = 1000
+TRAINING_TEXT = [
+    "You are an AI language model specialising in cybersecurity and Capture The Flag (CTF) competitions.",
+    "RSA is a public-key cryptosystem. Factor the modulus, compute the private exponent and decrypt the flag.",
+    "What clues can you extract from the challenge description? Let's think step by step.",
+    "from Crypto.Util.number import long_to_bytes, bytes_to_long\nprint(long_to_bytes(pow(c, d, n)))",
+    "The XOR key is 0xdeadbeef and the buffer overflow offset is 72 bytes from the return address.",
+]
+CHAT_TEMPLATE = "{{ bos_token }}{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}"
+
+
+def make_stub_tokeniser() -> Tokenizer:
+    tokeniser = Tokenizer(models.BPE(unk_token="<unk>"))
+    tokeniser.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokeniser.decoder = decoders.ByteLevel()
+    tokeniser.train_from_iterator(
+        TRAINING_TEXT * 20,
+        trainers.BpeTrainer(
+            vocab_size=VOCAB_SIZE,
+            special_tokens=["<unk>", "<s>", "<|im_start|>", "<|im_end|>"],
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+            show_progress=False,
+        ),
+    )
+    tokeniser.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", tokeniser.token_to_id("<s>"))]
+    )
+    return tokeniser
+
+
+def make_stub_chat_tokeniser(tokeniser: Tokenizer) -> PreTrainedTokenizerFast:
+    chat_tokeniser = PreTrainedTokenizerFast(
+        tokenizer_object=tokeniser, bos_token="<s>", unk_token="<unk>"
+    )
+    chat_tokeniser.chat_template = CHAT_TEMPLATE
+    return chat_tokeniser
+
+
+def install_stub_tokenisers():
+    """
+    Loads a stub tokeniser for every supported chat model and for nomic-embed-text into the tokeniser registry.
+    """
+    tokeniser = make_stub_tokeniser()
+    chat_tokeniser = make_stub_chat_tokeniser(tokeniser)
+    TOKENISER_REGISTRY.set_max_loaded(
+        max(TOKENISER_REGISTRY.max_loaded, len(MODEL_SPECS) + 1)
+    )
+    for model_name in MODEL_SPECS:
+        TOKENISER_REGISTRY.get(model_name, lambda: chat_tokeniser)
+    TOKENISER_REGISTRY.get(NOMIC_EMBED_TEXT, lambda: tokeniser)
@@ -1,30 +1,44 @@
 #!/usr/bin/env python3
 
 import argparse
-import socket
 
 import gradio as gr
 
-from modules.autosolver_categories.crypto_autosolver import crypto_autosolver
+from modules.autosolver_categories.crypto_autosolver import (
+    CA_DEFAULT_RACE_PARALLELISM,
+    crypto_autosolver,
+    crypto_autosolver_race,
+)
 from modules.logging import log_warning
+from modules.metrics import REGISTRY, start_metrics_server
+import modules.ports as ports
 from modules.config import get_config, update_config
+from modules.startup_profile import format_import_profile, profile_imports
+from modules.tokenisers import SUPPORTED_MODELS, get_default_model
+from modules.warmup import get_warmup_manager
+
+GRADIO_CONCURRENCY_LIMIT = 64
+MODEL_STATUS_REFRESH_INTERVAL = 10  # seconds
+METRICS_REFRESH_INTERVAL = 10  # seconds
 
 
 def is_port_in_use(port):
-    server_name = get_config()["server_name"] or "127.0.0.1"
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex((server_name, port)) == 0
+    return ports.is_port_in_use(get_config().server_name or "127.0.0.1", port)
 
 
 def get_first_usable_port_from_7860():
-    server_name = get_config()["server_name"] or "127.0.0.1"
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        for port in range(7860, 65536):
-            if s.connect_ex((server_name, port)) != 0:
-                return port
-        log_warning("Configuration", "No available ports from port 7650")
+    port = ports.find_free_port(get_config().server_name or "127.0.0.1")
+    if port is None:
+        log_warning("Configuration", "No available ports found from port 7860")
         return "7860"
+    return port
+
+
+def gen_autosurfer_response(*args):
+    # LangChain, Chroma and the scraper are only imported once the Autosurfer is first used
+    from modules.study_chatbot.gen_response import gen_response
+
+    yield from gen_response(*args)
 
 
 def load_config_if_tab_is_selected(
@@ -39,12 +53,12 @@ def load_config_if_tab_is_selected(
     if evt_data.selected:
         prev_config = get_config()
         return (
-            prev_config["server_name"],
-            prev_config["server_port"],
-            prev_config["ollama_server_url"],
-            prev_config["google_api_key"],
-            prev_config["google_prog_search_engine_id"],
-            prev_config["huggingface_user_access_token"],
+            prev_config.server_name,
+            prev_config.server_port,
+            prev_config.ollama_server_url,
+            prev_config.google_api_key,
+            prev_config.google_prog_search_engine_id,
+            prev_config.huggingface_user_access_token,
         )
     return (
         server_name,
@@ -79,7 +93,7 @@ def config_server_port_update(value):
         (not stripped_value.isdigit())
         or stripped_value_int < 7860
         or stripped_value_int > 65536
-    ) or (get_config()["server_port"] != value and is_port_in_use(stripped_value_int)):
+    ) or (get_config().server_port != value and is_port_in_use(stripped_value_int)):
         return str(get_first_usable_port_from_7860())
 
     return stripped_value
@@ -146,11 +160,42 @@ parser.add_argument(
     action="store_true",
     help="Allows user to write to configuration file (DO NOT USE IF YOU HOST CTFBUDDY)",
 )
+parser.add_argument(
+    "--compact-index",
+    action="store_true",
+    help="Prunes expired chunks from the study chatbot's vector index, compacts it and exits",
+)
+parser.add_argument(
+    "--metrics-port",
+    type=int,
+    help="Serves Prometheus metrics at http://[server name]:[port]/metrics",
+)
+parser.add_argument(
+    "--profile-startup",
+    action="store_true",
+    help="Prints how long each module takes to import at startup (as with python -X importtime) and exits",
+)
+parser.add_argument(
+    "--no-warmup",
+    action="store_true",
+    help="Does not preload models or keep them loaded in the background",
+)
 
 if __name__ == "__main__":
     args = parser.parse_args()
     config_writable = args.config_writable
 
+    if args.profile_startup:
+        print(format_import_profile(profile_imports()))
+        raise SystemExit
+
+    if args.compact_index:
+        from modules.vector_index import get_vector_index
+
+        no_pruned, no_kept = get_vector_index().compact()
+        print(f"Pruned {no_pruned} expired chunks, kept {no_kept}")
+        raise SystemExit
+
     with gr.Blocks(
         theme=gr.themes.Default(primary_hue="red"),
         analytics_enabled=False,
@@ -167,9 +212,8 @@ if __name__ == "__main__":
             ca_flag_format = gr.Textbox(label="Flag format:")
             ca_chall_desc = gr.Textbox(label="Challenge description:")
             ca_chall_filepaths = gr.File(
-                label="Challenge files (text):",
+                label="Challenge files (binary files are shown as a hex preview):",
                 file_count="multiple",
-                file_types=["text"],
             )
 
             with gr.Row():
@@ -184,17 +228,86 @@ if __name__ == "__main__":
                 )
                 ca_run_btn = gr.Button(value="Solve!")
 
-            ca_autosolver_model = gr.Dropdown(
-                ["llama3", "openchat", "mistral", "phi3"],
-                label="Model:",
-                value="mistral",
-            )
+            with gr.Row():
+                ca_autosolver_model = gr.Dropdown(
+                    SUPPORTED_MODELS,
+                    label="Model:",
+                    value=get_default_model(),
+                )
+                ca_bypass_cache = gr.Checkbox(
+                    label="Bypass cache (regenerate every step)", value=False
+                )
 
             with gr.Column():
                 ca_used_token_info = gr.Textbox(
                     label="[Used tokens]/[Context window] ([Used token percentage])"
                 )
                 ca_chatbox = gr.Chatbot(label="Output")
+                ca_prefill_report = gr.Markdown()
+
+            with gr.Accordion("Race models", open=False):
+                with gr.Row():
+                    ca_race_models = gr.CheckboxGroup(
+                        SUPPORTED_MODELS,
+                        label="Models to race:",
+                        value=SUPPORTED_MODELS,
+                    )
+                    ca_race_max_parallel = gr.Slider(
+                        minimum=1,
+                        maximum=len(SUPPORTED_MODELS),
+                        step=1,
+                        value=CA_DEFAULT_RACE_PARALLELISM,
+                        label="Parallel requests (should match OLLAMA_NUM_PARALLEL):",
+                    )
+                ca_race_btn = gr.Button(value="Race!")
+                ca_race_results = gr.Markdown()
+                with gr.Row():
+                    ca_race_chatboxes = [
+                        gr.Chatbot(label=f"Output ({model})")
+                        for model in SUPPORTED_MODELS
+                    ]
+
+        with gr.Tab("Autosurfer"):
+            as_chatbox = gr.Chatbot(label="Chat")
+            as_prompt = gr.Textbox(label="Prompt:")
+            with gr.Row():
+                as_model = gr.Dropdown(
+                    SUPPORTED_MODELS,
+                    label="Model:",
+                    value=get_default_model(),
+                )
+                as_online_mode = gr.Checkbox(label="Search the web", value=True)
+                as_moderator_on = gr.Checkbox(label="Moderate", value=True)
+            with gr.Row():
+                as_clear_btn = gr.ClearButton(
+                    value="Clear chat", components=[as_prompt, as_chatbox]
+                )
+                as_send_btn = gr.Button(value="Send")
+            with gr.Accordion("Timings", open=False):
+                as_timings = gr.Markdown()
+
+        with gr.Tab("Models"):
+            # Filled in by a load event rather than while building the UI, which would wait on every backend
+            models_status = gr.Markdown("Checking models...")
+            models_refresh_btn = gr.Button(value="Refresh")
+            models_refresh_btn.click(
+                fn=get_warmup_manager().status_markdown,
+                inputs=None,
+                outputs=[models_status],
+            )
+
+        with gr.Tab("Metrics"):
+            metrics_summary = gr.Markdown(
+                REGISTRY.summary_markdown, every=METRICS_REFRESH_INTERVAL
+            )
+            with gr.Accordion("Prometheus text", open=False):
+                metrics_text = gr.Code(REGISTRY.render_prometheus, language=None)
+            metrics_refresh_btn = gr.Button(value="Refresh")
+            metrics_refresh_btn.click(
+                fn=lambda: (REGISTRY.summary_markdown(), REGISTRY.render_prometheus()),
+                inputs=None,
+                outputs=[metrics_summary, metrics_text],
+            )
 
         if config_writable:
             with gr.Tab("Configuration") as config_tab:
@@ -247,12 +360,39 @@ if __name__ == "__main__":
                 ca_chall_desc,
                 ca_chall_filepaths,
                 ca_chatbox,
+                ca_bypass_cache,
             ],
-            outputs=[ca_chatbox, ca_used_token_info],
+            outputs=[ca_chatbox, ca_used_token_info, ca_prefill_report],
+        )
+        ca_race_btn.click(
+            fn=crypto_autosolver_race,
+            inputs=[
+                ca_race_models,
+                ca_race_max_parallel,
+                ca_chall_name,
+                ca_flag_format,
+                ca_chall_desc,
+                ca_chall_filepaths,
+                ca_bypass_cache,
+            ],
+            outputs=[*ca_race_chatboxes, ca_race_results],
         )
 
+        for as_trigger in (as_prompt.submit, as_send_btn.click):
+            as_trigger(
+                fn=gen_autosurfer_response,
+                inputs=[
+                    as_model,
+                    as_online_mode,
+                    as_moderator_on,
+                    as_prompt,
+                    as_chatbox,
+                ],
+                outputs=[as_prompt, as_chatbox, as_timings],
+            )
+
         if config_writable:
-            config_server_name.update(
+            config_server_name.blur(
                 fn=config_server_name_update,
                 inputs=[config_server_name],
                 outputs=[config_server_name],
@@ -262,22 +402,22 @@ if __name__ == "__main__":
                 inputs=[config_server_port],
                 outputs=[config_server_port],
             )
-            config_ollama_server_url.update(
+            config_ollama_server_url.blur(
                 fn=config_ollama_server_url_update,
                 inputs=[config_ollama_server_url],
                 outputs=[config_ollama_server_url],
             )
-            config_google_api_key.update(
+            config_google_api_key.blur(
                 fn=config_standard_update,
                 inputs=[config_google_api_key],
                 outputs=[config_google_api_key],
             )
-            config_google_prog_search_engine_id.update(
+            config_google_prog_search_engine_id.blur(
                 fn=config_standard_update,
                 inputs=[config_google_prog_search_engine_id],
                 outputs=[config_google_prog_search_engine_id],
             )
-            config_huggingface_user_access_token.update(
+            config_huggingface_user_access_token.blur(
                 fn=config_standard_update,
                 inputs=[config_huggingface_user_access_token],
                 outputs=[config_huggingface_user_access_token],
@@ -295,10 +435,22 @@ if __name__ == "__main__":
                 outputs=None,
             )
 
+        ctfbuddy.load(
+            fn=get_warmup_manager().status_markdown,
+            inputs=None,
+            outputs=[models_status],
+            every=MODEL_STATUS_REFRESH_INTERVAL,
+        )
+
+    if not args.no_warmup:
+        get_warmup_manager().start()
+    if args.metrics_port:
+        start_metrics_server(get_config().server_name or "127.0.0.1", args.metrics_port)
+
     print("Launching...")
-    ctfbuddy.queue()
+    # Generations are capped by the Ollama request scheduler, so Gradio itself can run many sessions at once.
+    ctfbuddy.queue(default_concurrency_limit=GRADIO_CONCURRENCY_LIMIT)
     ctfbuddy.launch(
-        server_name=(get_config()["server_name"] or "127.0.0.1"),
-        server_port=(None if not (spi := get_config()["server_port"]) else int(spi)),
- 
-Running on local URL:  http://skibidi-   )
+        server_name=(get_config().server_name or "127.0.0.1"),
+        server_port=(None if not (spi := get_config().server_port) else int(spi)),
+    )
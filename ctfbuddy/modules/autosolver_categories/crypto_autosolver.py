@@ -1,12 +1,19 @@
+import asyncio
+from os import path
 from time import time
 
-from gradio import Error as GradioError
+from gradio import Error as GradioError, Request
 
 import modules.logging as log
-from modules.ollama_chat import OllamaChat
+from modules.ollama_chat import AsyncOllamaChat
 from modules.config import gradio_assert_config_exists
 from modules.host import get_host
+from modules.response_cache import get_response_cache
+from modules.file_ingest import ingest_files
+from modules.tokenisers import SUPPORTED_MODELS, get_tokeniser_and_context_window
+from modules.warmup import get_warmup_manager
 
+# Static, so Ollama can reuse the cached prompt prefix across steps and across challenges
 CA_SYSTEM_PROMPT = """You are an AI language model specializing in cybersecurity and Capture The Flag (CTF) competitions. You assist users in solving challenges by providing expert guidance and step-by-step solutions. You are knowledgeable in the Cryptography CTF category, knowing Python libraries such as PyCryptodome (Crypto) and math, and tools such as sagemath and FactorDB.
 ## Guidelines:
 1. **Understand the Challenge**:
@@ -23,9 +30,11 @@ CA_SYSTEM_PROMPT = """You are an AI language model specializing in cybersecurity
    - Explain the rationale behind steps and methods.
 5. **Stay Up-to-Date**:
    - Use the latest tools, techniques, and best practices in cybersecurity and CTFs.
-   - Incorporate current trends and advancements.
-## Challenge information:
-You will assist the user with the following challenge (remember to pay attention to the challenge files, if any) (do NOT infer unnecessary things about the flag format; only use the flag format when necessary during method suggestion or solve script generation):
+   - Incorporate current trends and advancements."""
+
+# Sent ahead of the first step, after the static system prompt
+CA_CHALLENGE_PROMPT = """## Challenge information:
+You will assist me with the following challenge (remember to pay attention to the challenge files, if any) (do NOT infer unnecessary things about the flag format; only use the flag format when necessary during method suggestion or solve script generation):
 - Challenge name: <<chall_name>>
 - Flag format: <<flag_format>>
 - Challenge description: <<chall_desc>>
@@ -38,68 +47,344 @@ CA_STARTING_PROMPTS = [
     "Based on the given challenge, extracted clues possible techniques and analysed vulnerabilities, what is a possible method that can be used to solve the given challenge? Let's think step by step.",
     "Based on the given challenge, extracted clues, possible techniques, analysed vulnerabilities and suggested method, explain how you would write a script to solve the given challenge, then give me a possible solve script for the given challenge in Python. ONLY provide the explanation and given solve script in that order, and nothing else",
 ]
+CA_EXPECTED_TOKENS_PER_STEP = 1152  # prompt plus a 1024-token reply
+CA_DEFAULT_RACE_PARALLELISM = 2
+CA_FILE_TOKEN_BUDGET_FRACTION = 0.25  # of the model's context window, per file
+CA_TOTAL_FILE_TOKEN_BUDGET_FRACTION = 0.5  # of the model's context window, all files
 
 
-def send_message_to_crypto_autosolver(ollama_chat, history, message):
+async def send_message_to_crypto_autosolver(
+    ollama_chat, history, message, timings=None, notify=True, challenge_prompt=None
+):
     conv_no_tokens = f"{ollama_chat.conv_no_tokens}/{ollama_chat.ctx_window} ({round((ollama_chat.conv_no_tokens/ollama_chat.ctx_window)*100, 2)}%)"
     history.append([message, None])
-    ollama_chat.append_message("user", message)
+    ollama_chat.append_message(
+        "user", f"{challenge_prompt}\n\n{message}" if challenge_prompt else message
+    )
     yield history, conv_no_tokens
 
-    start_time = time()
-    res = ollama_chat.invoke_and_append_generated_message(stream=True)
-    first_token_recvd = False
-    for res_str in res:
-        if not first_token_recvd:
-            log.log_info(
-                "Method Suggestor",
-                f"Received first token in {round(time()-start_time, 2)}s",
-            )
-            first_token_recvd = True
-        history[-1][1] = res_str
-        yield history, conv_no_tokens
+    try:
+        async for position in ollama_chat.queue_for_generation():
+            stats = ollama_chat.scheduler.stats()
+            yield history, f"Queued for {ollama_chat.model_name}: position {position} of {stats['queue_depth']} (average wait {round(stats['mean_wait'], 1)}s)"
+
+        start_time = time()
+        res = ollama_chat.invoke_and_append_generated_message(stream=True)
+        first_token_recvd = False
+        async for res_str in res:
+            if not first_token_recvd:
+                log.log_info(
+                    "Method Suggestor",
+                    f"Received first token in {round(time()-start_time, 2)}s",
+                    debug_only=True,
+                )
+                report = ollama_chat.last_compaction_report
+                if report.compacted or not report.fits:
+                    log.log_warning(
+                        "Method Suggestor",
+                        str(report),
+                        debug_only=not notify,
+                    )
+                if timings is not None:
+                    timings.setdefault("ttft", time() - start_time)
+                first_token_recvd = True
+            history[-1][1] = res_str
+            yield history, conv_no_tokens
+    finally:
+        ollama_chat.release_slot()
     end_time = time()
     log.log_info(
-        "Method Suggestor", f"Generated response in {round(end_time-start_time, 2)}s"
+        "Method Suggestor",
+        f"Generated response in {round(end_time-start_time, 2)}s",
+        debug_only=True,
     )
+    if ollama_chat.last_response_cached:
+        log.log_info("Method Suggestor", "Replayed cached response", debug_only=True)
+    elif ollama_chat.last_call_metrics:
+        log.log_info(
+            "Method Suggestor", str(ollama_chat.last_call_metrics), debug_only=True
+        )
     conv_no_tokens = f"{ollama_chat.conv_no_tokens}/{ollama_chat.ctx_window} ({round((ollama_chat.conv_no_tokens/ollama_chat.ctx_window)*100, 2)}%)"
     yield history, conv_no_tokens
 
 
-def crypto_autosolver(
+def assert_crypto_autosolver_inputs(chall_name, flag_format, chall_desc):
+    gradio_assert_config_exists()
+    if not (chall_name and flag_format and chall_desc):
+        raise GradioError(
+            'Please provide "Challenge name", "Flag format", and "Challenge description"'
+        )
+
+
+def make_crypto_autosolver_chat(
+    client,
     autosolver_model,
     chall_name,
     flag_format,
     chall_desc,
     chall_filepaths,
-    chat_history,
+    bypass_cache=False,
+    notify=True,
+    session_id=None,
 ):
-    chat_history = []
-    gradio_assert_config_exists()
-    if not (chall_name and flag_format and chall_desc):
-        raise GradioError(
-            'Please provide "Challenge name", "Flag format", and "Challenge description"'
-        )
+    """
+    Returns:
+        tuple: The chat, holding only the static system prompt, and the challenge prompt to send with the first step.
+    """
+    assert_crypto_autosolver_inputs(chall_name, flag_format, chall_desc)
 
-    system_prompt = (
-        CA_SYSTEM_PROMPT.replace("<<chall_name>>", chall_name)
+    prompt_parts = [
+        CA_CHALLENGE_PROMPT.replace("<<chall_name>>", chall_name)
         .replace("<<flag_format>>", flag_format)
         .replace("<<chall_desc>>", chall_desc)
-    )
+    ]
     if chall_filepaths:
-        for fp in chall_filepaths:
-            with open(fp, "r") as f:
-                system_prompt += f"\n###<{fp}>\n{f.read()}"
+        tokeniser, ctx_window, _, _ = get_tokeniser_and_context_window(autosolver_model)
+        for ingested_file in ingest_files(
+            chall_filepaths,
+            tokeniser,
+            int(ctx_window * CA_FILE_TOKEN_BUDGET_FRACTION),
+            int(ctx_window * CA_TOTAL_FILE_TOKEN_BUDGET_FRACTION),
+        ):
+            prompt_parts.append(ingested_file.render())
+            if ingested_file.omitted or ingested_file.truncated:
+                log.log_warning(
+                    "Method Suggestor",
+                    f"{'Left out' if ingested_file.omitted else 'Truncated'} {path.basename(ingested_file.filepath)} to fit the challenge file token budget",
+                    debug_only=not notify,
+                )
     else:
-        system_prompt += " Nil"
+        prompt_parts.append(" Nil")
+    challenge_prompt = "".join(prompt_parts)
+
+    ollama_chat = AsyncOllamaChat(
+        client,
+        autosolver_model,
+        CA_SYSTEM_PROMPT,
+        response_cache=get_response_cache(),
+        bypass_cache=bypass_cache,
+        session_id=session_id,
+        warmup_manager=get_warmup_manager(),
+    )
+    # The challenge prompt must survive compaction like the system prompt
+    ollama_chat.budget_manager.pin_first_user_message = True
+    ollama_chat.num_ctx_sizer.reserve_for_session(
+        ollama_chat.conv_no_tokens
+        + ollama_chat.count_message_tokens("user", challenge_prompt)
+        + len(CA_STARTING_PROMPTS) * CA_EXPECTED_TOKENS_PER_STEP
+    )
+    return ollama_chat, challenge_prompt
+
 
-    ollama_chat = OllamaChat(get_host(), autosolver_model, system_prompt)
+def format_prefill_report(step_metrics):
+    rows = [
+        "| Step | Prompt tokens | Prefilled | Reused from KV cache | Prefill time |",
+        "| --- | --- | --- | --- | --- |",
+    ]
+    for step, metrics in enumerate(step_metrics, start=1):
+        if metrics is None:
+            rows.append(f"| {step} | - | - | - | Replayed from response cache |")
+        elif metrics.prompt_eval_count is None:
+            rows.append(f"| {step} | {metrics.prompt_tokens} | - | - | - |")
+        else:
+            rows.append(
+                f"| {step} | {metrics.prompt_tokens} | {metrics.prompt_eval_count} | {max(metrics.prompt_tokens - metrics.prompt_eval_count, 0)} | {metrics.prompt_eval_duration or 0:.2f}s |"
+            )
+    return "\n".join(rows)
+
+
+async def crypto_autosolver(
+    autosolver_model,
+    chall_name,
+    flag_format,
+    chall_desc,
+    chall_filepaths,
+    chat_history,
+    bypass_cache=False,
+    request: Request = None,
+):
+    # Before get_host, which cannot build a router without a config
+    assert_crypto_autosolver_inputs(chall_name, flag_format, chall_desc)
+    chat_history = []
+    ollama_chat, challenge_prompt = await asyncio.to_thread(
+        make_crypto_autosolver_chat,
+        get_host(),
+        autosolver_model,
+        chall_name,
+        flag_format,
+        chall_desc,
+        chall_filepaths,
+        bypass_cache,
+        session_id=request.session_hash if request else None,
+    )
 
-    for prompt in CA_STARTING_PROMPTS:
-        for history, conv_token_frac in send_message_to_crypto_autosolver(
-            ollama_chat, chat_history, prompt
+    step_metrics = []
+    for i, prompt in enumerate(CA_STARTING_PROMPTS):
+        async for history, conv_token_frac in send_message_to_crypto_autosolver(
+            ollama_chat,
+            chat_history,
+            prompt,
+            challenge_prompt=challenge_prompt if i == 0 else None,
         ):
             chat_history = history
-            yield history, conv_token_frac
+            yield history, conv_token_frac, format_prefill_report(step_metrics)
+        step_metrics.append(
+            None if ollama_chat.last_response_cached else ollama_chat.last_call_metrics
+        )
+
+    yield history, conv_token_frac, format_prefill_report(step_metrics)
+
+
+async def _race_worker(
+    semaphore,
+    max_parallel,
+    race_models,
+    model,
+    updates,
+    race_start_time,
+    chall_name,
+    flag_format,
+    chall_desc,
+    chall_filepaths,
+    bypass_cache,
+    session_id,
+):
+    async with semaphore:
+        timings = {"queued": time() - race_start_time}
+        start_time = time()
+        chat_history = []
+        ollama_chat = None
+        try:
+            ollama_chat, challenge_prompt = await asyncio.to_thread(
+                make_crypto_autosolver_chat,
+                get_host(),
+                model,
+                chall_name,
+                flag_format,
+                chall_desc,
+                chall_filepaths,
+                bypass_cache,
+                notify=False,
+                session_id=session_id,
+            )
+            if ollama_chat.scheduler:
+                # Otherwise the scheduler would only let the raced models take turns
+                ollama_chat.scheduler.reserve_for_session(
+                    session_id, max_parallel, len(race_models)
+                )
+            for i, prompt in enumerate(CA_STARTING_PROMPTS):
+                async for history, _ in send_message_to_crypto_autosolver(
+                    ollama_chat,
+                    chat_history,
+                    prompt,
+                    timings,
+                    notify=False,
+                    challenge_prompt=challenge_prompt if i == 0 else None,
+                ):
+                    await updates.put(
+                        (model, [list(pair) for pair in history], dict(timings))
+                    )
+        except Exception as e:
+            timings["error"] = str(e)
+        finally:
+            if ollama_chat and ollama_chat.scheduler:
+                ollama_chat.scheduler.end_reservation(session_id)
+        timings["total"] = time() - start_time
+        await updates.put((model, None, timings))
+
+
+def format_race_results(race_models, race_timings):
+    rows = [
+        "| Model | Status | Queued | Time to first token | Total time |",
+        "| --- | --- | --- | --- | --- |",
+    ]
+    finished = sorted(
+        (model for model in race_models if "total" in race_timings[model]),
+        key=lambda model: race_timings[model]["total"],
+    )
+    fmt = lambda seconds: "-" if seconds is None else f"{seconds:.2f}s"
+    for model in race_models:
+        timings = race_timings[model]
+        if "error" in timings:
+            status = f"Failed: {timings['error']}"
+        elif "total" in timings:
+            status = f"Finished #{finished.index(model) + 1}"
+        elif "ttft" in timings:
+            status = "Generating"
+        else:
+            status = "Waiting"
+        rows.append(
+            f"| {model} | {status} | {fmt(timings.get('queued'))} | {fmt(timings.get('ttft'))} | {fmt(timings.get('total'))} |"
+        )
+    return "\n".join(rows)
+
+
+async def crypto_autosolver_race(
+    race_models,
+    max_parallel,
+    chall_name,
+    flag_format,
+    chall_desc,
+    chall_filepaths,
+    bypass_cache=False,
+    request: Request = None,
+):
+    """
+    Runs the crypto autosolver on several models at once and streams each model's chat into its own panel.
+
+    At most `max_parallel` models run at the same time, which should match Ollama's OLLAMA_NUM_PARALLEL. The raced
+    models may all be loaded at once, whatever the scheduler's usual limits.
 
-    yield history, conv_token_frac
+    Yields:
+        tuple: One chat history per model in SUPPORTED_MODELS, followed by a Markdown table of per-model timings.
+    """
+    assert_crypto_autosolver_inputs(chall_name, flag_format, chall_desc)
+    if not race_models:
+        raise GradioError("Please select at least one model to race")
+
+    panels = {model: [] for model in SUPPORTED_MODELS}
+    race_timings = {model: {} for model in race_models}
+    updates = asyncio.Queue()
+    max_parallel = max(int(max_parallel), 1)
+    semaphore = asyncio.Semaphore(max_parallel)
+    race_start_time = time()
+
+    workers = [
+        asyncio.create_task(
+            _race_worker(
+                semaphore,
+                max_parallel,
+                race_models,
+                model,
+                updates,
+                race_start_time,
+                chall_name,
+                flag_format,
+                chall_desc,
+                chall_filepaths,
+                bypass_cache,
+                f"{request.session_hash if request else id(updates)}:{model}",
+            )
+        )
+        for model in race_models
+    ]
+
+    try:
+        no_running = len(race_models)
+        while no_running:
+            model, history, timings = await updates.get()
+            race_timings[model] = timings
+            if history is not None:
+                panels[model] = history
+            else:
+                no_running -= 1
+            yield *panels.values(), format_race_results(race_models, race_timings)
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+    log.log_info(
+        "Method Suggestor",
+        f"Finished racing {len(race_models)} models in {round(time()-race_start_time, 2)}s",
+        debug_only=True,
+    )
@@ -0,0 +1,153 @@
+import math
+import re
+import sqlite3
+from collections import Counter
+from os import makedirs, path
+from threading import Lock
+
+from modules.config import CACHE_DIR
+
+BM25_INDEX_PATH = path.join(CACHE_DIR, "bm25.sqlite3")
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Runs of word characters joined by dots or hyphens, so CVE-2021-44228, libc.so.6 and aes-256-cbc stay whole
+TOKEN_PATTERN = re.compile(r"\w+(?:[.\-]\w+)*")
+TOKEN_SEPARATORS = re.compile(r"[.\-]")
+
+
+def tokenise(text: str) -> list[str]:
+    """
+    Lowercases and splits text into terms. Compound terms are kept whole and also indexed by their parts.
+    """
+    terms = []
+    for term in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(term)
+        if TOKEN_SEPARATORS.search(term):
+            terms.extend(part for part in TOKEN_SEPARATORS.split(term) if part)
+    return terms
+
+
+class BM25Index:
+    """
+    Persistent SQLite inverted index that ranks chunks by Okapi BM25.
+
+    It sits next to the vector index and shares its chunk IDs. Exact tokens such as CVE IDs, function names and
+    magic constants rarely move an embedding much, but they are exactly what this index matches on.
+    """
+
+    def __init__(self, db_path=BM25_INDEX_PATH, k1=BM25_K1, b=BM25_B):
+        self.k1 = k1
+        self.b = b
+        self._lock = Lock()
+
+        makedirs(path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(
+            db_path, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs (id TEXT PRIMARY KEY, length INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                id TEXT NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (term, id)
+            ) WITHOUT ROWID"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def add(self, ids: list[str], texts: list[str]) -> int:
+        """
+        Indexes the chunks whose IDs are not in the index yet.
+
+        Returns:
+            int: How many chunks were new.
+        """
+        with self._lock:
+            existing = set()
+            for i in range(0, len(ids), 512):
+                batch = ids[i : i + 512]
+                existing.update(
+                    row[0]
+                    for row in self._conn.execute(
+                        f"SELECT id FROM docs WHERE id IN ({','.join('?' * len(batch))})",
+                        batch,
+                    )
+                )
+
+            new_docs = {id: text for id, text in zip(ids, texts) if id not in existing}
+            if not new_docs:
+                return 0
+            self._conn.execute("BEGIN")
+            for id, text in new_docs.items():
+                terms = tokenise(text)
+                self._conn.execute("INSERT INTO docs VALUES (?, ?)", (id, len(terms)))
+                self._conn.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    ((term, id, tf) for term, tf in Counter(terms).items()),
+                )
+            self._conn.execute("COMMIT")
+        return len(new_docs)
+
+    def delete(self, ids: list[str]):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "DELETE FROM docs WHERE id = ?", ((id,) for id in ids)
+            )
+            self._conn.executemany(
+                "DELETE FROM postings WHERE id = ?", ((id,) for id in ids)
+            )
+            self._conn.execute("COMMIT")
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM docs")
+            self._conn.execute("DELETE FROM postings")
+
+    def vacuum(self):
+        with self._lock:
+            self._conn.execute("VACUUM")
+
+    def search(self, query: str, k: int) -> list[tuple[str, float]]:
+        """
+        Returns:
+            list: Up to `k` (chunk ID, BM25 score) pairs, best first.
+        """
+        terms = list(set(tokenise(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            no_docs, total_length = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs"
+            ).fetchone()
+            if not no_docs:
+                return []
+            rows = self._conn.execute(
+                f"""SELECT p.term, p.id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.id
+                WHERE p.term IN ({','.join('?' * len(terms))})""",
+                terms,
+            ).fetchall()
+
+        doc_freqs = Counter(term for term, _, _, _ in rows)
+        avg_length = total_length / no_docs
+        scores = Counter()
+        for term, id, tf, length in rows:
+            idf = math.log(
+                1 + (no_docs - doc_freqs[term] + 0.5) / (doc_freqs[term] + 0.5)
+            )
+            scores[id] += (
+                idf
+                * tf
+                * (self.k1 + 1)
+                / (tf + self.k1 * (1 - self.b + self.b * length / avg_length))
+            )
+        return scores.most_common(k)
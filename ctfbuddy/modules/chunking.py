@@ -0,0 +1,71 @@
+from typing import Iterable, Iterator
+
+from langchain_core.documents import Document
+from semantic_text_splitter import TextSplitter
+
+from modules.tokenisers import get_nomic_embed_text_tokeniser
+
+DEFAULT_CHUNK_SIZE = 512  # tokens
+DEFAULT_CHUNK_OVERLAP = 64  # tokens
+
+
+class Chunker:
+    """
+    Splits documents into chunks of at most `chunk_size` nomic-embed-text tokens along their structure.
+
+    `semantic-text-splitter` breaks text at the largest semantic units (paragraphs, then sentences, then words)
+    that fit in `chunk_size - chunk_overlap` tokens. Each chunk after the first is then extended backwards with
+    the last `chunk_overlap` tokens of the original text before it, so neighbouring chunks share context.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+        tokeniser=None,
+    ):
+        if not 0 <= chunk_overlap < chunk_size:
+            raise ValueError(
+                "Chunk overlap must be at least 0 and less than chunk size"
+            )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.tokeniser = tokeniser or get_nomic_embed_text_tokeniser()
+        self.splitter = TextSplitter.from_huggingface_tokenizer(
+            self.tokeniser, chunk_size - chunk_overlap
+        )
+
+    def _overlap_start(self, text: str, end: int) -> int:
+        # Start of the last `chunk_overlap` tokens of the text before `end`
+        head_start = max(end - self.chunk_overlap * 16, 0)
+        offsets = self.tokeniser.encode(
+            text[head_start:end], add_special_tokens=False
+        ).offsets
+        if len(offsets) < self.chunk_overlap:
+            return head_start
+        start = head_start + offsets[-self.chunk_overlap][0]
+
+        # Do not start the overlap halfway through a word
+        if start and not text[start - 1].isspace():
+            for i in range(start, end):
+                if text[i].isspace():
+                    return i + 1
+        return start
+
+    def split_text(self, text: str) -> list[str]:
+        chunks = []
+        for offset, chunk in self.splitter.chunk_indices(text):
+            if chunks and self.chunk_overlap:
+                chunk = text[self._overlap_start(text, offset) : offset + len(chunk)]
+            chunks.append(chunk)
+        return chunks
+
+    def split_documents(self, docs: Iterable[Document]) -> Iterator[Document]:
+        """
+        Yields the chunks of each document as soon as it arrives, with the document's metadata and its chunk number.
+        """
+        for doc in docs:
+            for i, chunk in enumerate(self.split_text(doc.page_content)):
+                yield Document(
+                    page_content=chunk, metadata={**doc.metadata, "chunk": i}
+                )
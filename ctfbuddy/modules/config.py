@@ -1,55 +1,200 @@
-from os import path
+from dataclasses import dataclass
+from os import environ, path, replace, stat
+from threading import Lock
+from typing import Callable, Optional
+from uuid import uuid4
 import configparser
 
 from gradio import Error as GradioError
 
+import modules.logging as log
+
 CONFIG_PATH = config_path = path.join(
     path.dirname(path.dirname(path.dirname(__file__))), "config.ini"
 )
+CACHE_DIR = path.join(path.dirname(path.dirname(path.dirname(__file__))), ".cache")
+BACKEND_SECTION_PREFIX = "Backend "
 
 
-def get_config():
-    if not path.exists(CONFIG_PATH):
-        return {
-            "server_name": "",
-            "server_port": "",
-            "ollama_server_url": "",
-            "google_api_key": "",
-            "google_prog_search_engine_id": "",
-            "huggingface_user_access_token": "",
-        }
-    config = configparser.ConfigParser()
-    config.read(CONFIG_PATH)
+@dataclass(frozen=True)
+class BackendConfig:
+    name: str
+    url: str
+    weight: float = 1.0
+    models: Optional[frozenset[str]] = None  # None means every model
 
-    server_name = config.get("Server", "server_name")
-    server_port = config.get("Server", "server_port")
-    ollama_server_url = config.get("Server", "ollama_server_url")
 
-    google_api_key = config.get("Keys_and_IDs", "google_api_key")
-    google_prog_search_engine_id = config.get(
-        "Keys_and_IDs", "google_prog_search_engine_id"
+@dataclass(frozen=True)
+class Config:
+    server_name: str = ""
+    server_port: str = ""
+    ollama_server_url: str = ""
+    google_api_key: str = ""
+    google_prog_search_engine_id: str = ""
+    huggingface_user_access_token: str = ""
+    ollama_backends: tuple[BackendConfig, ...] = ()
+    ollama_num_parallel: Optional[int] = None  # None means the scheduler's default
+    ollama_max_loaded_models: Optional[int] = None
+    default_model: str = ""
+    max_loaded_tokenisers: Optional[int] = (
+        None  # None means the tokeniser registry's default
     )
-    huggingface_user_access_token = config.get(
-        "Keys_and_IDs", "huggingface_user_access_token"
+
+
+def _env_int(name):
+    value = environ.get(name, "").strip()
+    return int(value) if value.isdigit() and int(value) > 0 else None
+
+
+def parse_config(config: configparser.ConfigParser) -> Config:
+    ollama_server_url = config.get("Server", "ollama_server_url", fallback="")
+    return Config(
+        server_name=config.get("Server", "server_name", fallback=""),
+        server_port=config.get("Server", "server_port", fallback=""),
+        ollama_server_url=ollama_server_url,
+        google_api_key=config.get("Keys_and_IDs", "google_api_key", fallback=""),
+        google_prog_search_engine_id=config.get(
+            "Keys_and_IDs", "google_prog_search_engine_id", fallback=""
+        ),
+        huggingface_user_access_token=config.get(
+            "Keys_and_IDs", "huggingface_user_access_token", fallback=""
+        ),
+        ollama_backends=get_ollama_backends(config, ollama_server_url),
+        # Same meaning as the Ollama server's environment variables, which are used when the config leaves them out
+        ollama_num_parallel=config.getint(
+            "Server", "ollama_num_parallel", fallback=_env_int("OLLAMA_NUM_PARALLEL")
+        ),
+        ollama_max_loaded_models=config.getint(
+            "Server",
+            "ollama_max_loaded_models",
+            fallback=_env_int("OLLAMA_MAX_LOADED_MODELS"),
+        ),
+        default_model=config.get("Server", "default_model", fallback=""),
+        max_loaded_tokenisers=config.getint(
+            "Server", "max_loaded_tokenisers", fallback=None
+        ),
     )
 
-    return {
-        "server_name": server_name,
-        "server_port": server_port,
-        "ollama_server_url": ollama_server_url,
-        "google_api_key": google_api_key,
-        "google_prog_search_engine_id": google_prog_search_engine_id,
-        "huggingface_user_access_token": huggingface_user_access_token,
-    }
+
+class ConfigStore:
+    """
+    The parsed contents of config.ini, kept in memory.
+
+    `get` only stats the file and re-reads it when its modification time, size or inode has changed; if the new
+    contents cannot be parsed, the last good config is kept. Subscribers are called with the old and new `Config`
+    after every change, on the thread that noticed it.
+    """
+
+    def __init__(self, config_path=CONFIG_PATH):
+        self.path = config_path
+        self._config = Config()
+        self._signature = None
+        self._subscribers = []
+        self._lock = Lock()
+
+    def _stat_signature(self):
+        try:
+            stat_result = stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (
+            self.path,
+            stat_result.st_mtime_ns,
+            stat_result.st_size,
+            stat_result.st_ino,
+        )
+
+    def get(self) -> Config:
+        signature = self._stat_signature()
+        if signature == self._signature:
+            return self._config
+
+        with self._lock:
+            if signature == self._signature:
+                return self._config
+            old_config = self._config
+            if signature is None:
+                new_config = Config()
+            else:
+                parser = configparser.ConfigParser()
+                try:
+                    parser.read(self.path)
+                    new_config = parse_config(parser)
+                except (configparser.Error, ValueError) as e:
+                    log.log_warning(
+                        "Configuration",
+                        f"Keeping the previous configuration, {self.path} could not be read: {e}",
+                        debug_only=True,
+                    )
+                    new_config = old_config
+            self._config = new_config
+            self._signature = signature
+            subscribers = list(self._subscribers)
+
+        if new_config != old_config:
+            for callback in subscribers:
+                callback(old_config, new_config)
+        return new_config
+
+    def subscribe(self, callback: Callable[[Config, Config], None]):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.remove(callback)
+
+
+CONFIG_STORE = ConfigStore()
+
+
+def get_config() -> Config:
+    return CONFIG_STORE.get()
+
+
+def get_ollama_backends(config, ollama_server_url):
+    """
+    Reads the pool of Ollama backends from `[Backend <name>]` sections, e.g.
+
+        [Backend gpu-box]
+        url = http://10.0.0.2:11434
+        weight = 2
+        models = llama3, mistral
+
+    `weight` defaults to 1 and leaving out `models` means the backend hosts every model. Without any backend
+    sections, the pool is just `ollama_server_url`.
+    """
+    backends = []
+    for section in config.sections():
+        if not section.startswith(BACKEND_SECTION_PREFIX):
+            continue
+        models = config.get(section, "models", fallback="").strip()
+        backends.append(
+            BackendConfig(
+                section[len(BACKEND_SECTION_PREFIX) :].strip(),
+                config.get(section, "url"),
+                config.getfloat(section, "weight", fallback=1.0),
+                (
+                    frozenset(
+                        model.strip() for model in models.split(",") if model.strip()
+                    )
+                    if models
+                    else None
+                ),
+            )
+        )
+    if not backends and ollama_server_url:
+        backends.append(BackendConfig("default", ollama_server_url))
+    return tuple(backends)
 
 
 def gradio_assert_config_exists():
     conf = get_config()
     if not (
-        conf["server_url"]
-        and conf["google_api_key"]
-        and conf["google_prog_search_engine_id"]
-        and conf["huggingface_user_access_token"]
+        conf.ollama_server_url
+        and conf.google_api_key
+        and conf.google_prog_search_engine_id
+        and conf.huggingface_user_access_token
     ):
         raise GradioError(
             "Config not found! Please configure CTFBuddy before running any autosolvers!"
@@ -65,12 +210,18 @@ def update_config(
     huggingface_user_access_token,
 ):
     config = configparser.ConfigParser()
+    # Backend sections and the other [Server] settings are only edited by hand, so keep them
+    config.read(CONFIG_STORE.path)
 
-    config["Server"] = {
-        "server_name": server_name,
-        "server_port": server_port,
-        "ollama_server_url": ollama_server_url,
-    }
+    if not config.has_section("Server"):
+        config.add_section("Server")
+    config["Server"].update(
+        {
+            "server_name": server_name,
+            "server_port": server_port,
+            "ollama_server_url": ollama_server_url,
+        }
+    )
 
     config["Keys_and_IDs"] = {
         "google_api_key": google_api_key,
@@ -78,5 +229,9 @@ def update_config(
         "huggingface_user_access_token": huggingface_user_access_token,
     }
 
-    with open(CONFIG_PATH, "w") as configfile:
+    # Written to a temporary file and swapped in, so readers never see a half-written config
+    tmp_path = f"{CONFIG_STORE.path}.{uuid4().hex}.tmp"
+    with open(tmp_path, "w") as configfile:
         config.write(configfile)
+    replace(tmp_path, CONFIG_STORE.path)
+    CONFIG_STORE.get()
@@ -0,0 +1,230 @@
+from dataclasses import dataclass, field
+
+DEFAULT_GENERATION_RESERVE = 1024
+SUMMARY_REQUEST = "Summarise our conversation so far."
+SUMMARY_PROMPT = """Summarise the following conversation between a user and an AI assistant working on a CTF challenge. Keep every clue, technique, vulnerability, method, number and piece of code that may be needed later, and nothing else.
+
+<<transcript>>"""
+TRIM_MARKER = "\n[... {} tokens trimmed to fit the context window ...]\n"
+
+
+@dataclass
+class CompactionReport:
+    policy: str
+    tokens_before: int
+    tokens_after: int
+    budget: int
+    dropped_messages: int = 0
+    summarised_messages: int = 0
+    trimmed_messages: list[int] = field(default_factory=list)
+
+    @property
+    def compacted(self):
+        return self.policy != "none"
+
+    @property
+    def fits(self):
+        return self.tokens_after <= self.budget
+
+    def __str__(self):
+        if not self.compacted:
+            if not self.fits:
+                return f"Conversation is {self.tokens_after} tokens, over the budget of {self.budget}, and could not be compacted"
+            return f"No compaction needed ({self.tokens_before}/{self.budget} tokens)"
+
+        actions = []
+        if self.summarised_messages:
+            actions.append(f"summarised {self.summarised_messages} old messages")
+        if self.dropped_messages:
+            actions.append(f"dropped {self.dropped_messages} old messages")
+        if self.trimmed_messages:
+            actions.append(
+                f"trimmed message(s) {', '.join(map(str, self.trimmed_messages))}"
+            )
+        if not self.fits:
+            actions.append(
+                f"still {self.tokens_after - self.budget} tokens over budget"
+            )
+        return f"Compacted conversation from {self.tokens_before} to {self.tokens_after} tokens (budget {self.budget}): {'; '.join(actions)}"
+
+
+def trim_middle(tokeniser, content, no_tokens_to_remove):
+    """
+    Removes roughly `no_tokens_to_remove` tokens from the middle of `content`, keeping its start and end.
+    """
+    tokens = tokeniser.encode(content, add_special_tokens=False)
+    marker = TRIM_MARKER.format(no_tokens_to_remove)
+    no_marker_tokens = len(tokeniser.encode(marker, add_special_tokens=False))
+    no_kept_tokens = max(len(tokens) - no_tokens_to_remove - no_marker_tokens, 0)
+    if not no_kept_tokens:
+        return marker.strip()
+
+    no_head_tokens = (no_kept_tokens + 1) // 2
+    no_tail_tokens = no_kept_tokens - no_head_tokens
+    head = tokeniser.decode(tokens[:no_head_tokens])
+    tail = tokeniser.decode(tokens[-no_tail_tokens:]) if no_tail_tokens else ""
+    return head + marker + tail
+
+
+class ContextBudgetManager:
+    """
+    Keeps an OllamaChat's message history within its context window.
+
+    Before each invocation `fit` checks the running token count against the context window minus
+    room reserved for the reply. If the conversation does not fit, the pinned messages (the system
+    prompt and, with `pin_first_user_message`, the first user message) are kept and, in order, the
+    oldest user/assistant turns are summarised or dropped and then the largest messages (usually the
+    challenge files) are trimmed in the middle. The system prompt is never trimmed, and the final user
+    message only as a last resort; if the conversation still does not fit, the report says so.
+    Compaction rewrites the message history itself, so discarded text is never sent or prefilled again.
+    """
+
+    def __init__(
+        self,
+        chat,
+        generation_reserve=DEFAULT_GENERATION_RESERVE,
+        summarise_dropped_turns=False,
+    ):
+        self.chat = chat
+        self.client = chat.client
+        self.generation_reserve = generation_reserve
+        self.summarise_dropped_turns = summarise_dropped_turns
+        self.pin_first_user_message = False
+
+    @property
+    def budget(self):
+        return self.chat.ctx_window - min(
+            self.generation_reserve, self.chat.ctx_window // 4
+        )
+
+    @property
+    def no_pinned_messages(self):
+        history = self.chat.message_history
+        no_pinned = 1 if history and history[0]["role"] == "system" else 0
+        if self.pin_first_user_message and len(history) > no_pinned:
+            no_pinned += 1
+        return no_pinned
+
+    def fit(self):
+        """
+        Compacts the message history until it fits within the budget.
+
+        Returns:
+            CompactionReport: What was compacted, if anything.
+        """
+        budget = self.budget
+        report = CompactionReport(
+            "none", self.chat.conv_no_tokens, self.chat.conv_no_tokens, budget
+        )
+        if report.tokens_before <= budget:
+            return report
+
+        policies = []
+        if self._compact_oldest_turns(report):
+            policies.append(
+                "summarise_oldest_turns"
+                if report.summarised_messages
+                else "drop_oldest_turns"
+            )
+        if self.chat.conv_no_tokens > budget and self._trim_largest_messages(report):
+            policies.append("trim_oversized_messages")
+
+        report.policy = "+".join(policies) or "none"
+        report.tokens_after = self.chat.conv_no_tokens
+        return report
+
+    def _compact_oldest_turns(self, report):
+        chat = self.chat
+        deficit = chat.conv_no_tokens - report.budget
+
+        # Whole user/assistant turns between the pinned messages and the final user message. A pinned user
+        # message keeps its reply, so roles still alternate once turns are dropped or summarised.
+        start = self.no_pinned_messages
+        if (
+            start < len(chat.message_history)
+            and chat.message_history[start]["role"] != "user"
+        ):
+            start += 1
+        no_droppable = (len(chat.message_history) - 1 - start) // 2 * 2
+        if no_droppable <= 0:
+            return False
+
+        no_dropped = 0
+        freed_tokens = 0
+        while no_dropped < no_droppable and freed_tokens < deficit:
+            freed_tokens += sum(
+                chat.message_token_counts[start + no_dropped : start + no_dropped + 2]
+            )
+            no_dropped += 2
+
+        dropped = chat.message_history[start : start + no_dropped]
+        summary = None
+        if self.summarise_dropped_turns:
+            summary = self._summarise(dropped, max_tokens=freed_tokens // 4)
+
+        chat.remove_messages(start, start + no_dropped)
+        if summary:
+            chat.insert_message(start, "user", SUMMARY_REQUEST)
+            chat.insert_message(start + 1, "assistant", summary)
+            report.summarised_messages = no_dropped
+        else:
+            report.dropped_messages = no_dropped
+        return True
+
+    def _summarise(self, messages, max_tokens):
+        if max_tokens < 32:
+            return None
+
+        transcript = "\n\n".join(
+            f"{message['role'].upper()}: {message['content']}" for message in messages
+        )
+        overflow = (
+            len(self.chat.tokeniser.encode(transcript, add_special_tokens=False))
+            - self.budget
+            + max_tokens
+        )
+        if overflow > 0:
+            transcript = trim_middle(self.chat.tokeniser, transcript, overflow)
+
+        try:
+            res = self.client.chat(
+                model=self.chat.model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": SUMMARY_PROMPT.replace("<<transcript>>", transcript),
+                    }
+                ],
+                stream=False,
+                options={"num_ctx": self.chat.ctx_window, "num_predict": max_tokens},
+            )
+        except Exception:
+            return None
+        return res["message"]["content"].strip() or None
+
+    def _trim_largest_messages(self, report):
+        chat = self.chat
+        # The system prompt is never trimmed, and the final user message, the question being asked, only once
+        # nothing else is left.
+        first = 1 if chat.message_history[0]["role"] == "system" else 0
+        last = len(chat.message_history) - 1
+        candidates = sorted(
+            range(first, last),
+            key=lambda i: chat.message_token_counts[i],
+            reverse=True,
+        ) + [last]
+
+        trimmed = False
+        for i in candidates:
+            deficit = chat.conv_no_tokens - report.budget
+            if deficit <= 0:
+                break
+            chat.replace_message_content(
+                i,
+                trim_middle(
+                    chat.tokeniser, chat.message_history[i]["content"], deficit
+                ),
+            )
+            report.trimmed_messages.append(i)
+            trimmed = True
+        return trimmed
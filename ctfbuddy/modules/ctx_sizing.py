@@ -0,0 +1,129 @@
+from dataclasses import dataclass
+from threading import Lock
+from typing import Optional
+
+NUM_CTX_TIERS = (2048, 4096, 8192, 16384, 32768)
+DEFAULT_EXPECTED_GENERATION = 1024
+
+# Bytes of f16 KV cache per token of context: K and V * layers * KV heads * head dim * 2 bytes
+KV_CACHE_BYTES_PER_TOKEN = {
+    "llama3": 2 * 32 * 8 * 128 * 2,
+    "mistral": 2 * 32 * 8 * 128 * 2,
+    "openchat": 2 * 32 * 8 * 128 * 2,
+    "phi3": 2 * 32 * 32 * 96 * 2,
+}
+
+# Last num_ctx each model was run with, so sessions reuse an already-loaded size when it fits
+_last_num_ctx = {}
+_last_num_ctx_lock = Lock()
+
+
+@dataclass
+class CallMetrics:
+    model_name: str
+    num_ctx: int
+    ctx_window: int
+    prompt_tokens: int
+    reloaded: bool
+    kv_cache_bytes: int
+    kv_cache_bytes_saved: int
+    load_duration: Optional[float] = None
+    prompt_eval_count: Optional[int] = None
+    prompt_eval_duration: Optional[float] = None
+    eval_count: Optional[int] = None
+    eval_duration: Optional[float] = None
+    total_duration: Optional[float] = None
+    queue_wait: Optional[float] = None
+
+    def record_final_chunk(self, chunk):
+        # Ollama reports durations in nanoseconds
+        for key in (
+            "load_duration",
+            "prompt_eval_duration",
+            "eval_duration",
+            "total_duration",
+        ):
+            if chunk.get(key) is not None:
+                setattr(self, key, chunk[key] / 1e9)
+        self.prompt_eval_count = chunk.get("prompt_eval_count")
+        self.eval_count = chunk.get("eval_count")
+
+    def __str__(self):
+        text = f"num_ctx {self.num_ctx}/{self.ctx_window} for {self.prompt_tokens} prompt tokens{' (reloaded)' if self.reloaded else ''}, KV cache {self.kv_cache_bytes / 2**20:.0f} MiB ({self.kv_cache_bytes_saved / 2**20:.0f} MiB saved)"
+        if self.queue_wait is not None:
+            text += f", queued {self.queue_wait:.2f}s"
+        if self.total_duration is not None:
+            text += f", load {self.load_duration or 0:.2f}s, prompt eval {self.prompt_eval_count or 0} tokens in {self.prompt_eval_duration or 0:.2f}s, eval {self.eval_count or 0} tokens in {self.eval_duration or 0:.2f}s, total {self.total_duration:.2f}s"
+        return text
+
+
+class NumCtxSizer:
+    """
+    Picks the `num_ctx` sent to Ollama for each request from a fixed set of tiers.
+
+    The smallest tier that holds the prompt plus the expected reply is used instead of the whole
+    context window, which keeps Ollama's KV cache small. Because changing `num_ctx` makes Ollama
+    reload the model, a session never moves to a smaller tier, and a model's previous tier is reused
+    whenever it is big enough.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        ctx_window,
+        expected_generation=DEFAULT_EXPECTED_GENERATION,
+        tiers=NUM_CTX_TIERS,
+    ):
+        self.model_name = model_name
+        self.ctx_window = ctx_window
+        self.expected_generation = expected_generation
+        self.tiers = sorted(
+            {tier for tier in tiers if tier < ctx_window} | {ctx_window}
+        )
+        self.num_ctx = None
+        self.reserved_tokens = 0
+
+    def reserve_for_session(self, no_tokens):
+        """
+        Makes the first request pick a tier big enough for `no_tokens`, so the whole session fits in one tier.
+        """
+        self.reserved_tokens = no_tokens
+
+    def select(self, no_prompt_tokens):
+        """
+        Chooses the num_ctx for a request.
+
+        Args:
+            no_prompt_tokens (int): The number of tokens in the conversation sent to the model.
+
+        Returns:
+            tuple[int, bool]: The num_ctx, and whether it differs from the size the model was last run with.
+        """
+        needed = max(no_prompt_tokens + self.expected_generation, self.reserved_tokens)
+
+        with _last_num_ctx_lock:
+            last_num_ctx = _last_num_ctx.get(self.model_name)
+            if self.num_ctx is None or needed > self.num_ctx:
+                if last_num_ctx and needed <= last_num_ctx <= self.ctx_window:
+                    tier = last_num_ctx
+                else:
+                    tier = next(
+                        (tier for tier in self.tiers if tier >= needed),
+                        self.ctx_window,
+                    )
+                self.num_ctx = max(self.num_ctx or 0, tier)
+
+            _last_num_ctx[self.model_name] = self.num_ctx
+        return self.num_ctx, last_num_ctx is not None and last_num_ctx != self.num_ctx
+
+    def make_call_metrics(self, no_prompt_tokens, num_ctx, reloaded):
+        bytes_per_token = KV_CACHE_BYTES_PER_TOKEN.get(self.model_name, 0)
+        return CallMetrics(
+            model_name=self.model_name,
+            num_ctx=num_ctx,
+            ctx_window=self.ctx_window,
+            prompt_tokens=no_prompt_tokens,
+            reloaded=reloaded,
+            kv_cache_bytes=num_ctx * bytes_per_token,
+            kv_cache_bytes_saved=(self.ctx_window - num_ctx) * bytes_per_token,
+        )
@@ -0,0 +1,335 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from os import makedirs, path, remove
+from threading import Lock, local
+from time import perf_counter, time
+
+import httpx
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from modules.config import CACHE_DIR
+from modules.host import get_host
+from modules.metrics import EMBEDDING_BATCH_DURATION, EMBEDDING_TEXTS
+from modules.sqlite_cache import connect_cache_db
+from modules.tokenisers import NOMIC_EMBED_TEXT, get_nomic_embed_text_tokeniser
+
+EMBEDDING_CACHE_DIR = path.join(CACHE_DIR, "embeddings")
+BATCH_TOKEN_BUDGET = 8192
+MAX_BATCH_SIZE = 256
+MAX_CONCURRENT_BATCHES = 4
+EMBED_TIMEOUT = 120  # seconds per batch
+INITIAL_CACHE_ROWS = 1024
+QUERY_CACHE_SIZE = 1024  # query vectors kept in memory
+
+# nomic-embed-text expects a task prefix on every text
+DOCUMENT_PREFIX = "search_document: "
+QUERY_PREFIX = "search_query: "
+
+
+class VectorCache:
+    """
+    On-disk embedding cache: a memory-mapped float32 matrix of vectors and a SQLite index from text hash to row.
+
+    Vectors are written to the matrix before their rows are indexed, so an interrupted write leaves at most an
+    unused row behind. The matrix doubles in size whenever it fills up, and `retain` rebuilds it with only the
+    vectors still needed.
+    """
+
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, model_name=NOMIC_EMBED_TEXT):
+        makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self._lock = Lock()
+        self._matrix = None
+
+        self._conn = connect_cache_db(path.join(cache_dir, f"{model_name}.sqlite3"))
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors (hash TEXT PRIMARY KEY, row INTEGER NOT NULL)"
+        )
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        self.dim = row[0] if row else None
+        row = self._conn.execute(
+            "SELECT value FROM meta WHERE key = 'generation'"
+        ).fetchone()
+        self.generation = row[0] if row else 0
+        (self.no_rows,) = self._conn.execute(
+            "SELECT COALESCE(MAX(row) + 1, 0) FROM vectors"
+        ).fetchone()
+        if self.dim:
+            self._open_matrix()
+
+    def _matrix_path(self, generation):
+        # Each rebuild writes a new file, so the index never points into a half-written matrix
+        suffix = f".{generation}" if generation else ""
+        return path.join(self.cache_dir, f"{self.model_name}{suffix}.f32")
+
+    @property
+    def matrix_path(self):
+        return self._matrix_path(self.generation)
+
+    def _open_matrix(self, min_rows=0):
+        row_bytes = self.dim * np.dtype(np.float32).itemsize
+        capacity = (
+            path.getsize(self.matrix_path) // row_bytes
+            if path.exists(self.matrix_path)
+            else 0
+        )
+        if capacity < max(min_rows, 1):
+            capacity = max(capacity * 2, min_rows, INITIAL_CACHE_ROWS)
+            if self._matrix is not None:
+                self._matrix.flush()
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(capacity * row_bytes)
+        self._matrix = np.memmap(
+            self.matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim)
+        )
+
+    def get_many(self, hashes):
+        found = {}
+        with self._lock:
+            if self._matrix is None:
+                return found
+            for i in range(0, len(hashes), 512):
+                batch = hashes[i : i + 512]
+                for hash, row in self._conn.execute(
+                    f"SELECT hash, row FROM vectors WHERE hash IN ({','.join('?' * len(batch))})",
+                    batch,
+                ):
+                    found[hash] = np.array(self._matrix[row])
+        return found
+
+    def put_many(self, hashes, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._conn.execute("INSERT INTO meta VALUES ('dim', ?)", (self.dim,))
+            if self._matrix is None or self.no_rows + len(hashes) > len(self._matrix):
+                self._open_matrix(self.no_rows + len(hashes))
+
+            rows = range(self.no_rows, self.no_rows + len(hashes))
+            self._matrix[rows.start : rows.stop] = vectors
+            self._matrix.flush()
+            self.no_rows = rows.stop
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO vectors VALUES (?, ?)", zip(hashes, rows)
+            )
+
+    def retain(self, hashes):
+        """
+        Rebuilds the matrix with only the vectors of `hashes`, freeing the rows of every other vector.
+
+        Returns:
+            int: How many vectors were kept.
+        """
+        keep = set(hashes)
+        with self._lock:
+            if self._matrix is None:
+                return 0
+            kept = [
+                (hash, row)
+                for hash, row in self._conn.execute("SELECT hash, row FROM vectors")
+                if hash in keep
+            ]
+            old_path = self.matrix_path
+            generation = self.generation + 1
+            new_path = self._matrix_path(generation)
+            matrix = np.memmap(
+                new_path,
+                dtype=np.float32,
+                mode="w+",
+                shape=(max(len(kept), INITIAL_CACHE_ROWS), self.dim),
+            )
+            if kept:
+                matrix[: len(kept)] = self._matrix[[row for _, row in kept]]
+            matrix.flush()
+            del matrix
+
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM vectors")
+            self._conn.executemany(
+                "INSERT INTO vectors VALUES (?, ?)",
+                ((hash, new_row) for new_row, (hash, _) in enumerate(kept)),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('generation', ?)", (generation,)
+            )
+            self._conn.execute("COMMIT")
+
+            self._matrix = None
+            self.generation = generation
+            self.no_rows = len(kept)
+            self._open_matrix()
+            remove(old_path)
+        return len(kept)
+
+
+class EmbeddingService(Embeddings):
+    """
+    Batched, cached nomic-embed-text embeddings for LangChain vector stores.
+
+    Texts are grouped into batches of at most `batch_token_budget` tokens, counted with the nomic-embed-text
+    tokeniser, and up to `max_concurrent` batches are sent to Ollama's `/api/embed` at once (falling back to one
+    `/api/embeddings` call per text on older Ollama servers). Document vectors are cached on disk by text hash, so
+    texts that were embedded before cost nothing; query vectors are only kept in memory, for the last
+    `QUERY_CACHE_SIZE` queries. `last_stats` holds the throughput of the calling thread's most recent
+    `embed_documents` call.
+    """
+
+    def __init__(
+        self,
+        model_name=NOMIC_EMBED_TEXT,
+        batch_token_budget=BATCH_TOKEN_BUDGET,
+        max_concurrent=MAX_CONCURRENT_BATCHES,
+        vector_cache=None,
+    ):
+        self.model_name = model_name
+        self.batch_token_budget = batch_token_budget
+        self.max_concurrent = max_concurrent
+        self.vector_cache = vector_cache or VectorCache(model_name=model_name)
+        self._local = local()
+        self._query_vectors = OrderedDict()  # text -> vector, least recently used first
+        self._query_lock = Lock()
+        self._session = None
+        self._legacy_api = False
+
+    @property
+    def last_stats(self):
+        return getattr(self._local, "stats", None)
+
+    @staticmethod
+    def text_hash(model_name, text):
+        return sha256(f"{model_name}\0{text}".encode()).hexdigest()
+
+    def document_hashes(self, texts):
+        """
+        Returns the keys that `embed_documents` caches the vectors of `texts` under.
+        """
+        return [
+            self.text_hash(self.model_name, DOCUMENT_PREFIX + text) for text in texts
+        ]
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = get_host().session(self.model_name)
+        return self._session
+
+    def make_batches(self, texts):
+        tokeniser = get_nomic_embed_text_tokeniser()
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for i, encoding in enumerate(tokeniser.encode_batch(texts)):
+            no_tokens = len(encoding.ids)
+            if batch and (
+                batch_tokens + no_tokens > self.batch_token_budget
+                or len(batch) >= MAX_BATCH_SIZE
+            ):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(i)
+            batch_tokens += no_tokens
+        if batch:
+            batches.append(batch)
+        return [[texts[i] for i in batch] for batch in batches]
+
+    def _embed_batch(self, texts):
+        start_time = perf_counter()
+        vectors = self._request_embeddings(texts)
+        EMBEDDING_BATCH_DURATION.observe(
+            perf_counter() - start_time, model=self.model_name
+        )
+        return vectors
+
+    def _request_embeddings(self, texts):
+        if not self._legacy_api:
+            try:
+                return self.session.post(
+                    "/api/embed",
+                    {"model": self.model_name, "input": texts},
+                    timeout=EMBED_TIMEOUT,
+                )["embeddings"]
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code != 404:
+                    raise
+                self._legacy_api = True
+        return [
+            self.session.post(
+                "/api/embeddings",
+                {"model": self.model_name, "prompt": text},
+                timeout=EMBED_TIMEOUT,
+            )["embedding"]
+            for text in texts
+        ]
+
+    def _embed(self, texts, vector_cache=None):
+        """
+        Returns:
+            tuple: The vectors of `texts`, and the call's stats.
+        """
+        start_time = time()
+        hashes = [self.text_hash(self.model_name, text) for text in texts]
+        vectors = vector_cache.get_many(list(set(hashes))) if vector_cache else {}
+
+        missing = {}
+        for hash, text in zip(hashes, texts):
+            if hash not in vectors:
+                missing.setdefault(hash, text)
+        if missing:
+            missing_hashes = list(missing)
+            batches = self.make_batches([missing[hash] for hash in missing_hashes])
+            with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+                new_vectors = [
+                    vector
+                    for batch_vectors in executor.map(self._embed_batch, batches)
+                    for vector in batch_vectors
+                ]
+            if vector_cache:
+                vector_cache.put_many(missing_hashes, new_vectors)
+            vectors.update(zip(missing_hashes, np.asarray(new_vectors, np.float32)))
+
+        EMBEDDING_TEXTS.inc(len(missing), model=self.model_name, outcome="embedded")
+        EMBEDDING_TEXTS.inc(
+            len(texts) - len(missing), model=self.model_name, outcome="cached"
+        )
+        elapsed = time() - start_time
+        stats = {
+            "texts": len(texts),
+            "embedded": len(missing),
+            "cached": len(texts) - len(missing),
+            "batches": len(batches) if missing else 0,
+            "seconds": elapsed,
+            "chunks_per_s": len(texts) / elapsed if elapsed else float("inf"),
+        }
+        return [vectors[hash].tolist() for hash in hashes], stats
+
+    def embed_documents(self, texts):
+        vectors, self._local.stats = self._embed(
+            [DOCUMENT_PREFIX + text for text in texts], self.vector_cache
+        )
+        return vectors
+
+    def embed_query(self, text):
+        with self._query_lock:
+            if (vector := self._query_vectors.get(text)) is not None:
+                self._query_vectors.move_to_end(text)
+                return vector
+        vectors, _ = self._embed([QUERY_PREFIX + text])
+        with self._query_lock:
+            self._query_vectors[text] = vectors[0]
+            while len(self._query_vectors) > QUERY_CACHE_SIZE:
+                self._query_vectors.popitem(last=False)
+        return vectors[0]
+
+    def format_last_stats(self):
+        if not self.last_stats:
+            return "No embeddings yet"
+        stats = self.last_stats
+        return f"Embedded {stats['texts']} chunks ({stats['cached']} cached, {stats['embedded']} in {stats['batches']} batches) in {round(stats['seconds'], 2)}s ({round(stats['chunks_per_s'], 1)} chunks/s)"
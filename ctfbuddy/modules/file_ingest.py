@@ -0,0 +1,127 @@
+from codecs import getincrementaldecoder
+from dataclasses import dataclass
+from os import path
+
+READ_CHUNK_SIZE = 64 * 1024
+BINARY_SNIFF_SIZE = 8000
+BINARY_PREVIEW_BYTES = 1024
+HEXDUMP_LINE_BYTES = 16
+
+
+@dataclass
+class IngestedFile:
+    filepath: str
+    content: str
+    no_tokens: int
+    size: int
+    binary: bool = False
+    truncated: bool = False
+    omitted: bool = False
+
+    def render(self):
+        if self.omitted:
+            return f"\n###<{self.filepath}>\n[omitted: challenge file token budget used up]"
+        header = f"\n###<{self.filepath}>"
+        if self.binary:
+            header += f" (binary, {self.size} bytes, hex preview)"
+        text = f"{header}\n{self.content}"
+        if self.truncated:
+            text += f"\n[... truncated after {self.no_tokens} tokens ...]"
+        return text
+
+
+def is_binary(sample):
+    if b"\x00" in sample:
+        return True
+    try:
+        getincrementaldecoder("utf-8")().decode(sample, final=False)
+    except UnicodeDecodeError:
+        return True
+    return False
+
+
+def hexdump(data, offset=0):
+    lines = []
+    for i in range(0, len(data), HEXDUMP_LINE_BYTES):
+        line = data[i : i + HEXDUMP_LINE_BYTES]
+        hex_part = " ".join(line[j : j + 2].hex() for j in range(0, len(line), 2))
+        ascii_part = "".join(chr(b) if 32 <= b < 127 else "." for b in line)
+        lines.append(f"{offset + i:08x}: {hex_part:<39}  {ascii_part}")
+    return "\n".join(lines)
+
+
+def truncate_to_tokens(tokeniser, text, no_tokens):
+    tokens = tokeniser.encode(text, add_special_tokens=False)
+    if len(tokens) <= no_tokens:
+        return text, len(tokens)
+    return tokeniser.decode(tokens[:no_tokens]), no_tokens
+
+
+def ingest_file(filepath, tokeniser, token_budget):
+    """
+    Reads a challenge file in chunks, counting tokens as it goes, until it ends or `token_budget` is reached.
+
+    Binary files (NUL bytes or invalid UTF-8 near the start) are replaced with a hex dump of their first bytes.
+
+    Returns:
+        IngestedFile: The file's text (or preview) and how many tokens it uses.
+    """
+    size = path.getsize(filepath)
+    with open(filepath, "rb") as f:
+        first_chunk = f.read(READ_CHUNK_SIZE)
+
+        if is_binary(first_chunk[:BINARY_SNIFF_SIZE]):
+            preview, no_tokens = truncate_to_tokens(
+                tokeniser, hexdump(first_chunk[:BINARY_PREVIEW_BYTES]), token_budget
+            )
+            return IngestedFile(
+                filepath,
+                preview,
+                no_tokens,
+                size,
+                binary=True,
+                truncated=size > BINARY_PREVIEW_BYTES or no_tokens == token_budget,
+            )
+
+        decoder = getincrementaldecoder("utf-8")(errors="replace")
+        parts = []
+        no_tokens = 0
+        chunk = first_chunk
+        while chunk:
+            text = decoder.decode(chunk)
+            text_tokens = tokeniser.encode(text, add_special_tokens=False)
+            if no_tokens + len(text_tokens) > token_budget:
+                parts.append(tokeniser.decode(text_tokens[: token_budget - no_tokens]))
+                return IngestedFile(
+                    filepath, "".join(parts), token_budget, size, truncated=True
+                )
+            parts.append(text)
+            no_tokens += len(text_tokens)
+            chunk = f.read(READ_CHUNK_SIZE)
+
+        parts.append(decoder.decode(b"", final=True))
+        return IngestedFile(filepath, "".join(parts), no_tokens, size)
+
+
+def ingest_files(filepaths, tokeniser, file_token_budget, total_token_budget):
+    """
+    Ingests several challenge files, giving each at most `file_token_budget` tokens and all of them together at most
+    `total_token_budget` tokens. Files that no longer fit are listed but left out.
+
+    Returns:
+        list[IngestedFile]: The ingested files, in the given order.
+    """
+    ingested = []
+    remaining_tokens = total_token_budget
+    for filepath in filepaths:
+        if remaining_tokens <= 0:
+            ingested.append(
+                IngestedFile(filepath, "", 0, path.getsize(filepath), omitted=True)
+            )
+            continue
+        ingested_file = ingest_file(
+            filepath, tokeniser, min(file_token_budget, remaining_tokens)
+        )
+        remaining_tokens -= ingested_file.no_tokens
+        ingested.append(ingested_file)
+    return ingested
@@ -1,13 +1,68 @@
-from os import path
+from threading import Lock
 
-import ollama
+from gradio import Error as GradioError
 
-from modules.config import get_config
+from modules.config import CONFIG_STORE, get_config
+from modules.router import Backend, OllamaRouter
+
+_router = None
+_router_lock = Lock()
 
 
 def get_host_url():
-    return get_config()["ollama_server_url"]
+    return get_config().ollama_server_url
+
+
+def _build_router(backend_configs, old_router=None):
+    # Backends whose URL is unchanged keep their pooled clients and health state
+    old_backends = {
+        (backend.name, backend.url): backend
+        for backend in (old_router.backends if old_router else [])
+    }
+    backends = []
+    for backend_config in backend_configs:
+        backend = old_backends.get((backend_config.name, backend_config.url))
+        if backend is None:
+            backend = Backend(backend_config.name, backend_config.url)
+        backend.weight = backend_config.weight
+        backend.models = backend_config.models
+        backends.append(backend)
+    return OllamaRouter(backends)
+
+
+def _on_config_change(old_config, new_config):
+    global _router
+    if old_config.ollama_backends == new_config.ollama_backends:
+        return
+    with _router_lock:
+        if _router is not None:
+            _router = (
+                _build_router(new_config.ollama_backends, _router)
+                if new_config.ollama_backends
+                else None
+            )
+
+
+CONFIG_STORE.subscribe(_on_config_change)
 
 
 def get_host():
-    return ollama.Client(get_host_url())
+    """
+    Returns the shared `OllamaRouter` over the configured Ollama backends, rebuilt as soon as the backend pool in
+    config.ini changes.
+
+    Pass it as the client of an `OllamaChat` to bind the chat to one backend, or call `session`/`async_session`.
+
+    Raises:
+        gradio.Error: If no Ollama server is configured.
+    """
+    global _router
+    config = get_config()
+    if not config.ollama_backends:
+        raise GradioError(
+            "Ollama server not configured! Please configure CTFBuddy first!"
+        )
+    with _router_lock:
+        if _router is None:
+            _router = _build_router(config.ollama_backends)
+        return _router
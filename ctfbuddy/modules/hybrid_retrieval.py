@@ -0,0 +1,168 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import modules.logging as log
+from modules.host import get_host
+from modules.tokenisers import get_nomic_embed_text_tokeniser
+from modules.vector_index import chunk_id
+
+DEFAULT_K = 6
+DEFAULT_FETCH_K = 30  # candidates taken from each ranking
+DEFAULT_CONTEXT_TOKEN_BUDGET = 2048
+RRF_K = 60
+DEFAULT_RERANK_MODEL = "phi3"
+RERANK_TOP_N = 12
+MAX_CONCURRENT_RERANKS = 4
+
+RERANK_SYSTEM_PROMPT = """You judge how useful a passage is for answering a question about a CTF challenge.
+Reply with JSON of the form {"score": <integer from 0 to 10>}, where 0 means irrelevant and 10 means the passage answers the question."""
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[str]], k: int = RRF_K
+) -> list[tuple[str, float]]:
+    """
+    Merges rankings of IDs by summing 1 / (k + rank) over the rankings each ID appears in.
+
+    Returns:
+        list: (ID, fused score) pairs, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] = scores.get(id, 0) + 1 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class OllamaReranker:
+    """
+    Scores query-passage relevance with a small local model through Ollama, several passages at once.
+    """
+
+    def __init__(
+        self,
+        model_name: str = DEFAULT_RERANK_MODEL,
+        max_concurrent: int = MAX_CONCURRENT_RERANKS,
+    ):
+        self.model_name = model_name
+        self.max_concurrent = max_concurrent
+
+    def score(self, query: str, doc: Document) -> float:
+        res = (
+            get_host()
+            .session(self.model_name)
+            .chat(
+                model=self.model_name,
+                messages=[
+                    {"role": "system", "content": RERANK_SYSTEM_PROMPT},
+                    {
+                        "role": "user",
+                        "content": f"Question: {query}\n\nPassage:\n{doc.page_content}",
+                    },
+                ],
+                format="json",
+                options={"temperature": 0, "num_predict": 16},
+                stream=False,
+            )
+        )
+        try:
+            return float(json.loads(res["message"]["content"])["score"])
+        except (ValueError, KeyError, TypeError):
+            return 0.0
+
+    def rerank(self, query: str, docs: list[Document]) -> list[Document]:
+        """
+        Returns the documents sorted by score, keeping their order on ties and if the model cannot be reached.
+        """
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+                scores = list(executor.map(lambda doc: self.score(query, doc), docs))
+        except Exception as e:
+            log.log_warning("Autosurfer", f"Reranking failed, keeping fused order: {e}")
+            return docs
+
+        for doc, score in zip(docs, scores):
+            doc.metadata["rerank_score"] = score
+        return [
+            doc
+            for _, doc in sorted(
+                enumerate(docs), key=lambda item: (-scores[item[0]], item[0])
+            )
+        ]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retrieves chunks from a `VectorIndex` by fusing dense (embedding) and sparse (BM25) rankings.
+
+    The top `fetch_k` chunks of each ranking are merged with reciprocal rank fusion. If a reranker is given, the
+    best `rerank_top_n` fused chunks are reordered by it. The first `k` chunks that fit in `context_token_budget`
+    tokens (counted with the nomic-embed-text tokeniser) are returned.
+    """
+
+    vector_index: Any
+    k: int = DEFAULT_K
+    fetch_k: int = DEFAULT_FETCH_K
+    rrf_k: int = RRF_K
+    context_token_budget: Optional[int] = DEFAULT_CONTEXT_TOKEN_BUDGET
+    reranker: Optional[OllamaReranker] = None
+    rerank_top_n: int = RERANK_TOP_N
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> list[Document]:
+        fused = reciprocal_rank_fusion(
+            [
+                self.vector_index.dense_search(query, self.fetch_k),
+                [id for id, _ in self.vector_index.bm25.search(query, self.fetch_k)],
+            ],
+            self.rrf_k,
+        )
+        no_candidates = max(self.k, self.rerank_top_n if self.reranker else 0) * 2
+        fused_scores = dict(fused[:no_candidates])
+        docs = self.vector_index.get_documents(list(fused_scores))
+        for doc in docs:
+            doc.metadata["rrf_score"] = fused_scores[chunk_id(doc.page_content)]
+
+        if self.reranker:
+            docs = (
+                self.reranker.rerank(query, docs[: self.rerank_top_n])
+                + docs[self.rerank_top_n :]
+            )
+        return self.fit_to_budget(docs)
+
+    def fit_to_budget(self, docs: list[Document]) -> list[Document]:
+        if self.context_token_budget is None:
+            return docs[: self.k]
+
+        selected = []
+        no_tokens = 0
+        tokeniser = get_nomic_embed_text_tokeniser()
+        for doc, encoding in zip(
+            docs, tokeniser.encode_batch([doc.page_content for doc in docs])
+        ):
+            if len(selected) >= self.k:
+                break
+            if no_tokens + len(encoding.ids) > self.context_token_budget:
+                continue
+            selected.append(doc)
+            no_tokens += len(encoding.ids)
+        return selected
+
+
+def format_context(docs: list[Document]) -> str:
+    """
+    Joins retrieved chunks into the context block of a RAG prompt, each headed by its source.
+    """
+    return "\n\n".join(
+        f"[{i}] {doc.metadata.get('title') or doc.metadata.get('source', '')}\n{doc.page_content}"
+        for i, doc in enumerate(docs, start=1)
+    )
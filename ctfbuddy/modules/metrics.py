@@ -0,0 +1,335 @@
+import bisect
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)  # seconds
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)  # tokens per second
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels
+    )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _format_value(value):
+    return "+Inf" if value == math.inf else repr(float(value))
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            return [
+                (f"{self.name}_total", labels, value)
+                for labels, value in sorted(self._values.items())
+            ]
+
+
+class Histogram(Counter):
+    """
+    Cumulative-bucket histogram in the Prometheus style, kept per label set.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        if value is None:
+            return
+        key = self._key(labels)
+        with self._lock:
+            if (series := self._values.get(key)) is None:
+                series = self._values[key] = [
+                    [0] * len(self.buckets),
+                    0.0,
+                    0,
+                    value,
+                    value,
+                ]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+            series[3] = min(series[3], value)
+            series[4] = max(series[4], value)
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: (label pairs) -> (per-bucket counts, sum, count, min, max).
+        """
+        with self._lock:
+            return {
+                labels: (list(counts), *rest)
+                for labels, (counts, *rest) in self._values.items()
+            }
+
+    def quantile(self, q, counts, count, min_value, max_value):
+        """
+        Estimates a quantile from bucket counts by interpolating linearly within the bucket it falls in, clamped to
+        the smallest and largest values observed.
+        """
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for i, bucket_count in enumerate(counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = max(self.buckets[i - 1] if i else 0, min_value)
+                upper = min(self.buckets[i], max_value)
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return max_value
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total, count, _, _) in sorted(self.snapshot().items()):
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        labels + (("le", _format_value(bucket)),),
+                        cumulative,
+                    )
+                )
+            samples.append((f"{self.name}_sum", labels, total))
+            samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self, name, help, labelnames=(), buckets=LATENCY_BUCKETS
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def summary_markdown(self) -> str:
+        """
+        Renders every series with observations as Markdown tables: histograms with their mean, p50 and p95, and
+        counters with their totals.
+        """
+        histogram_rows = []
+        counter_rows = []
+        for metric in self.metrics():
+            if isinstance(metric, Histogram):
+                for labels, (counts, total, count, *extremes) in sorted(
+                    metric.snapshot().items()
+                ):
+                    p50, p95 = (
+                        metric.quantile(q, counts, count, *extremes)
+                        for q in (0.5, 0.95)
+                    )
+                    histogram_rows.append(
+                        f"| {metric.help} | {', '.join(str(value) for _, value in labels if value)} | {count} | {total / count:.3g} | {p50:.3g} | {p95:.3g} |"
+                    )
+            else:
+                for _, labels, value in metric.samples():
+                    counter_rows.append(
+                        f"| {metric.help} | {', '.join(str(value) for _, value in labels if value)} | {value:g} |"
+                    )
+
+        if not (histogram_rows or counter_rows):
+            return "No metrics recorded yet"
+        parts = []
+        if histogram_rows:
+            parts.append(
+                "\n".join(
+                    [
+                        "| Metric | Labels | Count | Mean | p50 | p95 |",
+                        "| --- | --- | --- | --- | --- | --- |",
+                        *histogram_rows,
+                    ]
+                )
+            )
+        if counter_rows:
+            parts.append(
+                "\n".join(
+                    [
+                        "| Counter | Labels | Total |",
+                        "| --- | --- | --- |",
+                        *counter_rows,
+                    ]
+                )
+            )
+        return "\n\n".join(parts)
+
+
+REGISTRY = MetricsRegistry()
+
+LLM_REQUESTS = REGISTRY.counter(
+    "ctfbuddy_llm_requests",
+    "LLM requests",
+    ("model", "outcome"),
+)
+LLM_TTFT = REGISTRY.histogram(
+    "ctfbuddy_llm_time_to_first_token_seconds",
+    "LLM time to first token (s)",
+    ("model",),
+)
+LLM_DURATION = REGISTRY.histogram(
+    "ctfbuddy_llm_request_duration_seconds",
+    "LLM request duration (s)",
+    ("model",),
+)
+LLM_QUEUE_WAIT = REGISTRY.histogram(
+    "ctfbuddy_llm_queue_wait_seconds",
+    "LLM scheduler queue wait (s)",
+    ("model",),
+)
+LLM_LOAD_DURATION = REGISTRY.histogram(
+    "ctfbuddy_llm_load_duration_seconds",
+    "Ollama model load (s)",
+    ("model",),
+)
+LLM_PROMPT_EVAL_DURATION = REGISTRY.histogram(
+    "ctfbuddy_llm_prompt_eval_duration_seconds",
+    "Ollama prompt eval (s)",
+    ("model",),
+)
+LLM_EVAL_DURATION = REGISTRY.histogram(
+    "ctfbuddy_llm_eval_duration_seconds",
+    "Ollama eval (s)",
+    ("model",),
+)
+LLM_PROMPT_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "ctfbuddy_llm_prompt_eval_tokens_per_second",
+    "Ollama prompt eval rate (tokens/s)",
+    ("model",),
+    RATE_BUCKETS,
+)
+LLM_TOKENS_PER_SECOND = REGISTRY.histogram(
+    "ctfbuddy_llm_eval_tokens_per_second",
+    "Ollama generation rate (tokens/s)",
+    ("model",),
+    RATE_BUCKETS,
+)
+EMBEDDING_BATCH_DURATION = REGISTRY.histogram(
+    "ctfbuddy_embedding_batch_duration_seconds",
+    "Embedding batch duration (s)",
+    ("model",),
+)
+EMBEDDING_TEXTS = REGISTRY.counter(
+    "ctfbuddy_embedding_texts",
+    "Texts embedded",
+    ("model", "outcome"),
+)
+WEB_REQUEST_DURATION = REGISTRY.histogram(
+    "ctfbuddy_web_request_duration_seconds",
+    "Web request duration (s)",
+    ("kind",),
+)
+WEB_CACHE_LOOKUPS = REGISTRY.counter(
+    "ctfbuddy_web_cache_lookups",
+    "Web cache lookups",
+    ("kind", "outcome"),
+)
+STAGE_DURATION = REGISTRY.histogram(
+    "ctfbuddy_stage_duration_seconds",
+    "Request stage duration (s)",
+    ("module", "stage"),
+)
+
+
+def record_llm_final_chunk(model_name, chunk):
+    """
+    Records the timings that Ollama reports (in nanoseconds) in the final chunk of a response.
+    """
+    for histogram, key in (
+        (LLM_LOAD_DURATION, "load_duration"),
+        (LLM_PROMPT_EVAL_DURATION, "prompt_eval_duration"),
+        (LLM_EVAL_DURATION, "eval_duration"),
+    ):
+        if chunk.get(key) is not None:
+            histogram.observe(chunk[key] / 1e9, model=model_name)
+    for histogram, count_key, duration_key in (
+        (LLM_PROMPT_TOKENS_PER_SECOND, "prompt_eval_count", "prompt_eval_duration"),
+        (LLM_TOKENS_PER_SECOND, "eval_count", "eval_duration"),
+    ):
+        if chunk.get(count_key) and chunk.get(duration_key):
+            histogram.observe(
+                chunk[count_key] / (chunk[duration_key] / 1e9), model=model_name
+            )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(host, port, registry=REGISTRY) -> ThreadingHTTPServer:
+    """
+    Serves the registry in the Prometheus text format at `http://<host>:<port>/metrics` on a daemon thread.
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,73 @@
+from gradio import Error as GradioError
+
+import modules.logging as log
+from modules.host import get_host
+
+MODERATION_MODEL = "llama-guard3"
+
+# Llama Guard 3 hazard categories
+HAZARD_CATEGORIES = {
+    "S1": "violent crimes",
+    "S2": "non-violent crimes",
+    "S3": "sex-related crimes",
+    "S4": "child sexual exploitation",
+    "S5": "defamation",
+    "S6": "specialised advice",
+    "S7": "privacy",
+    "S8": "intellectual property",
+    "S9": "indiscriminate weapons",
+    "S10": "hate",
+    "S11": "suicide and self-harm",
+    "S12": "sexual content",
+    "S13": "elections",
+    "S14": "code interpreter abuse",
+}
+
+
+def moderate(text: str, prompt: str | None = None) -> list[str]:
+    """
+    Classifies a prompt, or the answer to a prompt, with Llama Guard.
+
+    Args:
+        text (str): The prompt, or the answer if `prompt` is given.
+        prompt (str | None): The prompt that `text` answers.
+
+    Returns:
+        list[str]: The hazard categories the message falls into, or an empty list if it is safe.
+    """
+    verdict = (
+        get_host()
+        .session(MODERATION_MODEL)
+        .chat(
+            model=MODERATION_MODEL,
+            messages=(
+                [{"role": "user", "content": text}]
+                if prompt is None
+                else [
+                    {"role": "user", "content": prompt},
+                    {"role": "assistant", "content": text},
+                ]
+            ),
+            options={"temperature": 0},
+            stream=False,
+        )["message"]["content"]
+        .strip()
+    )
+    if not verdict.lower().startswith("unsafe"):
+        return []
+    codes = verdict.split("\n", 1)[1] if "\n" in verdict else ""
+    return [
+        HAZARD_CATEGORIES.get(code.strip(), code.strip())
+        for code in codes.split(",")
+        if code.strip()
+    ] or ["unspecified"]
+
+
+def check_moderation(module, categories, raise_error_if_moderated=True):
+    if not categories:
+        return
+    text = f"Flagged for moderation ({', '.join(categories)})"
+    if raise_error_if_moderated:
+        log.log_warning(module, text, debug_only=True)
+        raise GradioError(text)
+    log.log_warning(module, text)
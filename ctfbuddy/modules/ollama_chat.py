@@ -1,44 +1,279 @@
+import asyncio
+from time import perf_counter
 from typing import Optional
-from ollama import Client
+from uuid import uuid4
+from ollama import AsyncClient, Client
 
-from modules.tokenisers import get_tokeniser_and_context_window
+import modules.logging as log
+from modules.context_budget import ContextBudgetManager, DEFAULT_GENERATION_RESERVE
+from modules.ctx_sizing import NumCtxSizer
+from modules.metrics import (
+    LLM_DURATION,
+    LLM_QUEUE_WAIT,
+    LLM_REQUESTS,
+    LLM_TTFT,
+    record_llm_final_chunk,
+)
+from modules.response_cache import ResponseCache
+from modules.router import OllamaRouter
+from modules.scheduler import GenerationScheduler
+from modules.tokenisers import get_tokeniser_and_context_window, get_template_overheads
+from modules.warmup import ModelWarmupManager
 
 
 class OllamaChat:
-    def __init__(self, client: Client, model_name: str, system_prompt: Optional[str]):
+    def __init__(
+        self,
+        client: Client | OllamaRouter,
+        model_name: str,
+        system_prompt: Optional[str],
+        verify_token_count: bool = False,
+        generation_reserve: int = DEFAULT_GENERATION_RESERVE,
+        summarise_dropped_turns: bool = False,
+        adaptive_num_ctx: bool = True,
+        response_cache: Optional[ResponseCache] = None,
+        bypass_cache: bool = False,
+        scheduler: Optional[GenerationScheduler] = None,
+        session_id: Optional[str] = None,
+        warmup_manager: Optional[ModelWarmupManager] = None,
+    ):
+        if isinstance(client, OllamaRouter):
+            # The whole chat stays on one backend, which also decides its scheduler
+            client = self._open_session(client, model_name)
+            scheduler = scheduler or client.scheduler
         self.client = client
         self.model_name = model_name
         self.message_history = []
-
-        self.tokeniser, self.ctx_window, _, self.num_token_func = (
-            get_tokeniser_and_context_window(model_name)
-        )
+        self.message_token_counts = []
+        self.verify_token_count = verify_token_count
+        self._conv_no_tokens = 0
+        self.last_compaction_report = None
+        self.call_metrics = []
+        self.response_cache = response_cache
+        self.bypass_cache = bypass_cache
+        self.last_response_cached = False
+        self.scheduler = scheduler
+        self.session_id = session_id or uuid4().hex
+        self._ticket = None
+        self.warmup_manager = warmup_manager
 
         if not model_name:
             raise ValueError("Model name required")
         if not client:
             raise ValueError("Client required")
+
+        self.tokeniser, self.ctx_window, _, self.num_token_func = (
+            get_tokeniser_and_context_window(model_name)
+        )
+        self.template_overheads = get_template_overheads(model_name)
+        self.budget_manager = ContextBudgetManager(
+            self, generation_reserve, summarise_dropped_turns
+        )
+        self.num_ctx_sizer = (
+            NumCtxSizer(model_name, self.ctx_window, generation_reserve)
+            if adaptive_num_ctx
+            else None
+        )
+
         if system_prompt:
             self.append_message("system", system_prompt)
 
     @property
     def conv_no_tokens(self):
-        return self.num_token_func(self.message_history)
+        if self.template_overheads is None:
+            return self.num_token_func(self.message_history)
+
+        if self.verify_token_count and self.message_history:
+            full_no_tokens = self.num_token_func(self.message_history)
+            if full_no_tokens != self._conv_no_tokens:
+                log.log_warning(
+                    "OllamaChat",
+                    f"Incremental token count for {self.model_name} is {self._conv_no_tokens} but full re-tokenisation gives {full_no_tokens} ({self._conv_no_tokens - full_no_tokens:+})",
+                    debug_only=True,
+                )
+            return full_no_tokens
+
+        return self._conv_no_tokens
+
+    @property
+    def last_call_metrics(self):
+        return self.call_metrics[-1] if self.call_metrics else None
+
+    @staticmethod
+    def _open_session(router, model_name):
+        return router.session(model_name)
 
     @staticmethod
     def wrap_message(role, content):
         return {"role": role, "content": content}
 
+    def count_message_tokens(self, role, content, index=None):
+        """
+        Counts the tokens a message adds to the conversation, including the chat template's overhead around it.
+
+        Args:
+            role (str): The role of the message.
+            content (str): The content of the message.
+            index (int, optional): The position of the message in the message history. Defaults to the end of the history.
+
+        Returns:
+            int: The number of tokens, leaving out the template's overhead if the chat template could not be calibrated.
+        """
+        if self.template_overheads is None:
+            return len(self.tokeniser.encode(content, add_special_tokens=False))
+
+        if index is None:
+            index = len(self.message_history)
+        if index == 0:
+            position = "first"
+        elif index == 1 and self.message_history[0]["role"] == "system":
+            position = "after_system"
+        else:
+            position = "subsequent"
+
+        overhead = self.template_overheads.get(
+            (position, role), self.template_overheads[("subsequent", "user")]
+        )
+        return len(self.tokeniser.encode(content, add_special_tokens=False)) + overhead
+
     def append_message(self, role, content):
+        no_tokens = self.count_message_tokens(role, content)
         self.message_history.append(OllamaChat.wrap_message(role, content))
+        self.message_token_counts.append(no_tokens)
+        self._conv_no_tokens += no_tokens
 
     def pop_last_message(self):
         self.message_history.pop()
+        self._conv_no_tokens -= self.message_token_counts.pop()
+
+    def _recount_from(self, index):
+        # Only the first two messages have position-dependent template overheads.
+        for i in range(index, min(2, len(self.message_history))):
+            message = self.message_history[i]
+            no_tokens = self.count_message_tokens(
+                message["role"], message["content"], i
+            )
+            self._conv_no_tokens += no_tokens - self.message_token_counts[i]
+            self.message_token_counts[i] = no_tokens
+
+    def insert_message(self, index, role, content):
+        self.message_history.insert(index, OllamaChat.wrap_message(role, content))
+        self.message_token_counts.insert(index, 0)
+        no_tokens = self.count_message_tokens(role, content, index)
+        self.message_token_counts[index] = no_tokens
+        self._conv_no_tokens += no_tokens
+        self._recount_from(index + 1)
+
+    def remove_messages(self, start, end):
+        self._conv_no_tokens -= sum(self.message_token_counts[start:end])
+        del self.message_history[start:end]
+        del self.message_token_counts[start:end]
+        self._recount_from(start)
+
+    def replace_message_content(self, index, content):
+        self.message_history[index] = OllamaChat.wrap_message(
+            self.message_history[index]["role"], content
+        )
+        self._recount_from(index)
+        if index >= 2:
+            no_tokens = self.count_message_tokens(
+                self.message_history[index]["role"], content, index
+            )
+            self._conv_no_tokens += no_tokens - self.message_token_counts[index]
+            self.message_token_counts[index] = no_tokens
+
+    def fit_to_context_window(self):
+        """
+        Checks that the message history can be sent and compacts it so that it fits within the context window.
+
+        Raises:
+            ValueError: If the message history does not end with a user message.
+        """
+        if not self.message_history or self.message_history[-1]["role"] != "user":
+            raise ValueError("Message history must end with a user message")
+
+        self.last_compaction_report = self.budget_manager.fit()
+        if not self.last_compaction_report.fits:
+            log.log_warning(
+                "OllamaChat", str(self.last_compaction_report), debug_only=True
+            )
+
+    def _prepare_request(self, stream):
+        self.fit_to_context_window()
+
+        no_prompt_tokens = self.conv_no_tokens
+        if self.num_ctx_sizer:
+            num_ctx, reloaded = self.num_ctx_sizer.select(no_prompt_tokens)
+            metrics = self.num_ctx_sizer.make_call_metrics(
+                no_prompt_tokens, num_ctx, reloaded
+            )
+            self.call_metrics.append(metrics)
+        else:
+            num_ctx = self.ctx_window
+            metrics = None
+
+        request = {
+            "model": self.model_name,
+            "messages": self.message_history,
+            "stream": stream,
+            "options": {"num_ctx": num_ctx},
+        }
+        if self.warmup_manager:
+            self.warmup_manager.record_use(self.model_name)
+            request["keep_alive"] = self.warmup_manager.keep_alive_for(self.model_name)
+        return request, metrics
+
+    def _lookup_cached_response(self):
+        self.last_response_cached = False
+        if not self.response_cache:
+            return None, None
+
+        self.fit_to_context_window()
+        cache_key = ResponseCache.make_key(self.model_name, self.message_history)
+        if self.bypass_cache:
+            return cache_key, None
+        cached_response = self.response_cache.get(cache_key)
+        self.last_response_cached = cached_response is not None
+        return cache_key, cached_response
+
+    def _store_generated_message(self, cache_key, res_stream):
+        if cache_key:
+            self.response_cache.put(cache_key, self.model_name, res_stream)
+        self.append_message("assistant", res_stream)
+
+    def _record_queue_wait(self, metrics):
+        if not self._ticket:
+            return
+        LLM_QUEUE_WAIT.observe(self._ticket.wait_time, model=self.model_name)
+        if metrics:
+            metrics.queue_wait = self._ticket.wait_time
+
+    def _record_response(self, final_chunk, start_time, first_token_time):
+        LLM_REQUESTS.inc(model=self.model_name, outcome="generated")
+        LLM_TTFT.observe(first_token_time - start_time, model=self.model_name)
+        LLM_DURATION.observe(perf_counter() - start_time, model=self.model_name)
+        record_llm_final_chunk(self.model_name, final_chunk)
+
+    def release_slot(self):
+        """
+        Frees the chat's generation slot, or leaves the queue if it is still waiting. Safe to call at any time.
+        """
+        if self._ticket:
+            self.scheduler.release(self._ticket)
+            self._ticket = None
+
+    def _acquire_slot(self):
+        if not self.scheduler or self._ticket:
+            return
+        self._ticket = self.scheduler.submit(self.session_id, self.model_name)
+        self.scheduler.wait(self._ticket)
 
     def invoke(self, stream=False):
         """
         Invokes the chatbot with the given model and message history, and returns the chatbot's response.
 
+        If the chat has a scheduler, waits for a generation slot first and frees it once the response has been fully received.
+
         Args:
             stream (bool, optional): Whether to stream the chatbot's response. Defaults to False.
 
@@ -48,16 +283,40 @@ class OllamaChat:
         Raises:
             ValueError: If the message history does not end with a user message.
         """
+        try:
+            request, metrics = self._prepare_request(stream)
+            self._acquire_slot()
+            self._record_queue_wait(metrics)
+            start_time = perf_counter()
+            try:
+                res = self.client.chat(**request)
+            except BaseException:
+                LLM_REQUESTS.inc(model=self.model_name, outcome="error")
+                raise
+        except BaseException:
+            self.release_slot()
+            raise
 
-        if not self.message_history or self.message_history[-1]["role"] != "user":
-            raise ValueError("Message history must end with a user message")
+        if not stream:
+            self.release_slot()
+            if metrics:
+                metrics.record_final_chunk(res)
+            self._record_response(res, start_time, perf_counter())
+            return res
+        return self._record_final_chunk(res, metrics, start_time)
 
-        return self.client.chat(
-            model=self.model_name,
-            messages=self.message_history,
-            stream=stream,
-            options={"num_ctx": self.ctx_window},
-        )
+    def _record_final_chunk(self, res, metrics, start_time):
+        first_token_time = None
+        try:
+            for chunk in res:
+                first_token_time = first_token_time or perf_counter()
+                if chunk.get("done"):
+                    if metrics:
+                        metrics.record_final_chunk(chunk)
+                    self._record_response(chunk, start_time, first_token_time)
+                yield chunk
+        finally:
+            self.release_slot()
 
     def invoke_and_append_generated_message(self, stream=False):
         """
@@ -75,15 +334,183 @@ class OllamaChat:
         Returns:
             None
         """
-        res = self.invoke(stream)
-        res_stream = ""
+        # The slot is freed however this ends, including when the caller stops iterating early
+        try:
+            cache_key, cached_response = self._lookup_cached_response()
+            if cached_response is not None:
+                self.release_slot()
+                yield from self._replay_cached_response(cached_response, stream)
+                return
+
+            res = self.invoke(stream)
+            res_stream = ""
+
+            if stream:
+                for chunk in res:
+                    res_stream += chunk["message"]["content"]
+                    yield res_stream
+            else:
+                res_stream = res["message"]["content"]
+        finally:
+            self.release_slot()
 
+        self._store_generated_message(cache_key, res_stream)
+        yield res_stream
+
+    def _replay_cached_response(self, cached_response, stream):
+        LLM_REQUESTS.inc(model=self.model_name, outcome="cached")
+        res_stream = ""
         if stream:
-            for chunk in res:
-                res_stream += chunk["message"]["content"]
+            for line in cached_response.splitlines(keepends=True):
+                res_stream += line
                 yield res_stream
-        else:
-            res_stream = res["message"]["content"]
+        self.append_message("assistant", cached_response)
+        yield cached_response
 
-        self.append_message("assistant", res_stream)
+
+class AsyncOllamaChat(OllamaChat):
+    """
+    OllamaChat with the same API, driven by an `ollama.AsyncClient` so many chats can share one event loop.
+
+    `invoke` is a coroutine and `invoke_and_append_generated_message` is an async generator. Summaries of dropped
+    turns, if enabled, are generated with `summary_client`, a synchronous client, off the event loop.
+
+    Given an `OllamaRouter` instead of a client, the chat is bound to one of its backends for its whole life and
+    waits on that backend's scheduler.
+    """
+
+    def __init__(
+        self,
+        client: AsyncClient | OllamaRouter,
+        model_name: str,
+        system_prompt: Optional[str],
+        summary_client: Optional[Client | OllamaRouter] = None,
+        **kwargs,
+    ):
+        super().__init__(client, model_name, system_prompt, **kwargs)
+        if self.budget_manager.summarise_dropped_turns and not summary_client:
+            raise ValueError("Summary client required to summarise dropped turns")
+        if isinstance(summary_client, OllamaRouter):
+            summary_client = summary_client.session(model_name)
+        self.budget_manager.client = summary_client
+
+    @staticmethod
+    def _open_session(router, model_name):
+        return router.async_session(model_name)
+
+    async def invoke(self, stream=False):
+        """
+        Invokes the chatbot with the given model and message history, and returns the chatbot's response.
+
+        Args:
+            stream (bool, optional): Whether to stream the chatbot's response. Defaults to False.
+
+        Returns:
+            dict or AsyncIterator[dict]: The chatbot's response. If `stream` is True, returns an async iterator of dictionaries containing the chatbot's response in chunks. Otherwise, returns a dictionary containing the entire chatbot's response.
+
+        Raises:
+            ValueError: If the message history does not end with a user message.
+        """
+        try:
+            request, metrics = await asyncio.to_thread(self._prepare_request, stream)
+            async for _ in self._wait_for_slot():
+                pass
+            self._record_queue_wait(metrics)
+            start_time = perf_counter()
+            try:
+                res = await self.client.chat(**request)
+            except BaseException:
+                LLM_REQUESTS.inc(model=self.model_name, outcome="error")
+                raise
+        except BaseException:
+            self.release_slot()
+            raise
+
+        if not stream:
+            self.release_slot()
+            if metrics:
+                metrics.record_final_chunk(res)
+            self._record_response(res, start_time, perf_counter())
+            return res
+        return self._record_final_chunk_async(res, metrics, start_time)
+
+    async def _record_final_chunk_async(self, res, metrics, start_time):
+        first_token_time = None
+        try:
+            async for chunk in res:
+                first_token_time = first_token_time or perf_counter()
+                if chunk.get("done"):
+                    if metrics:
+                        metrics.record_final_chunk(chunk)
+                    self._record_response(chunk, start_time, first_token_time)
+                yield chunk
+        finally:
+            self.release_slot()
+
+    async def _wait_for_slot(self):
+        if not self.scheduler or self._ticket:
+            return
+        self._ticket = self.scheduler.submit(self.session_id, self.model_name)
+        try:
+            async for position in self.scheduler.wait_async(self._ticket):
+                yield position
+        except BaseException:
+            self._ticket = None
+            raise
+
+    async def queue_for_generation(self):
+        """
+        Queues for a generation slot ahead of the next `invoke`, yielding the chat's queue position while it waits.
+
+        Nothing is queued if the chat has no scheduler or the next response will be replayed from the cache. A slot
+        granted here is held until `invoke_and_append_generated_message` finishes, so callers that may stop before
+        then must call `release_slot` in a `finally`.
+
+        Yields:
+            int: The chat's position in the scheduler's queue.
+        """
+        if self.response_cache and not self.bypass_cache:
+            _, cached_response = await asyncio.to_thread(self._lookup_cached_response)
+            if cached_response is not None:
+                return
+        async for position in self._wait_for_slot():
+            yield position
+
+    async def invoke_and_append_generated_message(self, stream=False):
+        """
+        Invokes the chatbot with the given model and message history, and appends the generated message to the message history.
+
+        Args:
+            stream (bool, optional): Whether to stream the chatbot's response. Defaults to False.
+
+        Yields:
+            str: A string representing the generated message.
+
+        Raises:
+            ValueError: If the message history does not end with a user message.
+        """
+        # The slot, possibly granted earlier by `queue_for_generation`, is freed however this ends
+        try:
+            cache_key, cached_response = await asyncio.to_thread(
+                self._lookup_cached_response
+            )
+            if cached_response is not None:
+                self.release_slot()
+                for res_stream in self._replay_cached_response(cached_response, stream):
+                    yield res_stream
+                return
+
+            res = await self.invoke(stream)
+            res_stream = ""
+
+            if stream:
+                async for chunk in res:
+                    res_stream += chunk["message"]["content"]
+                    yield res_stream
+            else:
+                res_stream = res["message"]["content"]
+        finally:
+            self.release_slot()
+
+        self._store_generated_message(cache_key, res_stream)
         yield res_stream
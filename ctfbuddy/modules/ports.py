@@ -0,0 +1,136 @@
+import errno
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+
+DEFAULT_START_PORT = 7860
+MAX_PORT = 65535
+PROBE_TIMEOUT = 0.2  # seconds per connect probe
+SEARCH_TIME_BUDGET = 1.0  # seconds
+MAX_CONCURRENT_PROBES = 32
+FREE_PORT_TTL = 60  # seconds a port found free is tried first
+
+
+def _bind_probe(host, port):
+    """
+    Returns whether the port can be bound, or None when `host` is not an address of this machine.
+    """
+    try:
+        family = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0][0]
+        with socket.socket(family, socket.SOCK_STREAM) as s:
+            # Same option as the web server, so ports in TIME_WAIT count as free
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind((host, port))
+        return True
+    except OSError as e:
+        if e.errno == errno.EADDRINUSE or e.errno == errno.EACCES:
+            return False
+        return None
+
+
+def _connect_probe(host, port, timeout):
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return False
+    except ConnectionRefusedError:
+        return True
+    except OSError:
+        # Timed out or unreachable, e.g. on a filtered interface, so the port cannot be shown to be free
+        return False
+
+
+def is_port_free(host, port, timeout=PROBE_TIMEOUT) -> bool:
+    """
+    Tries to bind the port, falling back to a connect probe with a short timeout when `host` is not local, in which
+    case only a refused connection counts as free.
+    """
+    if (free := _bind_probe(host, port)) is not None:
+        return free
+    return _connect_probe(host, port, timeout)
+
+
+def is_port_in_use(host, port, timeout=PROBE_TIMEOUT) -> bool:
+    return not is_port_free(host, port, timeout)
+
+
+class PortFinder:
+    """
+    Finds a free port by probing candidates in parallel batches, lowest first, within a time budget.
+
+    Ports recently found free are remembered and tried before any new probing, so repeated lookups from the
+    configuration tab answer immediately.
+    """
+
+    def __init__(
+        self,
+        max_concurrent=MAX_CONCURRENT_PROBES,
+        probe_timeout=PROBE_TIMEOUT,
+        free_port_ttl=FREE_PORT_TTL,
+    ):
+        self.max_concurrent = max_concurrent
+        self.probe_timeout = probe_timeout
+        self.free_port_ttl = free_port_ttl
+        self._free_ports = {}  # (host, port) -> when it was last found free
+        self._lock = Lock()
+
+    def _remember(self, host, port):
+        with self._lock:
+            self._free_ports[(host, port)] = monotonic()
+
+    def _remembered(self, host, start, end):
+        now = monotonic()
+        with self._lock:
+            for key, found_at in list(self._free_ports.items()):
+                if now - found_at > self.free_port_ttl:
+                    del self._free_ports[key]
+            return sorted(
+                port
+                for remembered_host, port in self._free_ports
+                if remembered_host == host and start <= port <= end
+            )
+
+    def find_free_port(
+        self,
+        host,
+        start=DEFAULT_START_PORT,
+        end=MAX_PORT,
+        time_budget=SEARCH_TIME_BUDGET,
+    ):
+        """
+        Returns:
+            int | None: A free port from `start` to `end`, preferring one recently found free and otherwise the
+            lowest one, or None if none was found within `time_budget` seconds.
+        """
+        deadline = monotonic() + time_budget
+        for port in self._remembered(host, start, end):
+            if is_port_free(host, port, self.probe_timeout):
+                self._remember(host, port)
+                return port
+            with self._lock:
+                self._free_ports.pop((host, port), None)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent) as executor:
+            for batch_start in range(start, end + 1, self.max_concurrent):
+                timeout = min(self.probe_timeout, deadline - monotonic())
+                if timeout <= 0:
+                    break
+                batch = range(
+                    batch_start, min(batch_start + self.max_concurrent, end + 1)
+                )
+                results = executor.map(
+                    lambda port: is_port_free(host, port, timeout), batch
+                )
+                free_ports = [port for port, free in zip(batch, results) if free]
+                for port in free_ports:
+                    self._remember(host, port)
+                if free_ports:
+                    return free_ports[0]
+        return None
+
+
+_port_finder = PortFinder()
+
+
+def find_free_port(host, start=DEFAULT_START_PORT, time_budget=SEARCH_TIME_BUDGET):
+    return _port_finder.find_free_port(host, start, time_budget=time_budget)
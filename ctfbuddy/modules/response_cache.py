@@ -0,0 +1,94 @@
+import json
+from hashlib import sha256
+from os import path
+from threading import Lock
+from time import time
+
+from modules.config import CACHE_DIR
+from modules.sqlite_cache import connect_cache_db, evict_expired_and_lru
+
+RESPONSE_CACHE_PATH = path.join(CACHE_DIR, "responses.sqlite3")
+DEFAULT_TTL = 7 * 24 * 60 * 60  # seconds
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Persistent SQLite cache of generated responses keyed by model name and the exact message history sent.
+
+    Because the history includes the rendered system prompt and every previous turn, a cached entry is only
+    reused when the whole conversation prefix is identical. Entries expire after `ttl` seconds, and the least
+    recently used ones are evicted once the cache holds more than `max_bytes` of responses.
+    """
+
+    def __init__(
+        self, db_path=RESPONSE_CACHE_PATH, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+
+        self._conn = connect_cache_db(db_path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model_name TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_accessed ON responses (last_accessed)"
+        )
+
+    @staticmethod
+    def make_key(model_name, message_history):
+        return sha256(
+            json.dumps([model_name, message_history], ensure_ascii=False).encode()
+        ).hexdigest()
+
+    def get(self, key):
+        now = time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            response, created_at = row
+            if now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE responses SET last_accessed = ? WHERE key = ?", (now, key)
+            )
+        return response
+
+    def put(self, key, model_name, response):
+        now = time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, len(response.encode()), now, now),
+            )
+            evict_expired_and_lru(
+                self._conn, "responses", "created_at", self.ttl, self.max_bytes, now
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+
+
+_response_cache = None
+_response_cache_lock = Lock()
+
+
+def get_response_cache():
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
@@ -0,0 +1,288 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Lock
+from time import monotonic
+from typing import Optional
+
+import httpx
+import ollama
+
+from modules.scheduler import get_scheduler
+
+MAX_KEEPALIVE_CONNECTIONS = 16
+MAX_CONNECTIONS = 64
+KEEPALIVE_EXPIRY = 120  # seconds, long enough to span the pauses between solve steps
+HEALTH_CHECK_INTERVAL = 10  # seconds
+HEALTH_CHECK_TIMEOUT = 2  # seconds
+FAILURE_COOLDOWN = 30  # seconds before a failed backend is probed again
+
+
+def _pool_limits():
+    return httpx.Limits(
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        max_connections=MAX_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _base_model_name(model_name):
+    return model_name.split(":", 1)[0]
+
+
+def is_backend_failure(e):
+    return isinstance(e, httpx.TransportError) or (
+        isinstance(e, ollama.ResponseError) and e.status_code >= 500
+    )
+
+
+@dataclass(eq=False)
+class Backend:
+    name: str
+    url: str
+    weight: float = 1.0
+    models: Optional[frozenset] = None  # None means any model
+    healthy: bool = True
+    failed_at: Optional[float] = None
+    checked_at: Optional[float] = None
+    loaded_models: frozenset = frozenset()
+    active_sessions: int = 0
+    _client: Optional[ollama.Client] = field(default=None, repr=False)
+    _async_clients: dict = field(default_factory=dict, repr=False)
+    _http: Optional[httpx.Client] = field(default=None, repr=False)
+
+    def hosts(self, model_name):
+        return self.models is None or _base_model_name(model_name) in self.models
+
+    def has_loaded(self, model_name):
+        return _base_model_name(model_name) in self.loaded_models
+
+    @property
+    def client(self):
+        # Shared, pooled client with keep-alive connections
+        if self._client is None:
+            self._client = ollama.Client(self.url, limits=_pool_limits())
+        return self._client
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        if (client := self._async_clients.get(loop)) is None:
+            client = self._async_clients[loop] = ollama.AsyncClient(
+                self.url, limits=_pool_limits()
+            )
+        return client
+
+    @property
+    def http(self):
+        # Pooled client for endpoints `ollama.Client` does not wrap
+        if self._http is None:
+            self._http = httpx.Client(
+                base_url=self.url, limits=_pool_limits(), timeout=None
+            )
+        return self._http
+
+    @property
+    def scheduler(self):
+        return get_scheduler(self.url)
+
+
+class OllamaRouter:
+    """
+    Spreads OllamaChat sessions over a pool of Ollama backends.
+
+    A session is bound to one backend for its whole life, chosen among healthy backends that host the model,
+    preferring ones that already have it loaded and then the highest weight per active session. Backends are
+    probed through `/api/ps` at most every `health_check_interval` seconds. When a request fails with a
+    connection error or a server error before any output is produced, the backend is marked unhealthy and the
+    session moves to another backend.
+    """
+
+    def __init__(
+        self,
+        backends,
+        health_check_interval=HEALTH_CHECK_INTERVAL,
+        health_check_timeout=HEALTH_CHECK_TIMEOUT,
+    ):
+        if not backends:
+            raise ValueError("At least one Ollama backend is required")
+        self.backends = list(backends)
+        self.health_check_interval = health_check_interval
+        self.health_check_timeout = health_check_timeout
+        self._lock = Lock()
+        self._refreshed_at = None
+
+    def _probe(self, backend):
+        now = monotonic()
+        if (
+            not backend.healthy
+            and backend.failed_at
+            and now - backend.failed_at < FAILURE_COOLDOWN
+        ):
+            return
+        try:
+            res = httpx.get(
+                f"{backend.url.rstrip('/')}/api/ps", timeout=self.health_check_timeout
+            )
+            res.raise_for_status()
+            loaded_models = frozenset(
+                _base_model_name(model["name"])
+                for model in res.json().get("models") or []
+            )
+        except (httpx.HTTPError, ValueError):
+            backend.healthy = False
+            backend.failed_at = now
+        else:
+            backend.healthy = True
+            backend.failed_at = None
+            backend.loaded_models = loaded_models
+        backend.checked_at = now
+
+    def refresh(self, force=False):
+        now = monotonic()
+        with self._lock:
+            if (
+                not force
+                and self._refreshed_at
+                and now - self._refreshed_at < self.health_check_interval
+            ):
+                return
+            self._refreshed_at = now
+        with ThreadPoolExecutor(max_workers=len(self.backends)) as executor:
+            list(executor.map(self._probe, self.backends))
+
+    def mark_failed(self, backend):
+        with self._lock:
+            backend.healthy = False
+            backend.failed_at = monotonic()
+
+    def choose(self, model_name, exclude=()):
+        self.refresh()
+        with self._lock:
+            candidates = [
+                backend
+                for backend in self.backends
+                if backend.hosts(model_name) and backend not in exclude
+            ]
+            if not candidates:
+                raise ValueError(f"No Ollama backend hosts {model_name}")
+
+            # Fall back to unhealthy backends rather than failing outright; they may have recovered.
+            healthy = [backend for backend in candidates if backend.healthy]
+            return max(
+                healthy or candidates,
+                key=lambda backend: (
+                    backend.has_loaded(model_name),
+                    backend.weight / (backend.active_sessions + 1),
+                ),
+            )
+
+    def _attach(self, backend):
+        with self._lock:
+            backend.active_sessions += 1
+
+    def _detach(self, backend):
+        with self._lock:
+            backend.active_sessions -= 1
+
+    def session(self, model_name):
+        return RoutedSession(self, model_name)
+
+    def async_session(self, model_name):
+        return AsyncRoutedSession(self, model_name)
+
+
+class _RoutedSessionBase:
+    def __init__(self, router, model_name):
+        self.router = router
+        self.model_name = model_name
+        self.backend = None
+        self._bind(router.choose(model_name))
+
+    def __del__(self):
+        if self.backend:
+            self.router._detach(self.backend)
+
+    def _bind(self, backend):
+        if self.backend:
+            self.router._detach(self.backend)
+        self.router._attach(backend)
+        self.backend = backend
+
+    def _fail_over(self, tried):
+        self.router.mark_failed(self.backend)
+        tried.add(self.backend)
+        try:
+            self._bind(self.router.choose(self.model_name, exclude=tried))
+        except ValueError:
+            return False
+        return True
+
+    @property
+    def scheduler(self):
+        return self.backend.scheduler
+
+
+class RoutedSession(_RoutedSessionBase):
+    """
+    Client-like handle for one session: `chat` goes to the session's backend and fails over on backend errors.
+    """
+
+    def chat(self, **kwargs):
+        tried = set()
+        while True:
+            try:
+                res = self.backend.client.chat(**kwargs)
+                if not kwargs.get("stream"):
+                    return res
+                # Streaming errors surface on the first chunk, so fetch it before committing to this backend.
+                first_chunk = next(res)
+                return self._chain(first_chunk, res)
+            except Exception as e:
+                if not is_backend_failure(e) or not self._fail_over(tried):
+                    raise
+
+    @staticmethod
+    def _chain(first_chunk, res):
+        yield first_chunk
+        yield from res
+
+    def post(self, endpoint, payload, timeout=None):
+        """
+        POSTs `payload` as JSON to an Ollama API endpoint on the session's backend and returns the decoded response.
+        """
+        tried = set()
+        while True:
+            try:
+                res = self.backend.http.post(endpoint, json=payload, timeout=timeout)
+                if res.status_code >= 500:
+                    raise ollama.ResponseError(res.text, res.status_code)
+                res.raise_for_status()
+                return res.json()
+            except Exception as e:
+                if not is_backend_failure(e) or not self._fail_over(tried):
+                    raise
+
+
+class AsyncRoutedSession(_RoutedSessionBase):
+    """
+    Async client-like handle for one session: `chat` goes to the session's backend and fails over on backend errors.
+    """
+
+    async def chat(self, **kwargs):
+        tried = set()
+        while True:
+            try:
+                res = await self.backend.async_client().chat(**kwargs)
+                if not kwargs.get("stream"):
+                    return res
+                first_chunk = await res.__anext__()
+                return self._chain(first_chunk, res)
+            except Exception as e:
+                if not is_backend_failure(e) or not self._fail_over(tried):
+                    raise
+
+    @staticmethod
+    async def _chain(first_chunk, res):
+        yield first_chunk
+        async for chunk in res:
+            yield chunk
@@ -0,0 +1,281 @@
+import asyncio
+from collections import Counter, OrderedDict, deque
+from itertools import count
+from statistics import mean, quantiles
+from threading import Event, Lock
+from time import monotonic
+
+from modules.config import CONFIG_STORE, get_config
+
+DEFAULT_MAX_CONCURRENT_GENERATIONS = 2
+DEFAULT_MAX_LOADED_MODELS = 1
+MAX_SAME_MODEL_BATCH = 4
+POSITION_POLL_INTERVAL = 1.0  # seconds
+WAIT_TIME_SAMPLES = 1000
+
+
+class Ticket:
+    def __init__(self, session_id, model_name, seq):
+        self.session_id = session_id
+        self.model_name = model_name
+        self.seq = seq
+        self.enqueued_at = monotonic()
+        self.granted_at = None
+        self.released = False
+        self.position = None
+        self._event = Event()
+        self._waiters = []
+
+    @property
+    def granted(self):
+        return self.granted_at is not None
+
+    @property
+    def wait_time(self):
+        return (self.granted_at or monotonic()) - self.enqueued_at
+
+    def _grant(self):
+        self.granted_at = monotonic()
+        self.position = 0
+        self._event.set()
+        for loop, future in self._waiters:
+            loop.call_soon_threadsafe(
+                lambda future=future: future.done() or future.set_result(None)
+            )
+
+
+class GenerationScheduler:
+    """
+    Admission control in front of one Ollama server.
+
+    Every generation takes a ticket and waits for one of `max_concurrent` slots. Each session has its own
+    queue and only the oldest ticket of each session competes for a slot, taken round-robin, so one user
+    cannot crowd out the others. Tickets for a model that is already generating are preferred, and at
+    most `max_loaded_models` different models generate at once, so Ollama does not keep swapping models;
+    after `max_same_model_batch` consecutive grants while other models wait, the next model gets a turn.
+
+    A session reserved with `reserve_for_session`, such as one model of a race, is admitted under raised
+    limits, so the models of a race generate side by side instead of one after another.
+    """
+
+    def __init__(
+        self,
+        max_concurrent=DEFAULT_MAX_CONCURRENT_GENERATIONS,
+        max_loaded_models=DEFAULT_MAX_LOADED_MODELS,
+        max_same_model_batch=MAX_SAME_MODEL_BATCH,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_loaded_models = max_loaded_models
+        self.max_same_model_batch = max_same_model_batch
+
+        self._lock = Lock()
+        self._seq = count()
+        self._queues = OrderedDict()  # session ID -> deque of waiting tickets
+        self._running = Counter()  # model name -> number of running generations
+        self._last_model = None
+        self._batch_count = 0
+        self._reservations = {}  # session ID -> (max_concurrent, max_loaded_models)
+
+        self._wait_times = deque(maxlen=WAIT_TIME_SAMPLES)
+        self._no_granted = 0
+        self._no_model_swaps = 0
+
+    def submit(self, session_id, model_name):
+        with self._lock:
+            ticket = Ticket(session_id, model_name, next(self._seq))
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            self._schedule()
+        return ticket
+
+    def set_limits(self, max_concurrent=None, max_loaded_models=None):
+        """
+        Changes the limits, granting waiting tickets straight away if they were raised. A limit left as None is kept.
+        """
+        with self._lock:
+            if max_concurrent is not None:
+                self.max_concurrent = max_concurrent
+            if max_loaded_models is not None:
+                self.max_loaded_models = max_loaded_models
+            self._schedule()
+
+    def reserve_for_session(self, session_id, max_concurrent, max_loaded_models):
+        """
+        Lets the session's generations run while fewer than `max_concurrent` generations and, counting its own
+        model, at most `max_loaded_models` different models are running, where those are above the usual limits.
+        """
+        with self._lock:
+            self._reservations[session_id] = (max_concurrent, max_loaded_models)
+            self._schedule()
+
+    def end_reservation(self, session_id):
+        with self._lock:
+            self._reservations.pop(session_id, None)
+
+    def _limits(self, ticket):
+        max_concurrent, max_loaded_models = self._reservations.get(
+            ticket.session_id, (0, 0)
+        )
+        return max(max_concurrent, self.max_concurrent), max(
+            max_loaded_models, self.max_loaded_models
+        )
+
+    def _pick(self):
+        heads = [queue[0] for queue in self._queues.values()]
+        if not heads:
+            return None
+
+        no_running = sum(self._running.values())
+        running_models = {model for model, n in self._running.items() if n}
+        others_waiting = any(ticket.model_name != self._last_model for ticket in heads)
+        if self._batch_count < self.max_same_model_batch or not others_waiting:
+            for ticket in heads:
+                if no_running >= self._limits(ticket)[0]:
+                    continue
+                if ticket.model_name in running_models or (
+                    not running_models and ticket.model_name == self._last_model
+                ):
+                    return ticket
+
+        for ticket in heads:
+            if ticket.model_name == self._last_model and others_waiting:
+                continue
+            max_concurrent, max_loaded_models = self._limits(ticket)
+            if (
+                no_running < max_concurrent
+                and len(running_models | {ticket.model_name}) <= max_loaded_models
+            ):
+                return ticket
+        return None
+
+    def _schedule(self):
+        while True:
+            ticket = self._pick()
+            if ticket is None:
+                break
+
+            queue = self._queues.pop(ticket.session_id)
+            queue.popleft()
+            if queue:
+                # Back of the round-robin order
+                self._queues[ticket.session_id] = queue
+
+            if ticket.model_name == self._last_model:
+                self._batch_count += 1
+            else:
+                if self._last_model is not None:
+                    self._no_model_swaps += 1
+                self._last_model = ticket.model_name
+                self._batch_count = 1
+
+            self._running[ticket.model_name] += 1
+            self._no_granted += 1
+            ticket._grant()
+            self._wait_times.append(ticket.wait_time)
+
+        waiting = sorted(
+            (ticket for queue in self._queues.values() for ticket in queue),
+            key=lambda ticket: ticket.seq,
+        )
+        for position, ticket in enumerate(waiting, start=1):
+            ticket.position = position
+
+    def wait(self, ticket, timeout=None):
+        return ticket._event.wait(timeout)
+
+    async def wait_async(self, ticket, poll_interval=POSITION_POLL_INTERVAL):
+        """
+        Waits for `ticket` to be granted a slot, yielding its queue position every `poll_interval` seconds meanwhile.
+        """
+        if ticket.granted:
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._lock:
+            ticket._waiters.append((loop, future))
+            if ticket.granted:
+                future.set_result(None)
+
+        try:
+            while not future.done():
+                yield ticket.position
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self.release(ticket)
+            raise
+
+    def release(self, ticket):
+        """
+        Frees the ticket's slot, or takes it out of the queue if it has not been granted yet. Safe to call more than once.
+        """
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+
+            if ticket.granted:
+                self._running[ticket.model_name] -= 1
+            elif (queue := self._queues.get(ticket.session_id)) and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self._queues[ticket.session_id]
+            self._schedule()
+
+    def stats(self):
+        with self._lock:
+            wait_times = list(self._wait_times)
+            return {
+                "queue_depth": sum(len(queue) for queue in self._queues.values()),
+                "waiting_sessions": len(self._queues),
+                "running": sum(self._running.values()),
+                "max_concurrent": self.max_concurrent,
+                "granted": self._no_granted,
+                "model_swaps": self._no_model_swaps,
+                "mean_wait": mean(wait_times) if wait_times else 0.0,
+                "p95_wait": (
+                    quantiles(wait_times, n=20)[-1]
+                    if len(wait_times) > 1
+                    else (wait_times[0] if wait_times else 0.0)
+                ),
+            }
+
+
+_schedulers = {}
+_schedulers_lock = Lock()
+
+
+def _limits_from_config(config):
+    return (
+        config.ollama_num_parallel or DEFAULT_MAX_CONCURRENT_GENERATIONS,
+        config.ollama_max_loaded_models or DEFAULT_MAX_LOADED_MODELS,
+    )
+
+
+def _on_config_change(old_config, new_config):
+    limits = _limits_from_config(new_config)
+    if limits == _limits_from_config(old_config):
+        return
+    with _schedulers_lock:
+        schedulers = list(_schedulers.values())
+    for scheduler in schedulers:
+        scheduler.set_limits(*limits)
+
+
+CONFIG_STORE.subscribe(_on_config_change)
+
+
+def get_scheduler(host_url):
+    """
+    Returns the process-wide scheduler for the Ollama server at `host_url`.
+
+    Its limits are `ollama_num_parallel` and `ollama_max_loaded_models` from config.ini (or the Ollama server's
+    OLLAMA_NUM_PARALLEL and OLLAMA_MAX_LOADED_MODELS environment variables), and follow changes to them.
+    """
+    limits = _limits_from_config(get_config())
+    with _schedulers_lock:
+        if (scheduler := _schedulers.get(host_url)) is None:
+            scheduler = _schedulers[host_url] = GenerationScheduler(*limits)
+        return scheduler
@@ -0,0 +1,40 @@
+import sqlite3
+from os import makedirs, path
+
+
+def connect_cache_db(db_path):
+    """
+    Opens a SQLite cache database in autocommit and WAL mode, creating its directory if needed.
+
+    The connection may be used from any thread, so callers serialise access with their own lock.
+    """
+    makedirs(path.dirname(db_path), exist_ok=True)
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def evict_expired_and_lru(conn, table, created_column, max_age, max_bytes, now):
+    """
+    Deletes the rows of `table` whose `created_column` is more than `max_age` seconds before `now`, then the least
+    recently used rows until the rest hold at most `max_bytes`.
+
+    `table` must have `key`, `size` and `last_accessed` columns.
+    """
+    conn.execute(f"DELETE FROM {table} WHERE {created_column} < ?", (now - max_age,))
+    (total_size,) = conn.execute(
+        f"SELECT COALESCE(SUM(size), 0) FROM {table}"
+    ).fetchone()
+    if total_size <= max_bytes:
+        return
+
+    excess = total_size - max_bytes
+    evicted_keys = []
+    for key, size in conn.execute(
+        f"SELECT key, size FROM {table} ORDER BY last_accessed"
+    ).fetchall():
+        evicted_keys.append((key,))
+        excess -= size
+        if excess <= 0:
+            break
+    conn.executemany(f"DELETE FROM {table} WHERE key = ?", evicted_keys)
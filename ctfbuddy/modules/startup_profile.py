@@ -0,0 +1,94 @@
+import re
+import subprocess
+import sys
+from dataclasses import dataclass
+from os import path
+
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+# Only needed once a tab is used, so importing any of them at startup is a regression
+LAZY_MODULES = (
+    "transformers",
+    "tokenizers",
+    "chromadb",
+    "langchain_community",
+    "semantic_text_splitter",
+    "bs4",
+)
+
+
+@dataclass
+class ImportTiming:
+    module: str
+    self_time: float  # seconds
+    cumulative_time: float  # seconds
+    depth: int
+
+
+def profile_imports(module="main") -> list[ImportTiming]:
+    """
+    Imports `module` in a fresh interpreter under `python -X importtime` and parses the timings it reports.
+    """
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        cwd=path.dirname(path.dirname(__file__)),
+    )
+    if res.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{res.stderr[-2000:]}")
+
+    timings = []
+    for line in res.stderr.splitlines():
+        if match := IMPORTTIME_LINE.match(line):
+            timings.append(
+                ImportTiming(
+                    match[4],
+                    int(match[1]) / 1e6,
+                    int(match[2]) / 1e6,
+                    (len(match[3]) - 1) // 2,
+                )
+            )
+    return timings
+
+
+def format_import_profile(timings, module="main", top=20) -> str:
+    """
+    Renders the time taken to import `module`, its slowest direct imports (with everything they import) and the
+    slowest modules on their own, and flags heavy modules that should only load once a tab is used.
+    """
+    root_index = max(
+        i
+        for i, timing in enumerate(timings)
+        if timing.depth == 0 and timing.module == module
+    )
+    direct_imports = []
+    for timing in reversed(timings[:root_index]):
+        if timing.depth == 0:
+            break
+        if timing.depth == 1:
+            direct_imports.append(timing)
+    lines = [
+        f"Importing {module} took {timings[root_index].cumulative_time:.3f}s",
+        "",
+        f"{'cumulative':>10}  {'self':>8}  direct import",
+    ]
+    for timing in sorted(direct_imports, key=lambda t: t.cumulative_time, reverse=True)[
+        :top
+    ]:
+        lines.append(
+            f"{timing.cumulative_time:>9.3f}s  {timing.self_time:>7.3f}s  {timing.module}"
+        )
+
+    lines += ["", f"{'self':>10}  {'depth':>8}  module"]
+    for timing in sorted(timings, key=lambda t: t.self_time, reverse=True)[:top]:
+        lines.append(f"{timing.self_time:>9.3f}s  {timing.depth:>8}  {timing.module}")
+
+    imported = {timing.module.split(".")[0] for timing in timings}
+    eager = [module for module in LAZY_MODULES if module in imported]
+    lines.append("")
+    lines.append(
+        f"Imported at startup but only needed later: {', '.join(eager)}"
+        if eager
+        else "No heavy modules are imported at startup."
+    )
+    return "\n".join(lines)
@@ -1,21 +1,31 @@
-from time import time
-
-import gradio as gr
-from langchain_core.runnables import RunnablePassthrough
-from langchain_core.output_parsers import StrOutputParser
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_community.chat_models import ChatOllama
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
 import modules.logging as log
-from modules.host import HOST_URL, HOST
+from modules.config import get_config, gradio_assert_config_exists
+from modules.host import get_host
+from modules.hybrid_retrieval import DEFAULT_K, format_context
+from modules.moderate import check_moderation, moderate
+from modules.ollama_chat import OllamaChat
+from modules.response_cache import get_response_cache
 from modules.study_chatbot.surf_web import (
-    gen_queries,
-    search,
-    make_vectorstore_retriever,
+    make_hybrid_retriever,
+    search_and_index,
+    stream_queries,
 )
-from modules.latent_space_activation.technique01_dialog import lsa_query
-from modules.moderate import moderate, check_moderation
-from modules.config import CONFIG
+from modules.timing import TimingTrace
+from modules.warmup import get_warmup_manager
+from modules.web_cache import get_web_cache
+
+AUTOSURFER_SYSTEM_PROMPT = """You are a helpful assistant for CTF (capture the flag) players.
+Answer the user's question using the numbered context passages in their message where they are relevant, and cite them like [1].
+If the context does not contain the answer, say so and answer from your own knowledge, making clear which parts are not backed by the context."""
+
+
+def format_rag_prompt(prompt: str, context: str) -> str:
+    if not context:
+        return f"Context: Nil\n\nQuestion: {prompt}"
+    return f"Context:\n{context}\n\nQuestion: {prompt}"
 
 
 def gen_response(
@@ -24,121 +34,104 @@ def gen_response(
     moderator_on: bool,
     prompt: str,
     chat_history: list[list[str | None | tuple]],
-) -> tuple[str, list[list[str | None | tuple]]]:
-    if moderator_on:
-        log.log_info("Autosurfer", "Checking prompt for moderation issues")
+) -> Iterator[tuple[str, list[list[str | None | tuple]], str]]:
+    """
+    Answers the prompt from the study chatbot's index, yielding the chat history and a timing table each time more
+    of the answer has streamed in.
+
+    In online mode the index is first topped up from the web, with the stages overlapping: the prompt is moderated
+    while the search queries are generated, each query is searched as soon as its line is generated, and each page
+    is chunked and embedded as soon as it is scraped. No query is searched until the prompt has passed moderation.
+    Offline mode answers from the chunks indexed by earlier searches.
+    """
+    if online_mode:
+        gradio_assert_config_exists()
+    trace = TimingTrace("Autosurfer")
 
-        start_time = time()
-        check_moderation("Autosurfer", moderate(prompt))
-        end_time = time()
+    def moderate_prompt():
+        with trace.stage("Moderate prompt"):
+            return moderate(prompt)
 
-        log.log_info(
-            "Autosurfer",
-            f"Checked prompt for moderation issues ({round(end_time-start_time, 2)}s)",
-        )
+    moderation_executor = ThreadPoolExecutor(max_workers=1)
+    if moderator_on:
+        log.log_info("Autosurfer", "Checking prompt for moderation issues")
+        prompt_moderation = moderation_executor.submit(moderate_prompt)
     else:
         log.log_warning("Autosurfer", "Moderation is disabled. Use at your own risk!")
-
-    response_start_time = time()
-    if online_mode:
-        log.log_info("Autosurfer", "Generating search queries")
-
-        start_time = time()
-        queries = gen_queries(prompt)
-        end_time = time()
-
-        log.log_info(
-            "Autosurfer",
-            f"Generated {len(queries)} search queries ({round(end_time-start_time, 2)}s)",
-        )
-
-        len_queries = len(queries)
-        for i, query in enumerate(queries, start=1):
-            log.log_info("Autosurfer", f"Query {i}/{len_queries}: {query}")
-
-        log.log_info("Autosurfer", "Searching web")
-
-        start_time = time()
-        search_docs = search(
-            CONFIG["google_api_key"], CONFIG["google_prog_search_engine_id"], queries
-        )
-        end_time = time()
-        log.log_info("Autosurfer", f"Searched web ({round(end_time-start_time, 2)}s)")
-
-        start_time = time()
-        log.log_info("Autosurfer", "Processing search results...")
-        retriever = make_vectorstore_retriever(search_docs)
-        end_time = time()
-        log.log_info(
-            "Autosurfer", f"Processed search results ({round(end_time-start_time, 2)}s)"
-        )
-
-        model_local = ChatOllama(
-            model=f"guardrailed_{autosurfer_model}", base_url=HOST_URL
+        prompt_moderation = None
+
+    def check_prompt_moderation():
+        nonlocal prompt_moderation
+        if prompt_moderation:
+            check_moderation("Autosurfer", prompt_moderation.result())
+            prompt_moderation = None
+
+    def moderated_queries():
+        span = trace.begin("Generate queries")
+        no_queries = 0
+        for no_queries, query in enumerate(stream_queries(prompt), start=1):
+            check_prompt_moderation()
+            trace.mark(f"Query {no_queries}", query=query)
+            yield query
+        trace.end(span, queries=no_queries)
+
+    try:
+        if online_mode:
+            log.log_info("Autosurfer", "Searching web")
+            with trace.stage("Search and index") as span:
+                no_pages, no_new_chunks = search_and_index(
+                    get_config().google_api_key,
+                    get_config().google_prog_search_engine_id,
+                    moderated_queries(),
+                    # The retriever keeps at most DEFAULT_K chunks, so more pages than that cannot all be used
+                    max_docs=DEFAULT_K,
+                    web_cache=get_web_cache(),
+                )
+                span.details.update(pages=no_pages, new_chunks=no_new_chunks)
+        check_prompt_moderation()
+
+        with trace.stage("Retrieve") as span:
+            docs = make_hybrid_retriever().invoke(prompt)
+            span.details["chunks"] = len(docs)
+
+        ollama_chat = OllamaChat(
+            get_host(),
+            autosurfer_model,
+            AUTOSURFER_SYSTEM_PROMPT,
+            response_cache=get_response_cache(),
+            warmup_manager=get_warmup_manager(),
         )
-        question = prompt
-        after_rag_template = """Answer the question based only on the following context:
-        {context}
-        Question: {question}
-        """
-        after_rag_prompt = ChatPromptTemplate.from_template(after_rag_template)
-        after_rag_chain = (
-            {"context": retriever, "question": RunnablePassthrough()}
-            | after_rag_prompt
-            | model_local
-            | StrOutputParser()
+        for user_message, assistant_message in chat_history:
+            if isinstance(user_message, str) and isinstance(assistant_message, str):
+                ollama_chat.append_message("user", user_message)
+                ollama_chat.append_message("assistant", assistant_message)
+        ollama_chat.append_message(
+            "user", format_rag_prompt(prompt, format_context(docs))
         )
 
-        log.log_info("Answering question using RAG")
-
-        start_time = time()
-        answer = after_rag_chain.invoke(question)
-        end_time = time()
-
-        log.log_info(
-            "Autosurfer", f"Answered question ({round(end_time-start_time, 2)}s)"
-        )
-    else:
+        chat_history.append([prompt, ""])
+        log.log_info("Autosurfer", "Answering question")
         answer = ""
-
-        log.log_info("Autosurfer", "Answering question using LSA")
-
-        start_time = time()
-        for message in enumerate(
-            lsa_query(
-                prompt, model=f"guardrailed_{autosurfer_model}", chatbot=HOST.chat
-            )
-        ):
-            if message[0] % 2 == 0:
-                log.log_info(
-                    "Autosurfer", f'INTERROGATOR sent \'{message[1]["content"]}\''
+        with trace.stage("Answer"):
+            for answer in ollama_chat.invoke_and_append_generated_message(stream=True):
+                if not chat_history[-1][1]:
+                    trace.mark("First token")
+                chat_history[-1][1] = answer
+                yield "", chat_history, trace.format_markdown()
+
+        if moderator_on:
+            with trace.stage("Moderate answer"):
+                check_moderation(
+                    "Autosurfer",
+                    moderate(answer, prompt),
+                    raise_error_if_moderated=False,
                 )
-                answer += f'\n\nINTERROGATOR: {message[1]["content"]}'
-            else:
-                answer += f'\n\nCHATBOT:\n{message[1]["content"]}'
-        end_time = time()
-
-        log.log_info(
-            "Autosurfer", f"Answered question ({round(end_time-start_time, 2)}s)"
-        )
-
-    if moderator_on:
-        log.log_info("Autosurfer", "Checking answer for moderation issues")
-
-        start_time = time()
-        check_moderation("Autosurfer", moderate(answer), raise_error_if_moderated=False)
-        end_time = time()
-
-        log.log_info(
-            "Autosurfer",
-            f"Checked answer for moderation issues ({round(end_time-start_time, 2)}s)",
-        )
-
-    response_end_time = time()
+    finally:
+        moderation_executor.shutdown(wait=False)
 
     log.log_info(
         "Autosurfer",
-        f"Finished generating response ({round(response_end_time-response_start_time, 2)}s)",
+        f"Finished generating response ({round(trace.total(), 2)}s)",
+        debug_only=True,
     )
-    chat_history.append((prompt, answer))
-    return "", chat_history
+    yield "", chat_history, trace.format_markdown()
@@ -1,79 +1,439 @@
+import re
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from typing import Iterable, Iterator
+from urllib.parse import urldefrag, urlparse
+
 import gradio as gr
 import requests
+from bs4 import BeautifulSoup
 
 from langchain_core.documents import Document
-from langchain_core.vectorstores import VectorStoreRetriever
-from langchain_community.document_loaders import WebBaseLoader
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings.ollama import OllamaEmbeddings
-from langchain.text_splitter import CharacterTextSplitter
 
 import modules.logging as log
-from modules.host import HOST, HOST_URL
+from modules.chunking import DEFAULT_CHUNK_OVERLAP, DEFAULT_CHUNK_SIZE, Chunker
+from modules.host import get_host
+from modules.metrics import WEB_REQUEST_DURATION
+from modules.hybrid_retrieval import (
+    DEFAULT_CONTEXT_TOKEN_BUDGET,
+    DEFAULT_K,
+    HybridRetriever,
+    OllamaReranker,
+)
+from modules.vector_index import get_vector_index
+from modules.web_cache import WebCache, format_hit_rates
+
+SEARCH_API_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_TIMEOUT = 10  # seconds
+FETCH_TIMEOUT = (5, 10)  # seconds to connect, seconds between bytes
+MAX_SEARCH_WORKERS = 8
+MAX_FETCH_WORKERS = 16
+MAX_FETCHES_PER_HOST = 2
+DOCS_PER_QUERY = 2
+USER_AGENT = "Mozilla/5.0 (compatible; CTFBuddy)"
+QUERY_GENERATOR_MODEL = "phi3"
+MAX_QUERIES = 4
+
+QUERY_GENERATOR_SYSTEM_PROMPT = f"""You write Google search queries that find the information needed to answer a prompt about CTF challenges and cyber security.
+Write at most {MAX_QUERIES} short queries, one per line, each wrapped in double quotes. Keep exact terms from the prompt such as CVE IDs, function names, ciphers and constants. Do not write anything else."""
+# Optional list marker, then the query with or without its quotes
+QUERY_LINE_PATTERN = re.compile(r'\s*(?:[-*]|\d+[.)])?\s*"?(.*?)"?\s*$')
+
+
+def parse_query_line(line: str) -> str:
+    return QUERY_LINE_PATTERN.match(line).group(1).strip()
+
+
+def stream_queries(
+    prompt: str, model_name: str = QUERY_GENERATOR_MODEL
+) -> Iterator[str]:
+    """
+    Yields each search query as soon as the query generator finishes its line.
+    """
+    stream = (
+        get_host()
+        .session(model_name)
+        .chat(
+            model=model_name,
+            messages=[
+                {"role": "system", "content": QUERY_GENERATOR_SYSTEM_PROMPT},
+                {"role": "user", "content": f"Prompt: {prompt}\n\nQueries:"},
+            ],
+            options={"temperature": 0},
+            stream=True,
+        )
+    )
+
+    line = ""
+    no_queries = 0
+    for chunk in stream:
+        line += chunk["message"]["content"]
+        *finished_lines, line = line.split("\n")
+        for finished_line in finished_lines:
+            if query := parse_query_line(finished_line):
+                yield query
+                no_queries += 1
+                if no_queries >= MAX_QUERIES:
+                    return
+    if query := parse_query_line(line):
+        yield query
 
 
 def gen_queries(prompt: str) -> list[str]:
-    queries_str = HOST.chat(
-        model="search_query_generator",
-        messages=[{"role": "user", "content": f"Prompt: {prompt}\n\nQueries:"}],
-        stream=False,
-    )["message"]["content"]
-
-    splitted_queries = queries_str.split("\n")
-
-    queries = []
-    for splitted_query in splitted_queries:
-        if splitted_query:
-            query = splitted_query.strip()[1:-1]
-            queries.append(query)
-
-    return queries
-
-
-def search(api_key: str, search_engine_id: str, queries: list[str]) -> list[Document]:
-    search_docs = []
-    for query in queries:
-        log.log_info("Autosurfer", f"Searching for '{query}'...")
-        search_res = requests.get(
-            "https://www.googleapis.com/customsearch/v1",
-            params={
-                "key": api_key,
-                "cx": search_engine_id,
-                "q": query,
-            },
-        ).json()
-
-        search_links = [item["link"] for item in search_res["items"]]
-        scraped_links = []
-        for link in search_links:
-            try:
-                scraped_links.extend(WebBaseLoader(link).load())
-            except Exception as e:
-                log.log_warning(
-                    "Autosurfer", f"Encountered exception while scraping {link}: {e}"
-                )
+    return list(stream_queries(prompt))
+
+
+def normalise_url(url: str) -> str:
+    return urldefrag(url)[0].rstrip("/")
+
+
+def extract_text(html: str) -> tuple[str, str]:
+    """
+    Returns the title and visible text of an HTML page.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
+    title = soup.title.get_text(strip=True) if soup.title else ""
+    return title, soup.get_text()
+
+
+def make_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=MAX_FETCH_WORKERS, pool_maxsize=MAX_FETCH_WORKERS
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+def search_links(
+    session: requests.Session,
+    api_key: str,
+    search_engine_id: str,
+    query: str,
+    search_url: str = SEARCH_API_URL,
+    web_cache: WebCache | None = None,
+) -> list[str]:
+    if web_cache:
+        if (links := web_cache.get_search(search_engine_id, query)) is not None:
+            web_cache.record("search", "hit")
+            return links
+        web_cache.record("search", "miss")
+
+    start_time = perf_counter()
+    search_res = session.get(
+        search_url,
+        params={"key": api_key, "cx": search_engine_id, "q": query},
+        timeout=SEARCH_TIMEOUT,
+    )
+    WEB_REQUEST_DURATION.observe(perf_counter() - start_time, kind="search")
+    search_res.raise_for_status()
+    links = [item["link"] for item in search_res.json().get("items", [])]
+    if web_cache:
+        web_cache.put_search(search_engine_id, query, links)
+    return links
+
+
+class HostLimiter:
+    """
+    Caps how many requests run at once against each host.
+    """
+
+    def __init__(self, max_per_host: int = MAX_FETCHES_PER_HOST):
+        self.max_per_host = max_per_host
+        self._semaphores = {}
+        self._lock = Lock()
+
+    def __call__(self, url: str) -> BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if (semaphore := self._semaphores.get(host)) is None:
+                semaphore = self._semaphores[host] = BoundedSemaphore(self.max_per_host)
+            return semaphore
+
+
+def fetch_document(
+    session: requests.Session,
+    host_limiter: HostLimiter,
+    url: str,
+    web_cache: WebCache | None = None,
+) -> Document:
+    entry, fresh = web_cache.get_page(url) if web_cache else (None, False)
+    if fresh:
+        web_cache.record("page", "hit")
+        return Document(
+            page_content=entry.value["text"],
+            metadata={"source": url, "title": entry.value["title"]},
+        )
+
+    with host_limiter(url):
+        start_time = perf_counter()
+        res = session.get(
+            url, timeout=FETCH_TIMEOUT, headers=entry.validators() if entry else None
+        )
+        WEB_REQUEST_DURATION.observe(perf_counter() - start_time, kind="page")
+    if entry and res.status_code == 304:
+        web_cache.mark_page_revalidated(url)
+        web_cache.record("page", "revalidated")
+        return Document(
+            page_content=entry.value["text"],
+            metadata={"source": url, "title": entry.value["title"]},
+        )
+    res.raise_for_status()
+
+    content_type = res.headers.get("Content-Type", "text/html")
+    if "html" in content_type:
+        title, text = extract_text(res.text)
+    elif content_type.startswith("text/"):
+        title, text = "", res.text
+    else:
+        raise ValueError(f"Unsupported content type {content_type}")
+
+    if web_cache:
+        web_cache.record("page", "miss")
+        web_cache.put_page(
+            url,
+            title,
+            text,
+            res.headers.get("ETag"),
+            res.headers.get("Last-Modified"),
+        )
+    return Document(page_content=text, metadata={"source": url, "title": title})
+
+
+def iter_search(
+    api_key: str,
+    search_engine_id: str,
+    queries: Iterable[str],
+    docs_per_query: int = DOCS_PER_QUERY,
+    max_docs: int | None = None,
+    search_url: str = SEARCH_API_URL,
+    web_cache: WebCache | None = None,
+) -> Iterator[tuple[int, int, Document]]:
+    """
+    Searches each query as soon as `queries` yields it and scrapes up to `docs_per_query` pages per query in
+    parallel, yielding every page as soon as it is scraped.
+
+    `queries` may be lazy (e.g. lines streamed from a model); it is consumed on a worker thread. Each query keeps
+    `docs_per_query` of its result links in flight and moves on to its next link when one fails. Links already taken
+    by another query are skipped, at most `MAX_FETCHES_PER_HOST` requests hit any one host at once, and everything
+    stops as soon as `max_docs` pages are scraped. With a `web_cache`, search results and pages are reused from it
+    where possible.
+
+    Yields:
+        tuple: The index of the query that found the page, the page's rank in that query's results, and the page.
+    """
+    query_iter = iter(queries)
+    session = make_http_session()
+    host_limiter = HostLimiter()
+
+    seen_urls = set()
+    candidate_links = defaultdict(deque)  # query index -> (rank, link)s not tried yet
+    in_flight = defaultdict(int)  # query index -> fetches running
+    no_scraped = defaultdict(int)  # query index -> pages scraped
+    no_queries = 0
+    no_docs = 0
+
+    stats_before = web_cache.stats_snapshot() if web_cache else None
+
+    executor = ThreadPoolExecutor(
+        max_workers=1 + MAX_SEARCH_WORKERS + MAX_FETCH_WORKERS
+    )
+    pending = {}
+
+    def submit_next_query():
+        pending[executor.submit(next, query_iter, None)] = ("query", None, None, None)
+
+    def submit_fetches(i):
+        while candidate_links[i] and no_scraped[i] + in_flight[i] < docs_per_query:
+            rank, link = candidate_links[i].popleft()
+            if (url := normalise_url(link)) in seen_urls:
                 continue
-            else:
-                log.log_info("Autosurfer", f"Successfully scraped {link}")
-            if len(scraped_links) == 2:
-                break
+            seen_urls.add(url)
+            in_flight[i] += 1
+            pending[
+                executor.submit(fetch_document, session, host_limiter, link, web_cache)
+            ] = ("fetch", i, rank, link)
 
-        search_docs.extend(scraped_links)
+    try:
+        submit_next_query()
+        while pending and (max_docs is None or no_docs < max_docs):
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, i, rank, target = pending.pop(future)
+                if kind == "query":
+                    if (query := future.result()) is not None:
+                        log.log_info("Autosurfer", f"Searching for '{query}'...")
+                        pending[
+                            executor.submit(
+                                search_links,
+                                session,
+                                api_key,
+                                search_engine_id,
+                                query,
+                                search_url,
+                                web_cache,
+                            )
+                        ] = ("search", no_queries, None, query)
+                        no_queries += 1
+                        submit_next_query()
+                    continue
 
-    return search_docs
+                if kind == "search":
+                    try:
+                        candidate_links[i].extend(enumerate(future.result()))
+                    except Exception as e:
+                        log.log_warning(
+                            "Autosurfer",
+                            f"Encountered exception while searching for '{target}': {e}",
+                        )
+                else:
+                    in_flight[i] -= 1
+                    try:
+                        doc = future.result()
+                    except Exception as e:
+                        log.log_warning(
+                            "Autosurfer",
+                            f"Encountered exception while scraping {target}: {e}",
+                        )
+                    else:
+                        log.log_info("Autosurfer", f"Successfully scraped {target}")
+                        if max_docs is None or no_docs < max_docs:
+                            no_scraped[i] += 1
+                            no_docs += 1
+                            yield i, rank, doc
+                submit_fetches(i)
+    finally:
+        # Fetches still running once enough pages are in are left to finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
 
+    if web_cache:
+        log.log_info(
+            "Autosurfer",
+            f"Web cache: {format_hit_rates(web_cache.stats_snapshot() - stats_before)}",
+            debug_only=True,
+        )
 
-def make_vectorstore_retriever(search_docs: list[Document]) -> VectorStoreRetriever:
 
-    text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=7500, chunk_overlap=100
+def search(
+    api_key: str,
+    search_engine_id: str,
+    queries: list[str],
+    docs_per_query: int = DOCS_PER_QUERY,
+    max_docs: int | None = None,
+    search_url: str = SEARCH_API_URL,
+    web_cache: WebCache | None = None,
+) -> list[Document]:
+    """
+    Runs `iter_search` to completion.
+
+    Returns:
+        list[Document]: The scraped pages, grouped by query in the given order.
+    """
+    results = iter_search(
+        api_key,
+        search_engine_id,
+        queries,
+        docs_per_query,
+        max_docs,
+        search_url,
+        web_cache,
+    )
+    return [doc for _, _, doc in sorted(results, key=lambda result: result[:2])]
+
+
+def make_hybrid_retriever(
+    k: int = DEFAULT_K,
+    context_token_budget: int | None = DEFAULT_CONTEXT_TOKEN_BUDGET,
+    rerank_model: str | None = None,
+) -> HybridRetriever:
+    """
+    Returns a hybrid BM25 and vector retriever over everything indexed so far.
+
+    Args:
+        k (int): Maximum number of chunks to retrieve.
+        context_token_budget (int | None): Maximum number of tokens across the retrieved chunks.
+        rerank_model (str | None): Small local model that reranks the fused results, or None to skip reranking.
+    """
+    return HybridRetriever(
+        vector_index=get_vector_index(),
+        k=k,
+        context_token_budget=context_token_budget,
+        reranker=OllamaReranker(rerank_model) if rerank_model else None,
     )
-    doc_splits = text_splitter.split_documents(search_docs)
 
-    vectorstore = Chroma.from_documents(
-        documents=doc_splits,
-        collection_name="rag-chroma",
-        embedding=OllamaEmbeddings(model="nomic-embed-text", base_url=HOST_URL),
+
+def index_documents(docs: Iterable[Document], chunker: Chunker | None = None) -> int:
+    """
+    Chunks the documents and adds the chunks to the vector index.
+
+    Returns:
+        int: How many chunks were new.
+    """
+    doc_splits = list((chunker or Chunker()).split_documents(docs))
+
+    vector_index = get_vector_index()
+    no_new_chunks = vector_index.add_documents(doc_splits)
+    log.log_info(
+        "Autosurfer",
+        f"Indexed {no_new_chunks} new of {len(doc_splits)} chunks ({vector_index.count()} in index)",
+        debug_only=True,
     )
+    if no_new_chunks:
+        log.log_info(
+            "Autosurfer", vector_index.embedding.format_last_stats(), debug_only=True
+        )
+    return no_new_chunks
+
+
+def search_and_index(
+    api_key: str,
+    search_engine_id: str,
+    queries: Iterable[str],
+    max_docs: int | None = None,
+    web_cache: WebCache | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+    search_url: str = SEARCH_API_URL,
+) -> tuple[int, int]:
+    """
+    Runs `iter_search` and indexes each page on a background thread as soon as it is scraped, so chunking and
+    embedding overlap with the searches and scrapes still running. Searching stops once `max_docs` pages are in.
+
+    Returns:
+        tuple: How many pages were scraped and how many new chunks were indexed.
+    """
+    chunker = Chunker(chunk_size, chunk_overlap)
+    with ThreadPoolExecutor(max_workers=1) as indexer:
+        index_futures = [
+            indexer.submit(index_documents, [doc], chunker)
+            for _, _, doc in iter_search(
+                api_key,
+                search_engine_id,
+                queries,
+                max_docs=max_docs,
+                search_url=search_url,
+                web_cache=web_cache,
+            )
+        ]
+    return len(index_futures), sum(future.result() for future in index_futures)
+
 
-    return vectorstore.as_retriever()
+def make_vectorstore_retriever(
+    search_docs: list[Document],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    chunk_overlap: int = DEFAULT_CHUNK_OVERLAP,
+    k: int = DEFAULT_K,
+    context_token_budget: int | None = DEFAULT_CONTEXT_TOKEN_BUDGET,
+    rerank_model: str | None = None,
+) -> HybridRetriever:
+    """
+    Indexes the search results and returns `make_hybrid_retriever(k, context_token_budget, rerank_model)`.
+    """
+    index_documents(search_docs, Chunker(chunk_size, chunk_overlap))
+    return make_hybrid_retriever(k, context_token_budget, rerank_model)
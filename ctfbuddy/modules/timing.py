@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+from typing import Optional
+
+import modules.logging as log
+from modules.metrics import STAGE_DURATION
+
+
+@dataclass
+class Span:
+    name: str
+    start: float  # seconds since the trace started
+    end: Optional[float] = None
+    details: dict = field(default_factory=dict)
+
+    @property
+    def duration(self):
+        return None if self.end is None else self.end - self.start
+
+
+class TimingTrace:
+    """
+    Records how long each stage of a request takes, relative to when the trace started.
+
+    Stages may overlap and may be recorded from any thread. Each finished stage is logged (debug only).
+    """
+
+    def __init__(self, module: str):
+        self.module = module
+        self.spans = []
+        self._start = perf_counter()
+        self._lock = Lock()
+
+    def now(self) -> float:
+        return perf_counter() - self._start
+
+    def begin(self, name: str, **details) -> Span:
+        span = Span(name, self.now(), details=details)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def end(self, span: Span, **details):
+        span.end = self.now()
+        span.details.update(details)
+        STAGE_DURATION.observe(span.duration, module=self.module, stage=span.name)
+        log.log_info(
+            self.module,
+            f"{span.name} took {round(span.duration, 2)}s",
+            debug_only=True,
+        )
+
+    @contextmanager
+    def stage(self, name: str, **details):
+        span = self.begin(name, **details)
+        try:
+            yield span
+        finally:
+            self.end(span)
+
+    def mark(self, name: str, **details) -> Span:
+        """
+        Records an instant, e.g. the first token of an answer.
+        """
+        span = self.begin(name, **details)
+        span.end = span.start
+        return span
+
+    def total(self) -> float:
+        with self._lock:
+            return max(
+                (span.end for span in self.spans if span.end is not None), default=0
+            )
+
+    def as_dicts(self) -> list[dict]:
+        with self._lock:
+            return [
+                {
+                    "stage": span.name,
+                    "start": span.start,
+                    "duration": span.duration,
+                    **span.details,
+                }
+                for span in self.spans
+            ]
+
+    def format_markdown(self) -> str:
+        rows = [
+            "| Stage | Started at | Took |",
+            "| --- | --- | --- |",
+        ]
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start)
+        for span in spans:
+            took = "running" if span.end is None else f"{round(span.duration, 2)}s"
+            details = ", ".join(
+                f"{key}: {value}" for key, value in span.details.items()
+            )
+            rows.append(
+                f"| {span.name}{f' ({details})' if details else ''} | {round(span.start, 2)}s | {took} |"
+            )
+        return "\n".join(rows)
@@ -1,7 +1,16 @@
-from transformers import AutoTokenizer
-from tokenizers import Tokenizer
+from collections import OrderedDict
+from os import path, makedirs, remove, replace
+from shutil import rmtree
+from threading import Lock
+from uuid import uuid4
 
-from modules.config import get_config
+from modules.config import CACHE_DIR, CONFIG_STORE, get_config
+
+TOKENISER_CACHE_DIR = path.join(CACHE_DIR, "tokenisers")
+MAX_LOADED_TOKENISERS = 4
+
+NOMIC_EMBED_TEXT = "nomic-embed-text"
+NOMIC_EMBED_TEXT_REPO_ID = "nomic-ai/nomic-embed-text-v1.5"
 
 
 def mistral_format_system(conv):
@@ -23,49 +32,239 @@ def mistral_format_system(conv):
     return conv
 
 
+# model name -> (Hugging Face repo ID, context window, conversation formatter)
+MODEL_SPECS = {
+    "llama3": ("meta-llama/Meta-Llama-3-8B", 8192, None),
+    "mistral": (
+        "mistralai/Mistral-7B-Instruct-v0.3",
+        16384,  # usually 32768 but reduced to lower RAM usage
+        mistral_format_system,
+    ),
+    "openchat": ("openchat/openchat_3.5", 8192, None),
+    "phi3": ("microsoft/Phi-3-mini-4k-instruct", 4096, None),
+}
+SUPPORTED_MODELS = list(MODEL_SPECS)
+DEFAULT_MODEL = "mistral"
+
+
+def get_default_model():
+    """
+    Returns `default_model` from config.ini if it is a supported model, else DEFAULT_MODEL.
+    """
+    default_model = get_config().default_model
+    return default_model if default_model in MODEL_SPECS else DEFAULT_MODEL
+
+
+def _atomic_save(save_func, dest_path):
+    tmp_path = f"{dest_path}.{uuid4().hex}.tmp"
+    try:
+        save_func(tmp_path)
+        replace(tmp_path, dest_path)
+    except OSError:
+        # Another process won the race or the cache is read-only; the tokeniser
+        # is already loaded so the cache write is best-effort.
+        if path.isdir(tmp_path):
+            rmtree(tmp_path, ignore_errors=True)
+        elif path.exists(tmp_path):
+            remove(tmp_path)
+
+
+def _load_auto_tokeniser(repo_id, cache_path):
+    from transformers import AutoTokenizer
+
+    if path.exists(path.join(cache_path, "tokenizer_config.json")):
+        return AutoTokenizer.from_pretrained(cache_path, local_files_only=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        repo_id, token=get_config().huggingface_user_access_token
+    )
+    makedirs(path.dirname(cache_path), exist_ok=True)
+    _atomic_save(tokenizer.save_pretrained, cache_path)
+    return tokenizer
+
+
+def _load_hf_tokeniser(repo_id, cache_path):
+    from tokenizers import Tokenizer
+
+    if path.exists(cache_path):
+        return Tokenizer.from_file(cache_path)
+
+    tokenizer = Tokenizer.from_pretrained(
+        repo_id, auth_token=get_config().huggingface_user_access_token
+    )
+    makedirs(path.dirname(cache_path), exist_ok=True)
+    _atomic_save(tokenizer.save, cache_path)
+    return tokenizer
+
+
+class TokeniserRegistry:
+    """
+    Process-wide, thread-safe store of tokenisers keyed by model name.
+
+    Tokenisers are loaded on first use, kept resident up to `max_loaded` entries
+    (least recently used ones are dropped first) and serialised to `cache_dir` so
+    later loads, including after a restart, never need to reach the Hugging Face Hub.
+    """
+
+    def __init__(self, max_loaded=MAX_LOADED_TOKENISERS, cache_dir=TOKENISER_CACHE_DIR):
+        if max_loaded < 1:
+            raise ValueError("max_loaded must be at least 1")
+        self.max_loaded = max_loaded
+        self.cache_dir = cache_dir
+        self._tokenisers = OrderedDict()
+        self._lock = Lock()
+        self._load_locks = {}
+
+    def _get_resident(self, key):
+        tokenizer = self._tokenisers.get(key)
+        if tokenizer is not None:
+            self._tokenisers.move_to_end(key)
+        return tokenizer
+
+    def get(self, key, loader):
+        with self._lock:
+            if (tokenizer := self._get_resident(key)) is not None:
+                return tokenizer
+            load_lock = self._load_locks.setdefault(key, Lock())
+
+        # Only one thread loads a given tokeniser; the rest wait for it here.
+        with load_lock:
+            with self._lock:
+                if (tokenizer := self._get_resident(key)) is not None:
+                    return tokenizer
+
+            tokenizer = loader()
+
+            with self._lock:
+                self._tokenisers[key] = tokenizer
+                self._evict()
+        return tokenizer
+
+    def _evict(self):
+        while len(self._tokenisers) > self.max_loaded:
+            self._tokenisers.popitem(last=False)
+
+    def set_max_loaded(self, max_loaded):
+        if max_loaded < 1:
+            raise ValueError("max_loaded must be at least 1")
+        with self._lock:
+            self.max_loaded = max_loaded
+            self._evict()
+
+    def loaded(self):
+        with self._lock:
+            return list(self._tokenisers)
+
+    def get_chat_tokeniser(self, model_name):
+        if model_name not in MODEL_SPECS:
+            raise ValueError(f"{model_name} is not a supported model.")
+        repo_id = MODEL_SPECS[model_name][0]
+        return self.get(
+            model_name,
+            lambda: _load_auto_tokeniser(
+                repo_id, path.join(self.cache_dir, model_name)
+            ),
+        )
+
+    def get_embedding_tokeniser(self, model_name=NOMIC_EMBED_TEXT):
+        if model_name != NOMIC_EMBED_TEXT:
+            raise ValueError(f"{model_name} is not a supported embedding model.")
+        return self.get(
+            model_name,
+            lambda: _load_hf_tokeniser(
+                NOMIC_EMBED_TEXT_REPO_ID,
+                path.join(self.cache_dir, f"{model_name}.json"),
+            ),
+        )
+
+
+def _max_loaded_from_config(config):
+    max_loaded = config.max_loaded_tokenisers
+    return max_loaded if max_loaded and max_loaded > 0 else MAX_LOADED_TOKENISERS
+
+
+def _on_config_change(old_config, new_config):
+    max_loaded = _max_loaded_from_config(new_config)
+    if max_loaded != _max_loaded_from_config(old_config):
+        TOKENISER_REGISTRY.set_max_loaded(max_loaded)
+
+
+# Resident tokenisers are capped by `max_loaded_tokenisers` in config.ini, and follow changes to it
+TOKENISER_REGISTRY = TokeniserRegistry(_max_loaded_from_config(get_config()))
+CONFIG_STORE.subscribe(_on_config_change)
+
+
 def get_tokeniser_and_context_window(model_name):
-    match model_name:
-        case "llama3":
-            tokenizer = AutoTokenizer.from_pretrained(
-                "meta-llama/Meta-Llama-3-8B",
-                token=get_config()["huggingface_user_access_token"],
-            )
-            ctx_window = 8192
-            num_token_func = lambda text: len(tokenizer.encode(text))
-            ct_num_token_func = lambda conv: len(tokenizer.apply_chat_template(conv))
-        case "mistral":
-            tokenizer = AutoTokenizer.from_pretrained(
-                "mistralai/Mistral-7B-Instruct-v0.3",
-                token=get_config()["huggingface_user_access_token"],
-            )
-            ctx_window = 16384  # usually 32768 but reduced to lower RAM usage
-            num_token_func = lambda text: len(tokenizer.encode(text))
-            ct_num_token_func = lambda conv: len(
-                tokenizer.apply_chat_template(mistral_format_system(conv))
-            )
-        case "openchat":
-            tokenizer = AutoTokenizer.from_pretrained(
-                "openchat/openchat_3.5",
-                token=get_config()["huggingface_user_access_token"],
-            )
-            ctx_window = 8192
-            num_token_func = lambda text: len(tokenizer.encode(text))
-            ct_num_token_func = lambda conv: len(tokenizer.apply_chat_template(conv))
-        case "phi3":
-            tokenizer = AutoTokenizer.from_pretrained(
-                "microsoft/Phi-3-mini-4k-instruct",
-                token=get_config()["huggingface_user_access_token"],
-            )
-            ctx_window = 4096
-            num_token_func = lambda text: len(tokenizer.encode(text))
-            ct_num_token_func = lambda conv: len(tokenizer.apply_chat_template(conv))
-        case _:
-            raise ValueError(f"{modelname} is not a supported model.")
+    tokenizer = TOKENISER_REGISTRY.get_chat_tokeniser(model_name)
+    _, ctx_window, conv_formatter = MODEL_SPECS[model_name]
+
+    num_token_func = lambda text: len(tokenizer.encode(text))
+    if conv_formatter:
+        ct_num_token_func = lambda conv: len(
+            tokenizer.apply_chat_template(conv_formatter(conv))
+        )
+    else:
+        ct_num_token_func = lambda conv: len(tokenizer.apply_chat_template(conv))
 
     return tokenizer, ctx_window, num_token_func, ct_num_token_func
 
 
-NOMIC_EMBED_TEXT_TOKENIZER = Tokenizer.from_pretrained(
-    "nomic-ai/nomic-embed-text-v1.5",
-    auth_token=get_config()["huggingface_user_access_token"],
-)
+_TEMPLATE_CALIBRATION_CONV = [
+    {"role": "system", "content": "You are a helpful assistant."},
+    {"role": "user", "content": "What is RSA?"},
+    {"role": "assistant", "content": "RSA is a public-key cryptosystem."},
+    {"role": "user", "content": "How can it be broken?"},
+]
+_template_overheads = {}
+_template_overheads_lock = Lock()
+
+
+def get_template_overheads(model_name):
+    """
+    Measures how many tokens the chat template adds around a message's content.
+
+    Returns a dict keyed by (position, role), where position is "first", "after_system"
+    or "subsequent", or None if the model's chat template cannot be calibrated.
+    """
+    with _template_overheads_lock:
+        if model_name in _template_overheads:
+            return _template_overheads[model_name]
+
+    tokenizer, _, _, ct_num_token_func = get_tokeniser_and_context_window(model_name)
+    conv = _TEMPLATE_CALIBRATION_CONV
+    content_len = lambda message: len(
+        tokenizer.encode(message["content"], add_special_tokens=False)
+    )
+
+    try:
+        prefix_lens = [ct_num_token_func(conv[: i + 1]) for i in range(len(conv))]
+        overheads = {
+            ("first", "system"): prefix_lens[0] - content_len(conv[0]),
+            ("first", "user"): ct_num_token_func(conv[1:2]) - content_len(conv[1]),
+            ("after_system", "user"): prefix_lens[1]
+            - prefix_lens[0]
+            - content_len(conv[1]),
+            ("subsequent", "assistant"): prefix_lens[2]
+            - prefix_lens[1]
+            - content_len(conv[2]),
+            ("subsequent", "user"): prefix_lens[3]
+            - prefix_lens[2]
+            - content_len(conv[3]),
+        }
+    except Exception:
+        overheads = None
+
+    with _template_overheads_lock:
+        _template_overheads[model_name] = overheads
+    return overheads
+
+
+def get_nomic_embed_text_tokeniser():
+    return TOKENISER_REGISTRY.get_embedding_tokeniser(NOMIC_EMBED_TEXT)
+
+
+def __getattr__(name):
+    # Kept for callers that still import the constant; it now loads on first access.
+    if name == "NOMIC_EMBED_TEXT_TOKENIZER":
+        return get_nomic_embed_text_tokeniser()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
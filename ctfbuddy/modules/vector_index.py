@@ -0,0 +1,232 @@
+from hashlib import sha256
+from os import path
+from threading import Lock
+from time import time
+
+import chromadb
+from chromadb.config import Settings
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import Chroma
+
+from modules.bm25_index import BM25Index
+from modules.config import CACHE_DIR
+from modules.embeddings import EmbeddingService
+
+VECTOR_INDEX_DIR = path.join(CACHE_DIR, "vector_index")
+COLLECTION_NAME = "ctfbuddy-rag"
+DEFAULT_TTL = 30 * 24 * 60 * 60  # seconds
+BATCH_SIZE = 512
+
+
+def chunk_id(text: str) -> str:
+    return sha256(text.encode()).hexdigest()
+
+
+class VectorIndex:
+    """
+    Persistent Chroma index of every chunk the study chatbot has gathered, with a BM25 index kept alongside it.
+
+    Chunks are keyed by the SHA-256 of their text, so each distinct chunk is embedded once no matter how many
+    searches find it again, and retrieval covers everything gathered so far. Chunks are pruned `ttl` seconds after
+    they were first added, and `compact` rebuilds the collection and the embedding cache to reclaim the space left
+    by deleted chunks.
+    The BM25 index shares the chunk IDs and is updated, pruned and rebuilt together with the collection.
+    """
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        persist_directory: str = VECTOR_INDEX_DIR,
+        collection_name: str = COLLECTION_NAME,
+        ttl: float = DEFAULT_TTL,
+        bm25_index: BM25Index | None = None,
+    ):
+        self.embedding = embedding
+        self.bm25 = bm25_index or BM25Index()
+        self.collection_name = collection_name
+        self.ttl = ttl
+        self._lock = Lock()
+        self.client = chromadb.PersistentClient(
+            path=persist_directory, settings=Settings(anonymized_telemetry=False)
+        )
+        self._open()
+
+    def _open(self):
+        self.vectorstore = Chroma(
+            client=self.client,
+            collection_name=self.collection_name,
+            embedding_function=self.embedding,
+            collection_metadata={"hnsw:space": "cosine"},
+        )
+
+    @property
+    def collection(self):
+        return self.vectorstore._collection
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def existing_ids(self, ids: list[str]) -> set[str]:
+        existing = set()
+        for i in range(0, len(ids), BATCH_SIZE):
+            existing.update(
+                self.collection.get(ids=ids[i : i + BATCH_SIZE], include=[])["ids"]
+            )
+        return existing
+
+    def add_documents(self, docs: list[Document]) -> int:
+        """
+        Embeds and adds the chunks that are not in the index yet.
+
+        Returns:
+            int: How many chunks were new.
+        """
+        new_docs = {}
+        for doc in docs:
+            new_docs.setdefault(chunk_id(doc.page_content), doc)
+
+        with self._lock:
+            self.bm25.add(
+                list(new_docs), [doc.page_content for doc in new_docs.values()]
+            )
+            for existing_id in self.existing_ids(list(new_docs)):
+                del new_docs[existing_id]
+            if not new_docs:
+                return 0
+
+            added_at = time()
+            ids = list(new_docs)
+            texts = [new_docs[id].page_content for id in ids]
+            embeddings = self.embedding.embed_documents(texts)
+            metadatas = [
+                {
+                    **{
+                        key: value
+                        for key, value in new_docs[id].metadata.items()
+                        if isinstance(value, (str, int, float, bool))
+                    },
+                    "added_at": added_at,
+                }
+                for id in ids
+            ]
+            for i in range(0, len(ids), BATCH_SIZE):
+                self.collection.add(
+                    ids=ids[i : i + BATCH_SIZE],
+                    embeddings=embeddings[i : i + BATCH_SIZE],
+                    documents=texts[i : i + BATCH_SIZE],
+                    metadatas=metadatas[i : i + BATCH_SIZE],
+                )
+        return len(new_docs)
+
+    def dense_search(self, query: str, k: int) -> list[str]:
+        """
+        Returns:
+            list: The IDs of the `k` chunks closest to the query embedding, closest first.
+        """
+        n_results = min(k, self.count())
+        if not n_results:
+            return []
+        return self.collection.query(
+            query_embeddings=[self.embedding.embed_query(query)],
+            n_results=n_results,
+            include=[],
+        )["ids"][0]
+
+    def get_documents(self, ids: list[str]) -> list[Document]:
+        """
+        Returns the chunks with the given IDs in the same order, skipping IDs that are not in the index.
+        """
+        found = {}
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = self.collection.get(
+                ids=ids[i : i + BATCH_SIZE], include=["documents", "metadatas"]
+            )
+            for id, text, metadata in zip(
+                batch["ids"], batch["documents"], batch["metadatas"]
+            ):
+                found[id] = Document(page_content=text, metadata=metadata or {})
+        return [found[id] for id in ids if id in found]
+
+    def as_retriever(self, **kwargs):
+        return self.vectorstore.as_retriever(**kwargs)
+
+    def prune(self, ttl: float | None = None) -> int:
+        """
+        Deletes chunks added more than `ttl` seconds ago (by default the index's TTL).
+
+        Returns:
+            int: How many chunks were deleted.
+        """
+        cutoff = time() - (self.ttl if ttl is None else ttl)
+        with self._lock:
+            expired_ids = self.collection.get(
+                where={"added_at": {"$lt": cutoff}}, include=[]
+            )["ids"]
+            for i in range(0, len(expired_ids), BATCH_SIZE):
+                self.collection.delete(ids=expired_ids[i : i + BATCH_SIZE])
+            self.bm25.delete(expired_ids)
+        return len(expired_ids)
+
+    def compact(self) -> tuple[int, int]:
+        """
+        Prunes expired chunks, then copies the rest into a fresh collection so the HNSW index drops deleted entries.
+        The BM25 index is rebuilt from the kept chunks on the way.
+
+        Returns:
+            tuple: How many chunks were pruned and how many were kept.
+        """
+        no_pruned = self.prune()
+        with self._lock:
+            old_collection = self.collection
+            compacted_name = f"{self.collection_name}-compacting"
+            try:
+                self.client.delete_collection(compacted_name)
+            except ValueError:
+                pass
+            compacted = self.client.create_collection(
+                compacted_name, metadata=old_collection.metadata
+            )
+
+            self.bm25.clear()
+            no_kept = 0
+            kept_hashes = []
+            while True:
+                batch = old_collection.get(
+                    include=["embeddings", "documents", "metadatas"],
+                    limit=BATCH_SIZE,
+                    offset=no_kept,
+                )
+                if not batch["ids"]:
+                    break
+                compacted.add(
+                    ids=batch["ids"],
+                    embeddings=batch["embeddings"],
+                    documents=batch["documents"],
+                    metadatas=batch["metadatas"],
+                )
+                self.bm25.add(batch["ids"], batch["documents"])
+                if isinstance(self.embedding, EmbeddingService):
+                    kept_hashes += self.embedding.document_hashes(batch["documents"])
+                no_kept += len(batch["ids"])
+
+            self.client.delete_collection(self.collection_name)
+            compacted.modify(name=self.collection_name)
+            self._open()
+            self.bm25.vacuum()
+            if isinstance(self.embedding, EmbeddingService):
+                # Cached vectors of pruned chunks would otherwise stay on disk for good
+                self.embedding.vector_cache.retain(kept_hashes)
+        return no_pruned, no_kept
+
+
+_vector_index = None
+_vector_index_lock = Lock()
+
+
+def get_vector_index() -> VectorIndex:
+    global _vector_index
+    with _vector_index_lock:
+        if _vector_index is None:
+            _vector_index = VectorIndex(EmbeddingService())
+        return _vector_index
@@ -0,0 +1,261 @@
+from collections import deque
+from threading import Event, Lock, Thread
+from time import monotonic
+from urllib.parse import urlparse
+
+import httpx
+import ollama
+from gradio import Error as GradioError
+
+import modules.logging as log
+from modules.host import get_host
+from modules.tokenisers import (
+    SUPPORTED_MODELS,
+    get_default_model,
+    get_template_overheads,
+    get_tokeniser_and_context_window,
+)
+
+WARMUP_INTERVAL = 60  # seconds between background passes
+USAGE_WINDOW = 60 * 60  # seconds of usage history that decide keep_alive
+MIN_KEEP_ALIVE = 5 * 60  # seconds, Ollama's own default
+KEEP_ALIVE_PER_USE = 5 * 60  # seconds
+MAX_KEEP_ALIVE = 2 * 60 * 60  # seconds
+LOW_MEMORY_FRACTION = 0.1  # of total RAM still available
+LOCAL_HOSTNAMES = {"localhost", "127.0.0.1", "::1", "0.0.0.0"}
+WARMUP_SESSION_ID = "warm-up"
+# How long a load waits for a generation slot before it is skipped
+SLOT_WAIT_TIMEOUT = 30  # seconds
+
+
+def available_memory_fraction():
+    """
+    Returns MemAvailable/MemTotal from /proc/meminfo, or None where it cannot be read.
+    """
+    meminfo = {}
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0])
+        return meminfo["MemAvailable"] / meminfo["MemTotal"]
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+def is_local_backend(backend):
+    return urlparse(backend.url).hostname in LOCAL_HOSTNAMES
+
+
+class ModelWarmupManager:
+    """
+    Keeps the autosolver models loaded in Ollama so solves do not wait for a model to load from disk.
+
+    On start, the tokenisers are loaded and the most recently used model, or else the configured default model, is
+    preloaded on each healthy backend that hosts it. After that, a background pass every `interval` seconds re-pins
+    the models used in the last `USAGE_WINDOW` seconds, with a `keep_alive` that grows with how often each model was
+    used. Loads go through the backend's scheduler, so they count against its limits like any generation. When a
+    local backend runs low on RAM, checked before every load, the least used model it has loaded is unloaded instead
+    of loading anything else.
+    """
+
+    def __init__(
+        self,
+        models=SUPPORTED_MODELS,
+        interval=WARMUP_INTERVAL,
+        low_memory_fraction=LOW_MEMORY_FRACTION,
+    ):
+        self.models = list(models)
+        self.interval = interval
+        self.low_memory_fraction = low_memory_fraction
+
+        self._lock = Lock()
+        self._uses = {model: deque() for model in self.models}
+        self._last_used = {}
+        self._stop = Event()
+        self._thread = None
+
+    def record_use(self, model_name):
+        now = monotonic()
+        with self._lock:
+            self._uses.setdefault(model_name, deque()).append(now)
+            self._last_used[model_name] = now
+
+    def recent_uses(self, model_name):
+        cutoff = monotonic() - USAGE_WINDOW
+        with self._lock:
+            uses = self._uses.get(model_name)
+            if uses is None:
+                return 0
+            while uses and uses[0] < cutoff:
+                uses.popleft()
+            return len(uses)
+
+    def keep_alive_for(self, model_name):
+        return min(
+            MIN_KEEP_ALIVE + self.recent_uses(model_name) * KEEP_ALIVE_PER_USE,
+            MAX_KEEP_ALIVE,
+        )
+
+    def _memory_tight(self, backend):
+        if not is_local_backend(backend):
+            return False
+        fraction = available_memory_fraction()
+        return fraction is not None and fraction < self.low_memory_fraction
+
+    def _load(self, backend, model_name, keep_alive):
+        # An empty generate request loads the model and sets its keep_alive without generating anything
+        try:
+            backend.client.generate(model=model_name, keep_alive=keep_alive)
+        except (ollama.ResponseError, httpx.HTTPError) as e:
+            log.log_warning(
+                "Warm-up",
+                f"Could not load {model_name} on {backend.name}: {e}",
+                debug_only=True,
+            )
+            return False
+        return True
+
+    def _load_with_slot(self, backend, model_name, keep_alive):
+        scheduler = backend.scheduler
+        ticket = scheduler.submit(WARMUP_SESSION_ID, model_name)
+        try:
+            if not scheduler.wait(ticket, SLOT_WAIT_TIMEOUT):
+                log.log_warning(
+                    "Warm-up",
+                    f"Skipped loading {model_name} on {backend.name}, no generation slot freed up in {SLOT_WAIT_TIMEOUT}s",
+                    debug_only=True,
+                )
+                return False
+            return self._load(backend, model_name, keep_alive)
+        finally:
+            scheduler.release(ticket)
+
+    def _evict_coldest(self, backend):
+        # Never unload the last model, which would only make the next solve slower
+        loaded = [model for model in self.models if backend.has_loaded(model)]
+        if len(loaded) < 2:
+            return
+        coldest = min(
+            loaded,
+            key=lambda model: (
+                self.recent_uses(model),
+                self._last_used.get(model, float("-inf")),
+            ),
+        )
+        if self._load(backend, coldest, 0):
+            backend.loaded_models -= {coldest}
+            log.log_warning(
+                "Warm-up",
+                f"Low on RAM, unloaded {coldest} from {backend.name}",
+                debug_only=True,
+            )
+
+    def prewarm_tokenisers(self):
+        for model in self.models:
+            try:
+                get_tokeniser_and_context_window(model)
+                get_template_overheads(model)
+            except Exception as e:
+                log.log_warning(
+                    "Warm-up",
+                    f"Could not load the {model} tokeniser: {e}",
+                    debug_only=True,
+                )
+
+    def preload_model(self):
+        """
+        Returns the most recently used model, or the configured default model if none has been used yet.
+        """
+        with self._lock:
+            if self._last_used:
+                return max(self._last_used, key=self._last_used.get)
+        return get_default_model()
+
+    def run_once(self, preload=False):
+        """
+        Refreshes which models each backend has loaded, then re-pins the models that should be hot and, if `preload`,
+        loads `preload_model()`.
+        """
+        try:
+            router = get_host()
+        except GradioError:
+            return  # No Ollama server configured yet
+        router.refresh(force=True)
+        preload_model = self.preload_model() if preload else None
+
+        for backend in router.backends:
+            if not backend.healthy:
+                continue
+            if self._memory_tight(backend):
+                self._evict_coldest(backend)
+            for model in self.models:
+                if not backend.hosts(model):
+                    continue
+                if backend.has_loaded(model):
+                    if preload or self.recent_uses(model):
+                        self._load_with_slot(backend, model, self.keep_alive_for(model))
+                # Memory is checked again before each load, since the previous one may have used it up
+                elif model == preload_model and not self._memory_tight(backend):
+                    if self._load_with_slot(backend, model, self.keep_alive_for(model)):
+                        backend.loaded_models |= {model}
+
+    def _run(self):
+        start_time = monotonic()
+        self.prewarm_tokenisers()
+        self.run_once(preload=True)
+        log.log_info(
+            "Warm-up",
+            f"Warmed up models in {round(monotonic()-start_time, 2)}s",
+            debug_only=True,
+        )
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="model-warmup", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status_markdown(self):
+        try:
+            router = get_host()
+        except GradioError:
+            return "Ollama server not configured."
+        router.refresh()
+
+        rows = [
+            "| Model | Backend | Status | Uses (last hour) | keep_alive |",
+            "| --- | --- | --- | --- | --- |",
+        ]
+        for model in self.models:
+            for backend in router.backends:
+                if not backend.hosts(model):
+                    continue
+                if not backend.healthy:
+                    status = "Unreachable"
+                elif backend.has_loaded(model):
+                    status = "Hot"
+                else:
+                    status = "Cold"
+                rows.append(
+                    f"| {model} | {backend.name} | {status} | {self.recent_uses(model)} | {self.keep_alive_for(model) // 60} min |"
+                )
+        if (fraction := available_memory_fraction()) is not None:
+            rows.append(f"\nLocal RAM available: {round(fraction*100, 1)}%")
+        return "\n".join(rows)
+
+
+_warmup_manager = None
+_warmup_manager_lock = Lock()
+
+
+def get_warmup_manager():
+    global _warmup_manager
+    with _warmup_manager_lock:
+        if _warmup_manager is None:
+            _warmup_manager = ModelWarmupManager()
+        return _warmup_manager
@@ -0,0 +1,198 @@
+import json
+from collections import Counter
+from dataclasses import dataclass
+from hashlib import sha256
+from os import path
+from threading import Lock
+from time import time
+from typing import Optional
+
+from modules.config import CACHE_DIR
+from modules.metrics import WEB_CACHE_LOOKUPS
+from modules.sqlite_cache import connect_cache_db, evict_expired_and_lru
+
+WEB_CACHE_PATH = path.join(CACHE_DIR, "web.sqlite3")
+PAGE_FRESH_TTL = 24 * 60 * 60  # seconds a page is served without revalidation
+SEARCH_TTL = 24 * 60 * 60  # seconds, search results cannot be revalidated
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60  # seconds
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+@dataclass
+class CachedEntry:
+    value: object
+    etag: Optional[str]
+    last_modified: Optional[str]
+    fetched_at: float
+
+    def age(self):
+        return time() - self.fetched_at
+
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class WebCache:
+    """
+    Persistent SQLite cache of scraped pages and search results for the study chatbot.
+
+    Pages are stored as extracted title and text, keyed by URL, together with their ETag and Last-Modified
+    headers. A page younger than `page_fresh_ttl` is served straight from the cache; an older one is revalidated
+    with a conditional request and reused on 304 Not Modified. Search results are keyed by search engine and query
+    and reused for `search_ttl` seconds. Entries older than `max_age` are dropped, and the least recently used ones
+    are evicted once the cache holds more than `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        db_path=WEB_CACHE_PATH,
+        page_fresh_ttl=PAGE_FRESH_TTL,
+        search_ttl=SEARCH_TTL,
+        max_age=DEFAULT_MAX_AGE,
+        max_bytes=DEFAULT_MAX_BYTES,
+    ):
+        self.page_fresh_ttl = page_fresh_ttl
+        self.search_ttl = search_ttl
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self._lock = Lock()
+
+        self._conn = connect_cache_db(db_path)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                last_accessed REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS entries_last_accessed ON entries (last_accessed)"
+        )
+
+    @staticmethod
+    def page_key(url):
+        return f"page:{url}"
+
+    @staticmethod
+    def search_key(search_engine_id, query):
+        return f"search:{sha256(json.dumps([search_engine_id, query]).encode()).hexdigest()}"
+
+    def _get(self, key):
+        now = time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, etag, last_modified, fetched_at FROM entries WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            value, etag, last_modified, fetched_at = row
+            if now - fetched_at > self.max_age:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE entries SET last_accessed = ? WHERE key = ?", (now, key)
+            )
+        return CachedEntry(json.loads(value), etag, last_modified, fetched_at)
+
+    def _put(self, key, value, etag=None, last_modified=None):
+        now = time()
+        value = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, value, etag, last_modified, len(value.encode()), now, now),
+            )
+            evict_expired_and_lru(
+                self._conn,
+                "entries",
+                "fetched_at",
+                self.max_age,
+                self.max_bytes,
+                now,
+            )
+
+    def get_page(self, url):
+        """
+        Returns:
+            tuple: The cached page entry (or None) and whether it is fresh enough to use without revalidating.
+        """
+        entry = self._get(WebCache.page_key(url))
+        return entry, entry is not None and entry.age() <= self.page_fresh_ttl
+
+    def put_page(self, url, title, text, etag=None, last_modified=None):
+        self._put(
+            WebCache.page_key(url),
+            {"title": title, "text": text},
+            etag,
+            last_modified,
+        )
+
+    def mark_page_revalidated(self, url):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE entries SET fetched_at = ? WHERE key = ?",
+                (time(), WebCache.page_key(url)),
+            )
+
+    def get_search(self, search_engine_id, query):
+        entry = self._get(WebCache.search_key(search_engine_id, query))
+        if entry is None or entry.age() > self.search_ttl:
+            return None
+        return entry.value
+
+    def put_search(self, search_engine_id, query, links):
+        self._put(WebCache.search_key(search_engine_id, query), links)
+
+    def record(self, kind, outcome):
+        WEB_CACHE_LOOKUPS.inc(kind=kind, outcome=outcome)
+        with self._lock:
+            self.stats[(kind, outcome)] += 1
+
+    def stats_snapshot(self):
+        with self._lock:
+            return Counter(self.stats)
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries")
+
+
+def format_hit_rates(stats):
+    """
+    Summarises hit/revalidated/miss counts (e.g. the difference of two `stats_snapshot`s) per kind of entry.
+    """
+    parts = []
+    for kind, label in (("search", "searches"), ("page", "pages")):
+        hits = stats[(kind, "hit")]
+        revalidated = stats[(kind, "revalidated")]
+        total = hits + revalidated + stats[(kind, "miss")]
+        if not total:
+            continue
+        text = f"{label} {hits + revalidated}/{total} hits ({round((hits + revalidated) / total * 100, 1)}%)"
+        if revalidated:
+            text += f", {revalidated} revalidated"
+        parts.append(text)
+    return "; ".join(parts) or "no lookups"
+
+
+_web_cache = None
+_web_cache_lock = Lock()
+
+
+def get_web_cache():
+    global _web_cache
+    with _web_cache_lock:
+        if _web_cache is None:
+            _web_cache = WebCache()
+        return _web_cache
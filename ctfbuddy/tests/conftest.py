@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# The app imports its modules as `modules.<name>` from the ctfbuddy directory
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
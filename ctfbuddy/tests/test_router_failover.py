@@ -0,0 +1,100 @@
+import asyncio
+
+import gradio as gr
+import httpx
+import pytest
+
+import modules.config as config
+import modules.host as host
+from benchmarks.mock_ollama import MockOllamaServer
+from modules.router import Backend, OllamaRouter
+
+MODEL = "llama3"
+MESSAGES = [{"role": "user", "content": "How do I factor a small RSA modulus?"}]
+
+
+def kill(server):
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def servers():
+    servers = [
+        MockOllamaServer(first_token_delay=0, reply_tokens=4).start() for _ in range(2)
+    ]
+    yield servers
+    for server in servers:
+        kill(server)
+
+
+def make_router(servers):
+    return OllamaRouter(
+        [Backend(f"backend-{i}", server.url) for i, server in enumerate(servers)]
+    )
+
+
+def bind_and_kill(router, servers, session):
+    dead = session.backend
+    kill(servers[router.backends.index(dead)])
+    return dead
+
+
+def test_session_fails_over_when_its_backend_dies(servers):
+    router = make_router(servers)
+    session = router.session(MODEL)
+    dead = bind_and_kill(router, servers, session)
+
+    res = session.chat(model=MODEL, messages=MESSAGES)
+
+    assert res["message"]["content"]
+    assert session.backend is not dead
+    assert not dead.healthy
+    assert servers[router.backends.index(session.backend)].stats["/api/chat"] == 1
+
+
+def test_streaming_session_fails_over_when_its_backend_dies(servers):
+    router = make_router(servers)
+    session = router.session(MODEL)
+    dead = bind_and_kill(router, servers, session)
+
+    chunks = list(session.chat(model=MODEL, messages=MESSAGES, stream=True))
+
+    assert chunks[-1]["done"]
+    assert session.backend is not dead
+
+
+def test_async_session_fails_over_when_its_backend_dies(servers):
+    router = make_router(servers)
+    session = router.async_session(MODEL)
+    dead = bind_and_kill(router, servers, session)
+
+    async def chat():
+        return [
+            chunk
+            async for chunk in await session.chat(
+                model=MODEL, messages=MESSAGES, stream=True
+            )
+        ]
+
+    assert asyncio.run(chat())[-1]["done"]
+    assert session.backend is not dead
+
+
+def test_session_raises_when_every_backend_is_down(servers):
+    router = make_router(servers)
+    session = router.session(MODEL)
+    for server in servers:
+        kill(server)
+
+    with pytest.raises(httpx.TransportError):
+        session.chat(model=MODEL, messages=MESSAGES)
+    assert not any(backend.healthy for backend in router.backends)
+
+
+def test_get_host_without_config_raises_gradio_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(config.CONFIG_STORE, "path", str(tmp_path / "config.ini"))
+    monkeypatch.setattr(host, "_router", None)
+
+    with pytest.raises(gr.Error):
+        host.get_host()
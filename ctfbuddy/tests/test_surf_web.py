@@ -0,0 +1,139 @@
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import modules.study_chatbot.surf_web as surf_web
+
+LINKS_PER_QUERY = 4
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    """
+    Serves Custom Search-style results at /search?q=<query> and a small HTML page at every other path.
+
+    Each query's results are its own pages `/<query>/0` to `/<query>/3`, except that a query's first result is
+    `/broken` if the query starts with "broken", and every query also links to `/shared`.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type, status=200):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        with self.server.lock:
+            self.server.requests.append(url.path)
+        base_url = (
+            f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+        )
+
+        if url.path == "/search":
+            query = parse_qs(url.query)["q"][0]
+            paths = [f"/{query}/{i}" for i in range(LINKS_PER_QUERY)]
+            if query.startswith("broken"):
+                paths[0] = "/broken"
+            paths.insert(1, "/shared")
+            items = [{"link": base_url + path} for path in paths]
+            self._send(json.dumps({"items": items}), "application/json")
+        elif url.path == "/broken":
+            self._send("Internal Server Error", "text/plain", 500)
+        else:
+            self._send(
+                f"<html><head><title>{url.path}</title><script>var x;</script></head>"
+                f"<body><p>Writeup for {url.path}</p></body></html>",
+                "text/html",
+            )
+
+
+@pytest.fixture
+def fixture_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    server.daemon_threads = True
+    server.requests = []
+    server.lock = Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run_search(server, queries, **kwargs):
+    return surf_web.search(
+        "key", "engine", queries, search_url=f"{server.url}/search", **kwargs
+    )
+
+
+def test_search_scrapes_docs_per_query_pages_per_query(fixture_server):
+    docs = run_search(fixture_server, ["rsa"])
+
+    assert [doc.metadata["title"] for doc in docs] == ["/rsa/0", "/shared"]
+    assert "var x" not in docs[0].page_content
+    assert "Writeup for /rsa/0" in docs[0].page_content
+
+
+def test_search_drops_urls_already_taken_by_another_query(fixture_server):
+    docs = run_search(fixture_server, ["rsa", "xor", "aes"])
+
+    sources = [doc.metadata["source"] for doc in docs]
+    assert len(sources) == 6
+    assert len(sources) == len(set(sources))
+    assert fixture_server.requests.count("/shared") == 1
+
+
+def test_search_moves_on_to_the_next_link_when_a_page_fails(fixture_server):
+    docs = run_search(fixture_server, ["broken-rsa"])
+
+    assert [doc.metadata["title"] for doc in docs] == ["/shared", "/broken-rsa/1"]
+    assert "/broken" in fixture_server.requests
+
+
+def test_search_stops_at_max_docs(fixture_server):
+    docs = run_search(fixture_server, ["rsa", "xor", "aes", "ecc"], max_docs=3)
+
+    assert len(docs) == 3
+
+
+def test_iter_search_consumes_lazy_queries(fixture_server):
+    def queries():
+        yield "rsa"
+        yield "xor"
+
+    results = list(
+        surf_web.iter_search(
+            "key", "engine", queries(), search_url=f"{fixture_server.url}/search"
+        )
+    )
+
+    assert {i for i, _, _ in results} == {0, 1}
+
+
+def test_search_and_index_passes_max_docs_through(fixture_server, monkeypatch):
+    indexed = []
+    # Only the pages handed to the indexer matter here, not how they are chunked
+    monkeypatch.setattr(surf_web, "Chunker", lambda *args: None)
+    monkeypatch.setattr(
+        surf_web,
+        "index_documents",
+        lambda docs, chunker=None: indexed.extend(docs) or len(docs),
+    )
+
+    no_pages, no_new_chunks = surf_web.search_and_index(
+        "key",
+        "engine",
+        ["rsa", "xor", "aes", "ecc"],
+        max_docs=3,
+        search_url=f"{fixture_server.url}/search",
+    )
+
+    assert no_pages == no_new_chunks == len(indexed) == 3